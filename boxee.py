@@ -1,19 +1,27 @@
 #!/usr/bin/python
 
+import time
+STARTED = time.time()
+
 import dbus, dbus.mainloop.glib, dbus.service, gobject
 from dbus.exceptions import DBusException
 from boxee.box_service import BoxService
 from boxee.exceptions import DoesNotExistException, FailedException, InvalidArgsException, InvalidValueLengthException, \
     NotPermittedException, NotSupportedException
-import sys, os, getopt, logging, logging.handlers
+import sys, os, getopt, signal, logging, logging.handlers
 from boxee import stypes
-import boxee.core, boxee.io_service, boxee.advertisement, boxee.utils, boxee.gpio
+import boxee.core, boxee.utils
+from boxee.adapters import AdapterRegistry, AdapterBinding
 from boxee.gpio import GpioConnector
 from boxee.io_service import AutomationIOService
-from boxee.system_service import SystemService
-from boxee.advertisement import BoxAdvertisement
+from boxee.advertisement import BoxAdvertisement, AdvertisementPayload
+from boxee.executor import MainLoopExecutor
+from boxee.schema import GattSchema
+import boxee.config
+import boxee.recorder
+import boxee.executor
+import boxee.allocation
 import boxee.persistence
-import boxee.box_service
 
 mainloop = None
 logger = logging.getLogger(__name__)
@@ -25,44 +33,102 @@ class BoxeeServer:
     """
     # todo: bluetoothd[1792]: Can't store info for private addressed device
 
-    def __init__(self, current_folder, log_level):
+    def __init__(self, current_folder, log_level, profile=None, system_metrics=True, session_spread=0,
+                 gatt_profile=None, upstream=None, backup_interval=None, storage='sqlite', token_key=None,
+                 config_file=None, latency_probe=False, throughput_test=False):
+        """
+            :param current_folder: the program folder (location of the database)
+            :param log_level: the log level of the root logger; None: the level of the configuration
+            :param profile: if set, the duration of the startup stages are reported
+            :param system_metrics: publish the system (memory, cpu) service
+            :param session_spread: an adapter stops advertising while it has more connected centrals than the least
+            loaded adapter plus this value, so new connections go to the other adapters
+            :param gatt_profile: the JSON or YAML file of the GATT profile (the built-in profile by default)
+            :param upstream: the endpoint of the central store the slot states are replicated to (http://... or
+            unix:<socket path>); None: no replication
+            :param backup_interval: the minutes between two online snapshots of the database; None: no snapshots
+            :param storage: the storage engine of the locker state (see boxee.persistence.STORAGE_ENGINES)
+            :param token_key: the key file of the locker; if set, the parcel characteristics only accept signed tokens
+            (see boxee.tokens)
+            :param config_file: the JSON configuration file, reloaded on SIGHUP (see boxee.config); None: the defaults
+            :param latency_probe: publish the diagnostics service with the latency probe (see boxee.latency)
+            :param throughput_test: publish the throughput test service (see boxee.throughput_service)
+            :type profile: boxee.utils.StartupProfile
+        """
+        self.profile = profile if profile is not None else boxee.utils.StartupProfile()
+        self.profiling = profile is not None
+        self.system_metrics = system_metrics
+        self.latency_probe = latency_probe
+        self.throughput_test = throughput_test
+        self.throughput_service = None
+        self.config_file = config_file
+        if config_file is not None:
+            self.config = boxee.config.load_config(config_file)
+        else:
+            self.config = boxee.config.default_config()
+            self.config['session_spread'] = session_spread
+        if log_level is None:
+            log_level = getattr(logging, self.config['log_level'])
+        else:
+            self.config['log_level'] = logging.getLevelName(log_level)
+        self.session_spread = self.config['session_spread']
+        self.reloader = None
+        # the asynchronous startup stages which complete after the main loop is started
+        self.pending_stages = set()
 
         self.setup_logging(current_folder, log_level)
-        # GPIO configuration
-        out_chs = [17, 18]
-        self.box_dao = boxee.persistence.BoxDao(range(17, 19), current_folder)
-
-        self.gpio = GpioConnector(out_channels=out_chs)
+        self.startup_stage('logging')
+        # the services, characteristics and descriptors are validated and resolved once
+        self.schema = GattSchema.load(gatt_profile) if gatt_profile is not None else GattSchema()
+        self.startup_stage('gatt schema')
+        # the schema and the slots are initialized in the background, once the server is advertising
+        self.box_dao = boxee.persistence.create_dao(storage, list(self.config['slots']), current_folder,
+                                                    deferred_init=True)
+        # slot allocation policy of this deployment: lowest, wear, lru or nearest
+        self.allocator = boxee.allocation.create_allocator(self.config['allocation'])
+        self.startup_stage('database connection')
+
+        self.gpio = GpioConnector(out_channels=list(self.config['out_channels']), **self.config['gpio'])
+        self.startup_stage('gpio')
+
+        # the DAO and GPIO work of the characteristics is executed on worker threads
+        boxee.executor.init_threads()
+        self.executor = MainLoopExecutor(workers=4, max_pending=64)
 
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
         self.bus = dbus.SystemBus()
-
-        self.gatt_adapter = self.find_adapter_for_interface(self.bus, boxee.core.GATT_MGR_IFACE)
-        self.advertising_adapter = self.find_adapter_for_interface(self.bus, boxee.core.LE_ADVERTISING_MANAGER_IFACE)
-        if self.gatt_adapter != self.advertising_adapter:
-            err = ' the gatt adapter and the advertising adapters are not the same. Exiting application...'
-            print(err)
-            logger.error(err)
-            sys.exit(-1)
-
-        self.gatt_manager = dbus.Interface(
-            self.bus.get_object(boxee.core.BLUEZ_SERVICE_NAME, self.gatt_adapter),
-            boxee.core.GATT_MGR_IFACE)
-
-        self.advertising_manager = dbus.Interface(
-            self.bus.get_object(boxee.core.BLUEZ_SERVICE_NAME, self.gatt_adapter),
-            boxee.core.LE_ADVERTISING_MANAGER_IFACE)
-
-        self.hci0_props_manager = dbus.Interface(
-            self.bus.get_object(boxee.core.BLUEZ_SERVICE_NAME, self.gatt_adapter),
-            boxee.core.DBUS_PROP_IFACE)
+        self.startup_stage('dbus connection')
+
+        # one ObjectManager query for every adapter lookup, one proxy object per adapter
+        self.adapters = AdapterRegistry(self.bus)
+        self.adapter_paths = self.find_adapters(self.adapters)
+        # adapter path -> AdapterBinding; the GATT application and an advertisement are registered on every adapter
+        self.bindings = dict()
+        self.advertisement_count = 0
+        # the live locker state published by every advertisement
+        self.payload = AdvertisementPayload(company_id=self.config['company_id'], locker_id=self.config['locker_id'])
+        self.shipper = None
+        # the optional features (and their dependencies, eg. urllib2 of the replication) are only imported when enabled
+        if upstream is not None:
+            from boxee.replication import OutboxShipper, create_transport
+            self.shipper = OutboxShipper(self.box_dao, self.payload.locker_id, create_transport(upstream))
+        self.guard = None
+        if token_key is not None:
+            from boxee.tokens import WriteGuard, TokenVerifier, load_key
+            self.guard = WriteGuard(TokenVerifier(load_key(token_key)))
+        self.snapshots = None
+        if backup_interval is not None and storage != 'sqlite':
+            logger.warn('the online snapshots are only supported by the sqlite storage engine')
+        elif backup_interval is not None:
+            from boxee.backup import SnapshotScheduler
+            self.snapshots = SnapshotScheduler(self.box_dao.path, os.path.join(current_folder, 'backups'),
+                                               interval=backup_interval * 60.0)
 
         # GATT service storage array
         self.services = []
-
-        # Initialize bluetooth advertisement
-        self.advertisement = BoxAdvertisement(self.bus, '0')
+        self.box_service = None
+        self.startup_stage('adapter discovery')
 
     def start_server(self):
         """
@@ -75,17 +141,6 @@ class BoxeeServer:
         global mainloop
         mainloop = gobject.MainLoop()
 
-        if self.hci0_props_manager.Get(boxee.core.ADAPTER_IFACE, 'Powered') == dbus.Boolean(0):
-            msg = 'Powering on the adapter [%s]' % self.hci0_props_manager.Get(boxee.core.ADAPTER_IFACE, 'Name')
-            print(msg)
-            logger.info(msg)
-            self.hci0_props_manager.Set(boxee.core.ADAPTER_IFACE, 'Powered', dbus.Boolean(1))
-
-        print('Adapter properties')
-        print(boxee.utils.describe_dbus_dict(self.hci0_props_manager.GetAll(boxee.core.ADAPTER_IFACE).iteritems()))
-
-        # print self.hci_props_manager.GetAll('org.bluez.GattManager1')
-
         self.bus.add_signal_receiver(self.signal_receiver_callback,
                                      signal_name=None,
                                      dbus_interface=None,
@@ -97,51 +152,338 @@ class BoxeeServer:
                                      member_keyword='member',
                                      path_keyword='path')
         # Setup services
-        self.services.append(AutomationIOService(self.bus, 0, write_callback_func=self.ble_service_write_cb))
-        self.services.append(SystemService(self.bus, 1, write_callback_func=self.ble_service_write_cb))
-        self.services.append(BoxService(self.box_dao, self.gpio, self.bus, 2))
-
-        for srv in self.services:
-            logger.info('Registering BLE service [%s]' % srv.get_path())
-            self.gatt_manager.RegisterService(srv.get_path(), {},
-                                              reply_handler=self.service_registration_cb,
-                                              error_handler=self.service_registration_err_cb)
-
-        logger.info('Registering BLE advertisement [%s]' % self.advertisement.get_path())
-        self.advertisement.add_service_uuid('2A56')
-        self.advertising_manager.RegisterAdvertisement(self.advertisement.get_path(), {},
-                                                       reply_handler=self.adv_registration_cb,
-                                                       error_handler=self.adv_registration_err_cb)
+        self.services.append(AutomationIOService(self.bus, self.schema.service('automation_io'),
+                                                 write_callback_func=self.ble_service_write_cb))
+        if self.system_metrics:
+            from boxee.system_service import SystemService
+            self.services.append(SystemService(self.bus, self.schema.service('system'),
+                                               write_callback_func=self.ble_service_write_cb))
+        self.box_service = BoxService(self.box_dao, self.gpio, self.bus, self.schema.service('box'), self.executor,
+                                      self.allocator, deferred_warm_up=True, guard=self.guard,
+                                      slot_sizes=dict((int(slot_id), size) for slot_id, size
+                                                      in self.config['slot_sizes'].iteritems()))
+        self.services.append(self.box_service)
+        if self.latency_probe:
+            from boxee.diagnostics_service import DiagnosticsService
+            self.services.append(DiagnosticsService(self.bus, self.schema.service('diagnostics'), self.executor,
+                                                    self.box_dao))
+        if self.throughput_test:
+            from boxee.throughput_service import ThroughputService
+            self.throughput_service = ThroughputService(self.bus, self.schema.service('throughput'))
+            self.services.append(self.throughput_service)
+        try:
+            self.apply_notifications(dict(), self.config['notifications'])
+        except BaseException as e:
+            logger.error('the notification settings could not be applied: %s', str(e))
+        self.startup_stage('services created')
+        if self.config_file is not None:
+            self.watch_config()
+
+        # the advertisement and the services are registered first, the rest of the initialization follows in the
+        # background
+        self.pending_stages.add('advertisement registered')
+        for path in self.adapter_paths:
+            self.bind_adapter(path)
+        self.adapters.add_listener(self.adapter_changed_cb)
+
+        self.box_service.box_manager.add_listener(self.slot_changed_cb)
+        self.start_background_stage('database warm up', self.warm_up_database)
+        if self.system_metrics:
+            self.start_background_stage('system metrics init', SystemService.warm_up)
 
         mainloop.run()
 
+    def bind_adapter(self, path):
+        """
+        Powers on the adapter and registers the GATT services and the advertisements on it
+        """
+        binding = AdapterBinding(self.adapters, path, self.advertisement_cb)
+        for advertisement, weight in self.create_advertisements():
+            binding.add_advertisement(advertisement, weight)
+        self.bindings[path] = binding
+        binding.power_on()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Adapter properties: %s', boxee.utils.describe_dbus_dict(
+                binding.properties.GetAll(boxee.core.ADAPTER_IFACE).iteritems()))
+        logger.info('[%s] supports [%s] advertisement instances', binding.name,
+                    binding.advertisements.supported_instances)
+        binding.advertisements.start()
+        binding.register_services(self.services,
+                                  reply_handler=self.service_registration_cb,
+                                  error_handler=lambda error: self.service_registration_err_cb(binding, error))
+
+    def unbind_adapter(self, path, adapter_present=True):
+        """
+        Removes the advertisement and the GATT services from the adapter
+        :param adapter_present: False if the adapter is already gone (nothing to unregister)
+        """
+        binding = self.bindings.pop(path, None)
+        if binding is None:
+            return
+        binding.advertisements.stop(unregister=adapter_present)
+        if adapter_present:
+            binding.unregister_services(self.services)
+        for advertisement in binding.advertisements.advertisements():
+            advertisement.remove_from_connection()
+        self.report_sessions()
+
+    def new_advertisement(self, advertising_type, payload=None):
+        advertisement = BoxAdvertisement(self.bus, self.advertisement_count, payload, advertising_type)
+        self.advertisement_count += 1
+        return advertisement
+
+    def create_advertisements(self):
+        """
+        The advertisement instances of an adapter:
+            * the connectable advertisement of the GATT application with the locker state and the 16 bit UUIDs
+            * a beacon with the locker state: the most important data, broadcast most often
+            * a beacon for every 128 bit service UUID (only one of them fits into an advertisement)
+        :return: (advertisement, weight) tuples, the weight sets how often a beacon is on the air when the instances
+        of the controller are rotated
+        """
+        advertisements = []
+        intervals = self.config['advertising_intervals']
+        connectable = self.new_advertisement('peripheral', self.payload)
+        connectable.add_service_uuid('2A56')
+        connectable.add_service_uuid(self.schema.service('automation_io').uuid)
+        connectable.set_interval(*intervals['connectable'])
+        advertisements.append((connectable, 1))
+
+        state_beacon = self.new_advertisement('broadcast', self.payload)
+        state_beacon.set_interval(*intervals['state_beacon'])
+        advertisements.append((state_beacon, 3))
+
+        for service in self.services:
+            if len(service.uuid) > 4:
+                service_beacon = self.new_advertisement('broadcast')
+                service_beacon.add_service_uuid(service.uuid)
+                service_beacon.set_interval(*intervals['service_beacon'])
+                advertisements.append((service_beacon, 1))
+        return advertisements
+
+    @staticmethod
+    def advertisement_kind(advertisement):
+        """
+        :return: the key of the advertisement in the advertising_intervals setting
+        """
+        if advertisement.ad_type == 'peripheral':
+            return 'connectable'
+        return 'state_beacon' if advertisement.payload is not None else 'service_beacon'
+
+    def watch_config(self):
+        """
+        Reloads the configuration file on SIGHUP and on the D-Bus Reload call; the changed settings are applied in
+        place
+        """
+        self.reloader = boxee.config.ConfigReloader(self.config_file, self.config, {
+            'out_channels': lambda old, new: self.gpio.set_out_channels(new),
+            'gpio': self.tune_gpio,
+            'locker_id': lambda old, new: self.update_payload(locker_id=new),
+            'company_id': lambda old, new: self.update_payload(company_id=new),
+            'log_level': lambda old, new: self.set_log_level(getattr(logging, new)),
+            'session_spread': self.set_session_spread,
+            'advertising_intervals': self.apply_advertising_intervals,
+            'notifications': self.apply_notifications
+        })
+        boxee.config.ConfigObject(self.bus, self.reloader)
+        # the python handler runs on the main thread between two bytecodes, the reload itself is left to the main loop
+        signal.signal(signal.SIGHUP, lambda signum, frame: gobject.idle_add(self.reloader.reload_cb))
+        logger.info('Reloading [%s] on SIGHUP or on [%s].Reload', self.config_file, boxee.config.CONFIG_IFACE)
+
+    def update_payload(self, **state):
+        if 'locker_id' in state and self.shipper is not None:
+            self.shipper.locker_id = state['locker_id']
+        if self.payload.update(**state):
+            for binding in self.bindings.itervalues():
+                binding.advertisements.refresh()
+
+    @staticmethod
+    def set_log_level(log_level):
+        logging.root.setLevel(log_level)
+        for handler in logging.root.handlers:
+            handler.setLevel(log_level)
+
+    def tune_gpio(self, old, new):
+        """
+        The new pulse timing and power budget apply from the next opened slot
+        """
+        for name, value in new.iteritems():
+            setattr(self.gpio, name, value)
+
+    def set_session_spread(self, old, new):
+        self.session_spread = new
+        self.balance_advertisements()
+
+    def apply_advertising_intervals(self, old, new):
+        """
+        Sets the new advertising intervals and re-registers the advertisements on the air
+        """
+        for binding in self.bindings.itervalues():
+            for advertisement in binding.advertisements.advertisements():
+                advertisement.set_interval(*new[self.advertisement_kind(advertisement)])
+            binding.advertisements.reconfigure()
+
+    def apply_notifications(self, old, new):
+        """
+        Retunes the notification policy of the characteristics whose settings changed; a characteristic removed from
+        the settings keeps its last policy
+        """
+        for name, settings in new.iteritems():
+            if old.get(name) == settings:
+                continue
+            characteristics = [service.named_characteristics[name] for service in self.services
+                               if name in service.named_characteristics]
+            if not characteristics or not hasattr(characteristics[0], 'retune'):
+                logger.warn('[%s] is not a notifying characteristic of the running services', name)
+                continue
+            characteristics[0].retune(**settings)
+
+    def warm_up_database(self):
+        """
+        Background startup stage: prepares the database and publishes the initial slot counts
+        """
+        self.box_service.box_manager.warm_up()
+        self.slot_changed_cb(None, None)
+        if self.shipper is not None:
+            self.shipper.start()
+        if self.snapshots is not None:
+            self.snapshots.start()
+
+    def slot_changed_cb(self, slot_id, used):
+        """
+        Called on a worker thread when a parcel is stored or released
+        """
+        gobject.idle_add(self.locker_state_changed)
+
+    def locker_state_changed(self):
+        """
+        Updates the advertisement payload on the main loop; the counts are taken here, from the occupancy map, so
+        the latest state is advertised even if the callbacks of several changes run out of order. The advertisements
+        are only refreshed if the encoded bytes have changed
+        """
+        free, total = self.box_service.box_manager.slot_counts()
+        if self.payload.update(free_slots=free, total_slots=total):
+            logger.debug('advertising [%s] free slots of [%s]', free, total)
+            for binding in self.bindings.itervalues():
+                binding.advertisements.refresh()
+        return False
+
+    def adapter_changed_cb(self, path, added, removed):
+        """
+        Called by the adapter registry when an adapter (eg. a second USB dongle) is plugged in or removed
+        """
+        if removed and path in self.bindings:
+            logger.info('Adapter [%s] is gone', path)
+            self.unbind_adapter(path, adapter_present=False)
+        elif added and path not in self.bindings and path in self.adapters.find_all(boxee.core.GATT_MGR_IFACE) \
+                and path in self.adapters.find_all(boxee.core.LE_ADVERTISING_MANAGER_IFACE):
+            logger.info('Adapter [%s] is added', path)
+            self.bind_adapter(path)
+
+    def device_connection_changed(self, device_path, connected):
+        """
+        Tracks the connected centrals per adapter and spreads the new connections: an adapter with more sessions than
+        the least loaded one stops advertising until the load is balanced again
+        """
+        if boxee.recorder.recorder is not None:
+            boxee.recorder.recorder.record(boxee.recorder.EVENT_CONNECTED if connected
+                                           else boxee.recorder.EVENT_DISCONNECTED, device_path)
+        for binding in self.bindings.itervalues():
+            if binding.owns(device_path):
+                binding.device_connection_changed(device_path, connected)
+        self.report_sessions()
+        self.balance_advertisements()
+
+    def balance_advertisements(self):
+        if len(self.bindings) < 2:
+            return
+        least = min(len(binding.sessions) for binding in self.bindings.itervalues())
+        for binding in self.bindings.itervalues():
+            overloaded = len(binding.sessions) > least + self.session_spread
+            if overloaded and binding.connectable.wanted:
+                logger.info('Pausing advertisement on [%s] with [%s] sessions', binding.name, len(binding.sessions))
+                binding.connectable.stop()
+            elif not overloaded and not binding.connectable.wanted:
+                logger.info('Resuming advertisement on [%s] with [%s] sessions', binding.name, len(binding.sessions))
+                binding.connectable.start()
+
+    def session_counts(self):
+        """
+        :return: adapter name -> number of connected centrals
+        """
+        return dict((binding.name, len(binding.sessions)) for binding in self.bindings.itervalues())
+
+    def report_sessions(self):
+        logger.info('Connected centrals per adapter: %s', self.session_counts())
+
+    def start_background_stage(self, stage, func):
+        """
+        Executes a startup stage on the executor, so it does not delay the advertisement
+        """
+        started = time.time()
+        self.pending_stages.add(stage)
+        self.executor.submit(func, callback=lambda result: self.startup_stage(stage, started),
+                             errback=lambda error: self.startup_stage(stage + ' (failed)', started, stage))
+
+    def startup_stage(self, stage, since=None, pending_stage=None):
+        """
+        Records the completion of a startup stage; in profile mode the stages are reported once the asynchronous ones
+        are completed
+        """
+        duration = self.profile.mark(stage, since)
+        if not self.profiling:
+            return
+        logger.info('Startup stage [%s] completed in [%.1f] ms', stage, duration)
+        pending_stage = pending_stage if pending_stage is not None else stage
+        if pending_stage in self.pending_stages:
+            self.pending_stages.remove(pending_stage)
+            if not self.pending_stages:
+                print('Startup profile:\n' + self.profile.report())
+
     def stop_server(self):
         """
         Lifecycle method: the last to be called upon exit
         """
-
-        # todo: unregister advertsiement is not working
         exit_msg = 'Gracefully exiting boxee...'
         print(exit_msg)
         logger.info(exit_msg)
 
+        # the advertisements go first: the centrals should not connect to a server which is shutting down, and the
+        # unregistration must not wait behind the pending deferred operations
+        logger.info('Unregistering advertisements...')
+        for binding in self.bindings.values():
+            try:
+                binding.advertisements.stop()
+            except BaseException as e:
+                logger.error('Uncategorized exception caught while unregistering the advertisements from [%s]: %s' % (
+                    binding.name, str(e)))
+
+        logger.debug('Waiting for the pending deferred operations')
+        self.executor.shutdown()
+        if self.box_service is not None:
+            logger.info(self.box_service.box_manager.barcodes.describe())
+        if self.guard is not None:
+            logger.info(self.guard.describe())
+        if self.throughput_service is not None:
+            logger.info(self.throughput_service.describe())
+
         logger.debug('Cleanup on GPIO')
         self.gpio.cleanup()
 
-        logger.info('Unregistering advertisement...')
-        try:
-            logger.debug('Unregistering service adverstisement with path [%s]', self.advertisement.get_path())
-            self.advertising_manager.UnregisterAdvertisement(self.advertisement.get_path())
-            self.advertisement.Release()
-        except (DBusException, DoesNotExistException, InvalidArgsException) as e:
-            logger.error('Could not cleanly unregister advertisement: %s' % str(e))
-        except BaseException as e:
-            logger.error('Uncategorized exception caught while unregistering advertisment: %s' % str(e))
-        for srv in self.services:
-            logger.info('Unregistering service: %s' % srv.get_path())
-            self.gatt_manager.UnregisterService(srv.get_path())
+        logger.info('Unregistering services...')
+        for binding in self.bindings.values():
+            try:
+                binding.unregister_services(self.services)
+            except BaseException as e:
+                logger.error('Uncategorized exception caught while unregistering from [%s]: %s' % (binding.name,
+                                                                                                   str(e)))
+        if self.shipper is not None:
+            self.shipper.stop()
+        if self.snapshots is not None:
+            self.snapshots.stop()
         if self.box_dao:
             self.box_dao.destroy()
+        boxee.recorder.stop_recording()
 
         logger.info('Boxee server is terminated...')
 
@@ -152,25 +494,35 @@ class BoxeeServer:
         """
         logger.debug('A GATT service got registered')
 
-    def service_registration_err_cb(self, error):
+    def service_registration_err_cb(self, binding, error):
         """
         Callback method called by DBus, once the original method call was executed with an error
+            :param binding: the adapter on which the registration failed
             :param error: a DBusException
         """
-        err_msg = 'Exiting. Failed to register service: ' + str(error)
+        err_msg = 'Failed to register service on [%s]: %s' % (binding.path, str(error))
         print(err_msg)
         logger.error(err_msg)
-        mainloop.quit()
+        self.unbind_adapter(binding.path)
+        if not self.bindings:
+            logger.error('Exiting. The services could not be registered on any adapter')
+            mainloop.quit()
 
-    @staticmethod
-    def adv_registration_cb():
-        logger.debug('Advertisement registered')
-
-    @staticmethod
-    def adv_registration_err_cb(error):
-        err_msg = 'Failed to register advertisement: ' + str(error)
-        print(err_msg)
-        logger.error(err_msg)
+    def advertisement_cb(self, lifecycle, error):
+        """
+        Called by the advertisement lifecycle after each registration attempt
+            :param lifecycle: the advertisement lifecycle of an adapter
+            :param error: None if the advertisement got registered, otherwise the DBusException
+            :type lifecycle: boxee.advertisement.AdvertisementLifecycle
+        """
+        if error is None:
+            logger.debug('Advertisement registered on [%s]', lifecycle.name)
+            if 'advertisement registered' in self.pending_stages:
+                self.startup_stage('advertisement registered', STARTED)
+        elif lifecycle.failures == 1:
+            err_msg = 'Failed to register advertisement on [%s]: %s' % (lifecycle.name, str(error))
+            print(err_msg)
+            logger.error(err_msg)
 
     def ble_service_write_cb(self, signal_dictionary):
         """
@@ -189,8 +541,7 @@ class BoxeeServer:
             print('Unexpected error: ', sys.exc_info()[0], str(e))
             logger.error('Error while handling bluetooth low energy callback')
 
-    @staticmethod
-    def signal_receiver_callback(*args, **kwargs):
+    def signal_receiver_callback(self, *args, **kwargs):
         """
         Callback method registered for signals to be received on DBus
         :param args:
@@ -238,27 +589,29 @@ class BoxeeServer:
         # Signal processing
         if signal[stypes.KEY_SIG_TYPE] is stypes.SIG_TYPE_BLUE_DEVICE and stypes.KEY_SIG_VALUE in signal:
             if stypes.TEST_CONNECTED in signal[stypes.KEY_SIG_VALUE]:
-                if not signal[stypes.KEY_SIG_VALUE][stypes.TEST_CONNECTED]:
-                    logger.info('Need to reconnect')
-                else:
-                    logger.info('no need to reconnect')
+                connected = bool(signal[stypes.KEY_SIG_VALUE][stypes.TEST_CONNECTED])
+                logger.info('Device [%s] %s', kwargs.get('path'), 'connected' if connected else 'disconnected')
+                if kwargs.get('path') is not None:
+                    self.device_connection_changed(kwargs['path'], connected)
 
     @staticmethod
-    def find_adapter_for_interface(bus, iface_name):
+    def find_adapters(adapters):
         """
-        Returns the first bluetooth adapter which has a org.bluez.GattManager1 interface on it
-            :param bus: the dbus handler instance
-            :return: the bluetooth adapter
+        Returns every bluetooth adapter which has both an org.bluez.GattManager1 and an
+        org.bluez.LEAdvertisingManager1 interface on it
+            :param adapters: the adapter registry
+            :type adapters: AdapterRegistry
+            :return: the adapter paths
         """
-        remote_om = dbus.Interface(bus.get_object(boxee.core.BLUEZ_SERVICE_NAME, '/'),
-                                   boxee.core.DBUS_OM_IFACE)
-        objects = remote_om.GetManagedObjects()
-
-        for o, props in objects.iteritems():
-            if props.has_key(iface_name):
-                return o
-
-        err_msg = 'Adapter for interface [%s] not found. Exiting application...' % iface_name
+        gatt_adapters = adapters.find_all(boxee.core.GATT_MGR_IFACE)
+        advertising_adapters = adapters.find_all(boxee.core.LE_ADVERTISING_MANAGER_IFACE)
+        for path in set(gatt_adapters).symmetric_difference(advertising_adapters):
+            logger.warn('Adapter [%s] does not support both GATT and LE advertising, it is not used', path)
+        paths = [path for path in gatt_adapters if path in advertising_adapters]
+        if paths:
+            return paths
+
+        err_msg = 'No adapter supporting GATT and LE advertising found. Exiting application...'
         print(err_msg)
         logger.error(err_msg)
         sys.exit(-1)
@@ -299,23 +652,75 @@ def usage():
     print ('Usage:')
     print ('\t -h --help \t list all command line options')
     print ('\t -d --debug \t switches on the debug mode (more details in the syslog)')
+    print ('\t -p --profile \t reports the duration of the startup stages')
+    print ('\t -n --no-metrics \t does not publish the system (memory, cpu) service')
+    print ('\t -g --gatt-profile <file> \t loads the GATT profile from a JSON or YAML file')
+    print ('\t -r --record <file> \t records the incoming GATT traffic for an offline replay (python -m boxee.replay)')
+    print ('\t -u --upstream <endpoint> \t replicates the slot states to a central store (http://... or unix:<path>)')
+    print ('\t -b --backup-interval <minutes> \t takes online snapshots of the database into the backups folder '
+           '(restore: python -m boxee.backup -r <snapshot> <folder>)')
+    print ('\t -s --storage <engine> \t the storage engine of the locker state: sqlite (default) or slotfile')
+    print ('\t -k --token-key <file> \t only signed parcel tokens are accepted (python -m boxee.tokens issues them)')
+    print ('\t -c --config <file> \t the JSON configuration, reloaded on SIGHUP (see boxee/config.py)')
+    print ('\t -l --latency-probe \t publishes the latency probe characteristic (aggregation: python -m boxee.latency)')
+    print ('\t -t --throughput-test \t publishes the throughput test service (notification stream, write sink)')
 
 
 def main(argv):
     boxee_server = None
-    log_level = logging.INFO
+    # None: the log level of the configuration
+    log_level = None
+    profile = None
+    system_metrics = True
+    gatt_profile = None
+    upstream = None
+    backup_interval = None
+    storage = 'sqlite'
+    token_key = None
+    config_file = None
+    latency_probe = False
+    throughput_test = False
     try:
         current_folder = os.path.dirname(os.path.realpath(sys.argv[0]))
         # more details on getopts: http://www.diveintopython.net/scripts_and_streams/command_line_arguments.html
-        opts, args = getopt.getopt(argv, "hd", ["help", "debug"])
+        opts, args = getopt.getopt(argv, "hdpng:r:u:b:s:k:c:lt", ["help", "debug", "profile", "no-metrics",
+                                                                   "gatt-profile=", "record=", "upstream=",
+                                                                   "backup-interval=", "storage=", "token-key=",
+                                                                   "config=", "latency-probe", "throughput-test"])
         for opt, arg in opts:
             if opt in ("-h", "--help"):
                 usage()
                 sys.exit()
-            elif opt == '-d':
+            elif opt in ('-d', '--debug'):
                 print ('\t :: activating debug mode')
                 log_level = logging.DEBUG
-        boxee_server = BoxeeServer(current_folder, log_level)
+            elif opt in ('-p', '--profile'):
+                profile = boxee.utils.StartupProfile(STARTED)
+                profile.mark('imports', STARTED)
+            elif opt in ('-n', '--no-metrics'):
+                system_metrics = False
+            elif opt in ('-g', '--gatt-profile'):
+                gatt_profile = arg
+            elif opt in ('-r', '--record'):
+                boxee.recorder.start_recording(arg)
+            elif opt in ('-u', '--upstream'):
+                upstream = arg
+            elif opt in ('-b', '--backup-interval'):
+                backup_interval = float(arg)
+            elif opt in ('-s', '--storage'):
+                storage = arg
+            elif opt in ('-k', '--token-key'):
+                token_key = arg
+            elif opt in ('-c', '--config'):
+                config_file = arg
+            elif opt in ('-l', '--latency-probe'):
+                latency_probe = True
+            elif opt in ('-t', '--throughput-test'):
+                throughput_test = True
+        boxee_server = BoxeeServer(current_folder, log_level, profile, system_metrics, gatt_profile=gatt_profile,
+                                   upstream=upstream, backup_interval=backup_interval,
+                                   storage=storage, token_key=token_key, config_file=config_file,
+                                   latency_probe=latency_probe, throughput_test=throughput_test)
         boxee_server.start_server()
     except getopt.GetoptError:
         usage()
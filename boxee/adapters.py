@@ -0,0 +1,187 @@
+import logging
+import dbus
+from advertisement import AdvertisementScheduler
+from core import BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE, ADAPTER_IFACE, GATT_MGR_IFACE, \
+    LE_ADVERTISING_MANAGER_IFACE
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+# only the objects exposing one of these interfaces are indexed (the devices make up most of the bluez object tree)
+ADAPTER_INTERFACES = (ADAPTER_IFACE, GATT_MGR_IFACE, LE_ADVERTISING_MANAGER_IFACE)
+
+
+class AdapterRegistry:
+    """
+    Discovers the bluetooth adapters with a single GetManagedObjects call, indexes them by interface and keeps one
+    proxy object per adapter. Adapters added or removed later are followed through the ObjectManager signals instead
+    of re-scanning the object tree.
+    """
+
+    def __init__(self, bus):
+        """
+        :param bus: the dbus connection
+        """
+        self.bus = bus
+        # adapter path -> set of interface names
+        self.adapters = dict()
+        self.proxies = dict()
+        self.listeners = []
+        object_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/'), DBUS_OM_IFACE)
+        # subscribe first, so an adapter appearing during the scan is not missed
+        object_manager.connect_to_signal('InterfacesAdded', self.interfaces_added_cb)
+        object_manager.connect_to_signal('InterfacesRemoved', self.interfaces_removed_cb)
+        for path, interfaces in object_manager.GetManagedObjects().iteritems():
+            self._index(path, interfaces.keys())
+        logger.info('Bluetooth adapters found: %s', self.describe())
+
+    def _index(self, path, interfaces):
+        relevant = [iface for iface in interfaces if iface in ADAPTER_INTERFACES]
+        if relevant:
+            self.adapters.setdefault(path, set()).update(relevant)
+        return relevant
+
+    def describe(self):
+        return ', '.join('%s %s' % (path, sorted(ifaces)) for path, ifaces in sorted(self.adapters.iteritems()))
+
+    def find(self, iface_name):
+        """
+        :return: the path of the first adapter (by path) exposing the interface, or None
+        """
+        adapters = self.find_all(iface_name)
+        return adapters[0] if adapters else None
+
+    def find_all(self, iface_name):
+        """
+        :return: the sorted paths of the adapters exposing the interface
+        """
+        return sorted(path for path, ifaces in self.adapters.iteritems() if iface_name in ifaces)
+
+    def get_proxy(self, path):
+        """
+        :return: the (cached) proxy object of the adapter
+        """
+        proxy = self.proxies.get(path)
+        if proxy is None:
+            proxy = self.bus.get_object(BLUEZ_SERVICE_NAME, path)
+            self.proxies[path] = proxy
+        return proxy
+
+    def get_interface(self, path, iface_name):
+        """
+        :return: a dbus interface of the adapter, based on the cached proxy object
+        """
+        return dbus.Interface(self.get_proxy(path), iface_name)
+
+    def add_listener(self, listener):
+        """
+        :param listener: called with (path, added interfaces, removed interfaces) when an adapter changes
+        """
+        self.listeners.append(listener)
+
+    def interfaces_added_cb(self, path, interfaces):
+        added = self._index(path, interfaces.keys())
+        if added:
+            logger.info('Adapter interfaces added on [%s]: %s', path, added)
+            self._notify(path, added, [])
+
+    def interfaces_removed_cb(self, path, interfaces):
+        if path not in self.adapters:
+            return
+        removed = [iface for iface in interfaces if iface in self.adapters[path]]
+        self.adapters[path].difference_update(removed)
+        if not self.adapters[path]:
+            del self.adapters[path]
+            self.proxies.pop(path, None)
+        if removed:
+            logger.info('Adapter interfaces removed from [%s]: %s', path, removed)
+            self._notify(path, [], removed)
+
+    def _notify(self, path, added, removed):
+        for listener in self.listeners:
+            try:
+                listener(path, added, removed)
+            except BaseException as e:
+                logger.error('Adapter listener failed: %s', str(e))
+
+
+class AdapterBinding:
+    """
+    The GATT application and the advertisement registered on one bluetooth adapter (HCI controller), together with the
+    centrals connected through it
+    """
+
+    def __init__(self, registry, path, advertisement_listener=None, rotation_interval=2000):
+        """
+        :param registry: the adapter registry (provides the cached proxy object)
+        :param path: the adapter path (eg. /org/bluez/hci0)
+        :param advertisement_listener: called with (lifecycle, error) after each advertisement registration attempt
+        :param rotation_interval: the time a rotating advertisement stays on the air in milliseconds
+        :type registry: AdapterRegistry
+        """
+        self.path = path
+        self.name = path.split('/')[-1]
+        self.gatt_manager = registry.get_interface(path, GATT_MGR_IFACE)
+        self.properties = registry.get_interface(path, DBUS_PROP_IFACE)
+        self.advertisements = AdvertisementScheduler(registry.get_interface(path, LE_ADVERTISING_MANAGER_IFACE),
+                                                     self.name, self.supported_advertisements(),
+                                                     advertisement_listener, rotation_interval)
+        # the lifecycle of the connectable advertisement (paused while the adapter has too many sessions)
+        self.connectable = None
+        # the device paths of the connected centrals
+        self.sessions = set()
+
+    def power_on(self):
+        if self.properties.Get(ADAPTER_IFACE, 'Powered') == dbus.Boolean(0):
+            logger.info('Powering on the adapter [%s]', self.properties.Get(ADAPTER_IFACE, 'Name'))
+            self.properties.Set(ADAPTER_IFACE, 'Powered', dbus.Boolean(1))
+
+    def supported_advertisements(self):
+        """
+        :return: the number of advertisements the controller can broadcast at the same time (1 on bluez versions
+        without the SupportedInstances property)
+        """
+        try:
+            return int(self.properties.Get(LE_ADVERTISING_MANAGER_IFACE, 'SupportedInstances'))
+        except dbus.exceptions.DBusException:
+            return 1
+
+    def add_advertisement(self, advertisement, weight=1):
+        """
+        Adds an advertisement instance; the connectable one is registered all the time, the beacons rotate if the
+        controller does not support enough instances
+        :type advertisement: boxee.advertisement.BoxAdvertisement
+        """
+        connectable = advertisement.ad_type == 'peripheral'
+        lifecycle = self.advertisements.add(advertisement, weight, pinned=connectable)
+        if connectable:
+            self.connectable = lifecycle
+        return lifecycle
+
+    def owns(self, device_path):
+        """
+        :return: True if the device object belongs to this adapter (eg. /org/bluez/hci0/dev_XX)
+        """
+        return device_path.startswith(self.path + '/')
+
+    def register_services(self, services, reply_handler, error_handler):
+        for srv in services:
+            logger.info('Registering BLE service [%s] on [%s]', srv.get_path(), self.name)
+            self.gatt_manager.RegisterService(srv.get_path(), {},
+                                              reply_handler=reply_handler,
+                                              error_handler=error_handler)
+
+    def unregister_services(self, services):
+        for srv in services:
+            logger.info('Unregistering service [%s] from [%s]', srv.get_path(), self.name)
+            try:
+                self.gatt_manager.UnregisterService(srv.get_path())
+            except dbus.exceptions.DBusException as e:
+                logger.error('Could not unregister service [%s] from [%s]: %s', srv.get_path(), self.name, str(e))
+
+    def device_connection_changed(self, device_path, connected):
+        if connected:
+            self.sessions.add(device_path)
+        else:
+            self.sessions.discard(device_path)
+            self.advertisements.device_disconnected()
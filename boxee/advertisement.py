@@ -1,15 +1,440 @@
 __author__ = 'tamas'
+import struct
+import time
+import logging
+import dbus
+import dbus.exceptions
+import gobject
 from boxee.core import Advertisement
 
+logger = logging.getLogger(__name__)
+
+# the maximum length of the legacy advertising data
+ADV_DATA_BUDGET = 31
+# the flags AD structure, added by bluez to every advertisement
+ADV_FLAGS_SIZE = 3
+ADV_TX_POWER_SIZE = 3
+
+
+class AdvertisementPayload:
+    """
+    Packs the live state of the locker into the manufacturer data of the advertisement, so a phone can choose a
+    locker without connecting to it:
+        byte 0: format version (high nibble) and state flags (low nibble)
+        byte 1-2: locker id (unsigned short, little endian)
+        byte 3-4: number of free slots (unsigned short, little endian)
+        byte 5-6: number of slots (unsigned short, little endian)
+    """
+    VERSION = 1
+    FORMAT = '<BHHH'
+    FLAG_OUT_OF_SERVICE = 0x01
+
+    def __init__(self, company_id=0xffff, locker_id=0):
+        """
+        :param company_id: the bluetooth SIG company identifier (0xffff: reserved for testing)
+        :param locker_id: the identifier of this locker
+        """
+        self.company_id = company_id
+        self.locker_id = locker_id
+        self.free_slots = 0
+        self.total_slots = 0
+        self.flags = 0
+
+    def update(self, **state):
+        """
+        Updates some of the state fields (locker_id, free_slots, total_slots, flags)
+        :return: True if the encoded bytes have changed
+        """
+        encoded = self.encode()
+        for name, value in state.iteritems():
+            if not hasattr(self, name):
+                raise ValueError('unknown advertisement payload field [%s]' % name)
+            setattr(self, name, value)
+        return self.encode() != encoded
+
+    def encode(self):
+        """
+        :return: the manufacturer data bytes
+        """
+        return [ord(c) for c in struct.pack(self.FORMAT, (self.VERSION << 4) | (self.flags & 0x0f),
+                                            self.locker_id & 0xffff, min(self.free_slots, 0xffff),
+                                            min(self.total_slots, 0xffff))]
+
 
 class BoxAdvertisement(Advertisement):
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, payload=None, advertising_type='peripheral'):
         """
         Is a standard bluetooth low energy advertisement
         :param bus: the dbus connection
         :param index: the index of the advertisement
+        :param payload: the state published in the manufacturer data (None: no manufacturer data)
+        :param advertising_type: peripheral (connectable) or broadcast (non-connectable beacon)
+        :type payload: AdvertisementPayload
         """
-        Advertisement.__init__(self, bus, index, 'peripheral')
-        self.add_manufacturer_data(0xffff, [0x00, 0x01, 0x02, 0x03, 0x04])
-        self.add_service_data('9999', [0x00, 0x01, 0x02, 0x03, 0x04])
+        Advertisement.__init__(self, bus, index, advertising_type)
+        self.payload = payload
         self.include_tx_power = True
+        self.apply_payload()
+
+    def apply_payload(self):
+        """
+        Copies the encoded payload into the advertisement properties (read by bluez on registration)
+        :return: True if the advertised bytes have changed
+        """
+        if self.payload is None:
+            return False
+        encoded = self.payload.encode()
+        if self.manufacturer_data is not None and self.manufacturer_data.get(self.payload.company_id) == encoded:
+            return False
+        self.manufacturer_data = None
+        self.add_manufacturer_data(self.payload.company_id, encoded)
+        self.check_size()
+        return True
+
+    def encoded_size(self):
+        """
+        :return: the size of the advertising data in bytes, as it will be sent over the air
+        """
+        size = ADV_FLAGS_SIZE
+        if self.service_uuids:
+            # one AD structure per UUID width: 2 bytes header + 2 (16 bit) or 16 (128 bit) bytes per uuid
+            short_uuids = len([uuid for uuid in self.service_uuids if len(uuid) <= 4])
+            long_uuids = len(self.service_uuids) - short_uuids
+            size += (2 + 2 * short_uuids if short_uuids else 0) + (2 + 16 * long_uuids if long_uuids else 0)
+        if self.manufacturer_data:
+            for data in self.manufacturer_data.itervalues():
+                size += 4 + len(data)
+        if self.service_data:
+            for uuid, data in self.service_data.iteritems():
+                size += 2 + (2 if len(uuid) <= 4 else 16) + len(data)
+        if self.include_tx_power:
+            size += ADV_TX_POWER_SIZE
+        return size
+
+    def check_size(self):
+        size = self.encoded_size()
+        if size > ADV_DATA_BUDGET:
+            raise ValueError('the advertisement [%s] needs %s bytes, only %s are available' % (
+                self.path, size, ADV_DATA_BUDGET))
+
+    def add_service_uuid(self, uuid):
+        Advertisement.add_service_uuid(self, uuid)
+        self.check_size()
+
+
+class AdvertisementLifecycle:
+    """
+    Keeps one advertisement registered on an adapter. bluez stops advertising when a central connects and after the
+    disconnect it may take several seconds until the advertisement is enabled again; therefore the advertisement is
+    re-registered as soon as the Device1 Connected property turns to False. A failed registration is retried with an
+    exponential backoff. The time between the trigger (start or disconnect) and the successful registration is kept as
+    the time-to-advertise metric.
+        UNREGISTERED -> PENDING -> REGISTERED
+                           |
+                           +-> FAILED -> (backoff) -> PENDING
+    """
+    UNREGISTERED = 'unregistered'
+    PENDING = 'pending'
+    REGISTERED = 'registered'
+    FAILED = 'failed'
+
+    def __init__(self, advertising_manager, advertisement, name, listener=None, refresh_interval=5000,
+                 retry_interval=250, max_retry_interval=30000):
+        """
+        :param advertising_manager: the org.bluez.LEAdvertisingManager1 interface of the adapter
+        :param advertisement: the advertisement object
+        :param name: the name of the adapter (used for logging)
+        :param listener: called with (lifecycle, error) on the main loop after each registration attempt (error is
+        None on success)
+        :param refresh_interval: the minimum time between two payload refreshes in milliseconds
+        :param retry_interval: the delay of the first retry in milliseconds, doubled on every failure
+        :param max_retry_interval: the maximum delay between two retries in milliseconds
+        :type advertisement: BoxAdvertisement
+        """
+        self.advertising_manager = advertising_manager
+        self.advertisement = advertisement
+        self.name = name
+        self.listener = listener
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.state = self.UNREGISTERED
+        # the advertisement should be registered (False while stopped or paused)
+        self.wanted = False
+        self.failures = 0
+        self.retry_source = None
+        self.refresh_source = None
+        self.last_registration = 0
+        # the time of the event which requires the advertisement (start, disconnect)
+        self.triggered = None
+        self.time_to_advertise = None
+        self.max_time_to_advertise = None
+        self.registrations = 0
+
+    def start(self):
+        """
+        Registers the advertisement unless it is already registered or pending
+        """
+        self.wanted = True
+        if self.state in (self.UNREGISTERED, self.FAILED):
+            self._cancel_retry()
+            self.triggered = time.time()
+            self._register()
+
+    def stop(self, unregister=True):
+        """
+        Unregisters the advertisement; the state is UNREGISTERED afterwards
+        :param unregister: False if the adapter is already gone (only the timers are removed)
+        """
+        self.wanted = False
+        self._cancel_retry()
+        if self.refresh_source is not None:
+            gobject.source_remove(self.refresh_source)
+            self.refresh_source = None
+        if self.state == self.REGISTERED and unregister:
+            self._unregister()
+        # a pending registration is unregistered once its reply arrives
+        if self.state != self.PENDING:
+            self.state = self.UNREGISTERED
+
+    def device_disconnected(self):
+        """
+        A central disconnected from the adapter: the advertisement is re-registered immediately, instead of waiting
+        for bluez to resume it
+        """
+        if not self.wanted:
+            return
+        self.triggered = time.time()
+        if self.state == self.REGISTERED:
+            self._reregister()
+        elif self.state == self.FAILED:
+            # skip the backoff, a disconnect frees up an advertising instance
+            self._cancel_retry()
+            self._register()
+
+    def refresh(self):
+        """
+        Publishes the current payload of the advertisement. bluez reads the advertising data on registration only,
+        therefore the advertisement is re-registered, at most once per refresh_interval; the changes arriving
+        meanwhile are coalesced into one re-registration.
+        """
+        if self.refresh_source is not None:
+            return
+        wait = self.last_registration + self.refresh_interval / 1000.0 - time.time()
+        if wait > 0:
+            self.refresh_source = gobject.timeout_add(int(wait * 1000), self.refresh_cb)
+        else:
+            self.refresh_cb()
+
+    def refresh_cb(self):
+        self.refresh_source = None
+        if not self.advertisement.apply_payload():
+            logger.debug('advertisement payload of [%s] is unchanged', self.name)
+        elif self.wanted and self.state == self.REGISTERED:
+            logger.debug('re-registering the advertisement of [%s] with the new payload', self.name)
+            self._reregister()
+        return False
+
+    def reconfigure(self):
+        """
+        Re-registers a registered advertisement, so bluez picks up its changed properties (eg. the interval)
+        """
+        if self.wanted and self.state == self.REGISTERED:
+            logger.debug('re-registering the advertisement of [%s] with the new properties', self.name)
+            self._reregister()
+
+    def _reregister(self):
+        self._unregister()
+        self._register()
+
+    def _register(self):
+        self.advertisement.apply_payload()
+        self.state = self.PENDING
+        self.last_registration = time.time()
+        logger.info('Registering BLE advertisement [%s] on [%s]', self.advertisement.get_path(), self.name)
+        self.advertising_manager.RegisterAdvertisement(self.advertisement.get_path(), {},
+                                                       reply_handler=self.registered_cb,
+                                                       error_handler=self.registration_failed_cb)
+
+    def _unregister(self):
+        logger.info('Unregistering BLE advertisement [%s] from [%s]', self.advertisement.get_path(), self.name)
+        self.state = self.UNREGISTERED
+        try:
+            self.advertising_manager.UnregisterAdvertisement(self.advertisement.get_path())
+        except dbus.exceptions.DBusException as e:
+            logger.error('Could not unregister advertisement from [%s]: %s', self.name, str(e))
+
+    def registered_cb(self):
+        self.state = self.REGISTERED
+        if not self.wanted:
+            # stopped while the registration was pending
+            self._unregister()
+            return
+        self.failures = 0
+        self.registrations += 1
+        if self.triggered is not None:
+            self.time_to_advertise = (time.time() - self.triggered) * 1000
+            if self.max_time_to_advertise is None or self.time_to_advertise > self.max_time_to_advertise:
+                self.max_time_to_advertise = self.time_to_advertise
+            self.triggered = None
+            logger.info('Advertising on [%s] after [%.1f] ms (max [%.1f] ms)', self.name, self.time_to_advertise,
+                        self.max_time_to_advertise)
+        self._notify(None)
+
+    def registration_failed_cb(self, error):
+        if isinstance(error, dbus.exceptions.DBusException) \
+                and error.get_dbus_name() == 'org.bluez.Error.AlreadyExists':
+            # the previous registration is still alive in bluez
+            self.registered_cb()
+            return
+        self.state = self.FAILED
+        self.failures += 1
+        if self.wanted:
+            delay = min(self.retry_interval * 2 ** (self.failures - 1), self.max_retry_interval)
+            logger.warn('Advertisement registration on [%s] failed [%s] times, retrying in [%s] ms: %s', self.name,
+                        self.failures, delay, str(error))
+            self._cancel_retry()
+            self.retry_source = gobject.timeout_add(delay, self.retry_cb)
+        self._notify(error)
+
+    def retry_cb(self):
+        self.retry_source = None
+        if self.wanted and self.state == self.FAILED:
+            self._register()
+        return False
+
+    def _cancel_retry(self):
+        if self.retry_source is not None:
+            gobject.source_remove(self.retry_source)
+            self.retry_source = None
+
+    def _notify(self, error):
+        if self.listener is not None:
+            try:
+                self.listener(self, error)
+            except BaseException as e:
+                logger.error('Advertisement listener failed: %s', str(e))
+
+
+class AdvertisementScheduler:
+    """
+    Manages the advertisement instances of one adapter. The pinned instances (the connectable advertisement of the GATT
+    application) are always registered. If the controller supports fewer instances than there are, the rest of them
+    (the beacons) take turns on the remaining instances: every rotation period the instances are chosen by a smooth
+    weighted round robin, so an instance with weight 3 is on the air three times as often as one with weight 1.
+    """
+
+    def __init__(self, advertising_manager, name, supported_instances=1, listener=None, rotation_interval=2000):
+        """
+        :param advertising_manager: the org.bluez.LEAdvertisingManager1 interface of the adapter
+        :param name: the name of the adapter (used for logging)
+        :param supported_instances: the number of advertisements the controller can broadcast at the same time
+        :param listener: passed to every AdvertisementLifecycle
+        :param rotation_interval: the time a rotating instance stays on the air in milliseconds
+        """
+        self.advertising_manager = advertising_manager
+        self.name = name
+        self.supported_instances = max(supported_instances, 1)
+        self.listener = listener
+        self.rotation_interval = rotation_interval
+        self.pinned = []
+        # [lifecycle, weight, current weight] entries of the smooth weighted round robin
+        self.rotating = []
+        self.rotation_source = None
+        self.started = False
+
+    def add(self, advertisement, weight=1, pinned=False):
+        """
+        :param advertisement: the advertisement instance
+        :param weight: the relative frequency of a rotating instance
+        :param pinned: the instance is registered all the time
+        :return: the lifecycle of the advertisement
+        :type advertisement: BoxAdvertisement
+        """
+        lifecycle = AdvertisementLifecycle(self.advertising_manager, advertisement, self.name, self.listener)
+        if pinned:
+            self.pinned.append(lifecycle)
+        else:
+            self.rotating.append([lifecycle, weight, 0])
+        return lifecycle
+
+    def lifecycles(self):
+        return self.pinned + [entry[0] for entry in self.rotating]
+
+    def advertisements(self):
+        return [lifecycle.advertisement for lifecycle in self.lifecycles()]
+
+    def free_instances(self):
+        """
+        :return: the number of instances left for the rotating advertisements
+        """
+        return max(self.supported_instances - len(self.pinned), 0)
+
+    def start(self):
+        self.started = True
+        for lifecycle in self.pinned:
+            lifecycle.start()
+        if len(self.rotating) <= self.free_instances():
+            for entry in self.rotating:
+                entry[0].start()
+        else:
+            logger.info('[%s] advertisements rotate on [%s] free instances of [%s]', len(self.rotating),
+                        self.free_instances(), self.name)
+            self.rotate_cb()
+            if self.free_instances() > 0:
+                self.rotation_source = gobject.timeout_add(self.rotation_interval, self.rotate_cb)
+
+    def stop(self, unregister=True):
+        self.started = False
+        if self.rotation_source is not None:
+            gobject.source_remove(self.rotation_source)
+            self.rotation_source = None
+        for lifecycle in self.lifecycles():
+            lifecycle.stop(unregister)
+
+    def rotate_cb(self):
+        chosen = self.next_rotation(self.free_instances())
+        # the instances leaving the air are unregistered first, so the controller has room for the new ones
+        for lifecycle, weight, current in self.rotating:
+            if lifecycle not in chosen and lifecycle.wanted:
+                lifecycle.stop()
+        for lifecycle in chosen:
+            lifecycle.start()
+        return self.started
+
+    def next_rotation(self, count):
+        """
+        :return: the lifecycles of the next count rotating instances (smooth weighted round robin)
+        """
+        chosen = []
+        total = sum(entry[1] for entry in self.rotating)
+        for _ in range(min(count, len(self.rotating))):
+            for entry in self.rotating:
+                entry[2] += entry[1]
+            best = max((entry for entry in self.rotating if entry[0] not in chosen), key=lambda entry: entry[2])
+            best[2] -= total
+            chosen.append(best[0])
+        return chosen
+
+    def reconfigure(self):
+        """
+        Publishes the changed properties of every instance on the air
+        """
+        for lifecycle in self.lifecycles():
+            lifecycle.reconfigure()
+
+    def refresh(self):
+        """
+        Publishes the current payload on every instance carrying it
+        """
+        for lifecycle in self.lifecycles():
+            if lifecycle.advertisement.payload is not None:
+                lifecycle.refresh()
+
+    def device_disconnected(self):
+        """
+        Only the connectable advertisements are stopped by bluez when a central connects
+        """
+        for lifecycle in self.lifecycles():
+            if lifecycle.advertisement.ad_type == 'peripheral':
+                lifecycle.device_disconnected()
@@ -0,0 +1,218 @@
+__author__ = 'tamas'
+"""
+Slot allocation policies. Every policy keeps the free slots in one heap per size class, ordered by its own key, so
+the store path selects a slot in O(log n). Entries which became stale (the slot was taken or re-keyed meanwhile) are
+skipped lazily when they reach the top of the heap.
+"""
+import heapq
+import logging
+import threading
+from exceptions import NotSupportedException
+
+logger = logging.getLogger(__name__)
+
+SIZE_SMALL = 0
+SIZE_MEDIUM = 1
+SIZE_LARGE = 2
+SIZE_CLASSES = (SIZE_SMALL, SIZE_MEDIUM, SIZE_LARGE)
+
+
+class Slot(object):
+    __slots__ = ('slot_id', 'size', 'usage_count', 'free', 'key')
+
+    def __init__(self, slot_id, size, usage_count, free):
+        self.slot_id = slot_id
+        self.size = size
+        self.usage_count = usage_count
+        self.free = free
+        self.key = None
+
+
+class SlotAllocator(object):
+    """
+    Base allocator: hands out the free slot with the smallest key from the smallest size class which fits the parcel.
+    """
+
+    def __init__(self):
+        self.slots = dict()
+        # size class -> heap of (key, slot_id)
+        self.free = dict()
+        self.lock = threading.Lock()
+
+    def slot_key(self, slot):
+        """
+        :return: the ordering key of a free slot; the slot with the smallest key is allocated first
+        :type slot: Slot
+        """
+        logger.warn('slot_key is not implemented by [%s]. Please override this method.', type(self).__name__)
+        raise NotSupportedException()
+
+    def rebuild(self, rows):
+        """
+        Rebuilds the free heaps from the locker table
+        :param rows: (slot_id, used, size, usage_count) rows as returned by BoxDao.fetch_slots
+        """
+        with self.lock:
+            self.slots = dict()
+            self.free = dict()
+            for slot_id, used, size, usage_count in rows:
+                slot = Slot(slot_id, size, usage_count, used != 'T')
+                self.slots[slot_id] = slot
+                if slot.free:
+                    self._push(slot)
+            for heap in self.free.itervalues():
+                heapq.heapify(heap)
+        logger.info('%s rebuilt with [%s] slots', type(self).__name__, len(self.slots))
+
+    def take(self, size=SIZE_SMALL):
+        """
+        Removes the best free slot from the free set
+        :param size: the size class of the parcel; larger slots are used if no slot of this size is free
+        :return: the slot_id or None if there is no free slot which is large enough
+        """
+        with self.lock:
+            for size_class in sorted(self.free.iterkeys()):
+                if size_class < size:
+                    continue
+                heap = self.free[size_class]
+                while heap:
+                    key, slot_id = heapq.heappop(heap)
+                    slot = self.slots.get(slot_id)
+                    if slot is None or not slot.free or slot.key != key:
+                        # stale entry
+                        continue
+                    slot.free = False
+                    slot.usage_count += 1
+                    self.taken(slot)
+                    return slot_id
+        return None
+
+    def take_slot(self, slot_id, size=SIZE_SMALL):
+        """
+        Removes a given slot from the free set (eg. the slot hint of a signed token)
+        :return: True if the slot was free and large enough for the parcel
+        """
+        with self.lock:
+            slot = self.slots.get(slot_id)
+            if slot is None or not slot.free or slot.size < size:
+                return False
+            # the heap entry of the slot becomes stale
+            slot.free = False
+            slot.usage_count += 1
+            self.taken(slot)
+            return True
+
+    def release(self, slot_id):
+        """
+        Returns a slot into the free set (the parcel was collected)
+        """
+        with self.lock:
+            slot = self.slots.get(slot_id)
+            if slot is None or slot.free:
+                return
+            slot.free = True
+            self.released(slot)
+            self._push(slot, heap_push=True)
+
+    def put_back(self, slot_id):
+        """
+        Undoes a take (eg. the slot could not be opened), without counting it as a usage; the database row is rolled
+        back by BoxDao.unclaim_slot
+        """
+        with self.lock:
+            slot = self.slots.get(slot_id)
+            if slot is None or slot.free:
+                return
+            slot.free = True
+            slot.usage_count -= 1
+            self._push(slot, heap_push=True)
+
+    def taken(self, slot):
+        """
+        Hook called when a slot is allocated
+        """
+        pass
+
+    def released(self, slot):
+        """
+        Hook called when a slot becomes free again
+        """
+        pass
+
+    def _push(self, slot, heap_push=False):
+        slot.key = self.slot_key(slot)
+        heap = self.free.setdefault(slot.size, [])
+        if heap_push:
+            heapq.heappush(heap, (slot.key, slot.slot_id))
+        else:
+            heap.append((slot.key, slot.slot_id))
+
+
+class LowestSlotAllocator(SlotAllocator):
+    """
+    Always allocates the lowest free slot id (the historical behaviour)
+    """
+
+    def slot_key(self, slot):
+        return slot.slot_id
+
+
+class WearLevellingAllocator(SlotAllocator):
+    """
+    Allocates the least used slot, so the latches wear out evenly
+    """
+
+    def slot_key(self, slot):
+        return slot.usage_count, slot.slot_id
+
+
+class LeastRecentlyUsedAllocator(SlotAllocator):
+    """
+    Allocates the slot which has been free for the longest time (a ring over the free slots)
+    """
+
+    def __init__(self):
+        SlotAllocator.__init__(self)
+        self.sequence = 0
+
+    def slot_key(self, slot):
+        return self.sequence, slot.slot_id
+
+    def released(self, slot):
+        self.sequence += 1
+
+
+class NearestToDoorAllocator(SlotAllocator):
+    """
+    Allocates the free slot closest to the door (or the easiest to reach), based on a distance map
+    """
+
+    def __init__(self, distances=None):
+        """
+        :param distances: slot_id -> distance; slots without a distance are ordered by their id behind the known ones
+        """
+        SlotAllocator.__init__(self)
+        self.distances = distances if distances is not None else dict()
+
+    def slot_key(self, slot):
+        distance = self.distances.get(slot.slot_id)
+        return (0, distance, slot.slot_id) if distance is not None else (1, slot.slot_id, slot.slot_id)
+
+
+ALLOCATORS = {
+    'lowest': LowestSlotAllocator,
+    'wear': WearLevellingAllocator,
+    'lru': LeastRecentlyUsedAllocator,
+    'nearest': NearestToDoorAllocator
+}
+
+
+def create_allocator(policy, **kwargs):
+    """
+    :param policy: one of the ALLOCATORS keys (lowest, wear, lru, nearest)
+    :param kwargs: passed to the allocator constructor (eg. distances for nearest)
+    :return: the allocator instance
+    """
+    if policy not in ALLOCATORS:
+        raise ValueError('unknown slot allocation policy [%s], choose one of %s' % (policy, sorted(ALLOCATORS)))
+    return ALLOCATORS[policy](**kwargs)
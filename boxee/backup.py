@@ -0,0 +1,281 @@
+"""
+Online snapshots of the locker database. The snapshots are taken on a background thread with its own connection, so
+neither the main loop nor the DAO connection waits for them:
+ - with the sqlite3 backup API (Python 3.7+) the database is copied in small page steps;
+ - otherwise, in the rollback journal mode the pages are copied in small steps, every step in its own short read
+   transaction (the writers are only blocked for the copy of one step); if the database changed in the meantime
+   (the file change counter of the header moved) the copy is restarted, as the backup API does;
+ - in the WAL mode the readers never block the writers, the database is copied in one read transaction (VACUUM INTO,
+   or a dump on older sqlite versions).
+Every snapshot is checked (integrity_check), gzip compressed and the oldest ones are rotated out.
+
+    python -m boxee.backup [-s] [-r <snapshot>] <database folder>
+"""
+import sys
+import os
+import getopt
+import gzip
+import shutil
+import sqlite3
+import threading
+import time
+import logging
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+# VACUUM INTO is supported from sqlite 3.27
+VACUUM_INTO_SUPPORTED = sqlite3.sqlite_version_info >= (3, 27, 0)
+SNAPSHOT_PREFIX = 'boxee-'
+SNAPSHOT_SUFFIX = '.db.gz'
+# the offset of the file change counter in the database header, incremented by every commit in rollback journal mode
+CHANGE_COUNTER_OFFSET = 24
+
+
+class SnapshotException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+class SnapshotScheduler:
+    def __init__(self, db_path, folder, interval=300.0, keep=12, pages_per_step=16, step_pause=0.01,
+                 max_restarts=5):
+        """
+        :param db_path: the database file
+        :param folder: the folder of the snapshots
+        :param interval: the seconds between two snapshots
+        :param keep: the number of snapshots kept
+        :param pages_per_step: the number of pages copied in one step (in one short read transaction)
+        :param step_pause: the seconds between two steps, when the writers can commit
+        :param max_restarts: after this many restarts (the database was changed during the copy) the snapshot fails
+        and is retried at the next interval; the copy is never made in one long read transaction, which would block
+        the writers
+        """
+        self.db_path = db_path
+        self.folder = folder
+        self.interval = interval
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+        self.max_restarts = max_restarts
+        self.stopped = threading.Event()
+        self.thread = None
+        self.snapshots = 0
+        self.restarts = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='boxee-backup')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('taking a snapshot of [%s] every [%s] s into [%s]', self.db_path, self.interval, self.folder)
+
+    def stop(self, timeout=5.0):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.snapshot()
+            except BaseException as e:
+                logger.error('could not take a snapshot of the database: %s', str(e))
+
+    def snapshot(self):
+        """
+        Takes a snapshot, compresses it and removes the oldest ones
+        :return: the file name of the snapshot
+        """
+        started = time.time()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        copy_path = os.path.join(self.folder, '.snapshot.db')
+        try:
+            self.copy(copy_path)
+            check_database(copy_path)
+            name = os.path.join(self.folder, '%s%s%s' % (SNAPSHOT_PREFIX, time.strftime('%Y%m%d-%H%M%S'),
+                                                         SNAPSHOT_SUFFIX))
+            compress(copy_path, name)
+        finally:
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+        self.snapshots += 1
+        logger.info('snapshot [%s] taken in [%.1f] ms ([%s] bytes)', name, (time.time() - started) * 1000,
+                    os.path.getsize(name))
+        for old in list_snapshots(self.folder)[:-self.keep]:
+            logger.debug('removing the old snapshot [%s]', old)
+            os.remove(old)
+        return name
+
+    def copy(self, copy_path):
+        source = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            if hasattr(source, 'backup'):
+                target = sqlite3.connect(copy_path)
+                try:
+                    source.backup(target, pages=self.pages_per_step, sleep=self.step_pause)
+                finally:
+                    target.close()
+            elif source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+                self.copy_wal(source, copy_path)
+            else:
+                self.copy_pages(source, copy_path)
+        finally:
+            source.close()
+
+    def copy_wal(self, source, copy_path):
+        if VACUUM_INTO_SUPPORTED:
+            source.execute('VACUUM INTO ?', [copy_path])
+            return
+        target = sqlite3.connect(copy_path)
+        try:
+            source.execute('BEGIN')
+            try:
+                target.executescript(';\n'.join(source.iterdump()))
+            finally:
+                source.execute('COMMIT')
+        finally:
+            target.close()
+
+    def copy_pages(self, source, copy_path):
+        page_size = source.execute('PRAGMA page_size').fetchone()[0]
+        with open(self.db_path, 'rb') as db_file:
+            for attempt in range(self.max_restarts + 1):
+                if self._copy_pages(source, db_file, copy_path, page_size, self.pages_per_step):
+                    return
+                self.restarts += 1
+                logger.debug('the database changed during the snapshot, restarting the copy')
+        logger.warn('the database changed during [%s] copy attempts, the snapshot is skipped until the next interval',
+                    self.max_restarts + 1)
+        raise SnapshotException('the database changed during every copy attempt')
+
+    def _copy_pages(self, source, db_file, copy_path, page_size, step):
+        """
+        :param step: the pages copied in one read transaction (None: all of them)
+        :return: False if the database was changed by a commit between the steps
+        """
+        counter = None
+        page = 0
+        with open(copy_path, 'wb') as copy_file:
+            while True:
+                source.execute('BEGIN')
+                try:
+                    # the shared lock is taken by the first read; no writer can commit until the end of the step
+                    source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                    page_count = source.execute('PRAGMA page_count').fetchone()[0]
+                    db_file.seek(CHANGE_COUNTER_OFFSET)
+                    current = db_file.read(4)
+                    if counter is None:
+                        counter = current
+                    elif current != counter:
+                        return False
+                    pages = page_count - page if step is None else min(step, page_count - page)
+                    db_file.seek(page * page_size)
+                    copy_file.write(db_file.read(pages * page_size))
+                    page += pages
+                finally:
+                    source.execute('COMMIT')
+                if page >= page_count:
+                    return True
+                if self.stopped.wait(self.step_pause):
+                    raise SnapshotException('stopped during the snapshot')
+
+
+def check_database(path):
+    """
+    :raise SnapshotException: if the database file is corrupt
+    """
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise SnapshotException('[%s] failed the integrity check: %s' % (path, result))
+
+
+def compress(path, name):
+    """
+    Writes the gzip file under a temporary name first, so an interrupted compression does not leave a broken snapshot
+    """
+    with open(path, 'rb') as source:
+        compressed = gzip.open(name + '.tmp', 'wb')
+        try:
+            shutil.copyfileobj(source, compressed)
+        finally:
+            compressed.close()
+    os.rename(name + '.tmp', name)
+
+
+def list_snapshots(folder):
+    """
+    :return: the snapshot files of the folder, the oldest first
+    """
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX))
+
+
+def restore_snapshot(snapshot, db_path):
+    """
+    Replaces the database by the snapshot; the server must not be running. The replaced database is kept as
+    <db_path>.before-restore
+    """
+    restored = db_path + '.restore'
+    source = gzip.open(snapshot, 'rb')
+    try:
+        with open(restored, 'wb') as target:
+            shutil.copyfileobj(source, target)
+    finally:
+        source.close()
+    check_database(restored)
+    if os.path.exists(db_path):
+        os.rename(db_path, db_path + '.before-restore')
+    for suffix in ('-journal', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.rename(restored, db_path)
+    logger.info('[%s] restored from [%s]', db_path, snapshot)
+
+
+def usage():
+    print ('Usage: python -m boxee.backup [options] <database folder>')
+    print ('\t -h --help \t list all command line options')
+    print ('\t -s --snapshot \t takes a snapshot now')
+    print ('\t -r --restore <snapshot> \t replaces the database by the snapshot (stop boxee first)')
+
+
+def main(argv):
+    snapshot = None
+    take = False
+    try:
+        opts, args = getopt.getopt(argv, "hsr:", ["help", "snapshot", "restore="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-s', '--snapshot'):
+            take = True
+        elif opt in ('-r', '--restore'):
+            snapshot = arg
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+    logging.basicConfig(format='%(levelname)s - %(module)s.%(funcName)s: %(message)s', level=logging.INFO)
+    db_path = os.path.join(args[0], 'boxee.db')
+    folder = os.path.join(args[0], 'backups')
+    if snapshot is not None:
+        restore_snapshot(snapshot, db_path)
+    elif take:
+        print(SnapshotScheduler(db_path, folder).snapshot())
+    else:
+        for name in list_snapshots(folder):
+            print('%s\t%s bytes' % (name, os.path.getsize(name)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,9 +1,15 @@
-from core import Service, Characteristic, CharacteristicUserDescriptionDescriptor
+from core import Service, Characteristic, DeferredCharacteristic
 import logging
+import threading
 import dbus
+import gobject
 import core
 import persistence
 import gpio
+import allocation
+import tokens
+from occupancy import OccupancyBitmap, MIN_DELTA_SIZE
+from membership import BarcodeIndex
 from exceptions import NotSupportedException
 
 __author__ = 'tamas'
@@ -16,47 +22,265 @@ def enum(**enums):
 
 
 class BoxManager:
-    def __init__(self, box_dao, gpio_connector):
+    def __init__(self, box_dao, gpio_connector, allocator=None, deferred_warm_up=False, slot_sizes=None):
         """
         :param box_dao:
+        :param allocator: the slot allocation policy; if None the lowest free slot id is reserved by the DAO
+        :param slot_sizes: slot_id -> size class (see boxee.allocation) written into the database by the warm up; the
+        slots not listed keep their size class
+        :param deferred_warm_up: the database and the allocator are prepared later by warm_up (the parcel operations
+        wait for it)
         :return:
         :type box_dao: persistence.BoxDao
         :type gpio_connector: gpio.GpioConnector
+        :type allocator: allocation.SlotAllocator
         """
         global result_codes
         result_codes = enum(STORED=0x00, SLOTS_NOT_AVAILABLE=0x01, PARCEL_RELEASED=0x02, PARCEL_NOT_FOUND=0x03,
                             INVALID_DATA=0x04, GENERIC_FAILURE=0x255)
         self.box_dao = box_dao
         self.gpio = gpio_connector
+        self.allocator = allocator
+        self.slot_sizes = slot_sizes
+        # which slots are full, kept in memory for the occupancy characteristic
+        self.occupancy = OccupancyBitmap()
+        # answers the release of unknown barcodes without a database query
+        self.barcodes = BarcodeIndex()
+        self.listeners = []
+        self.ready = threading.Event()
+        if not deferred_warm_up:
+            self.warm_up()
 
-    def store_parcel(self, barcode):
+    def warm_up(self):
+        """
+        Initializes the database and rebuilds the slot allocator, the occupancy map and the barcode filter
+        """
+        try:
+            self.box_dao.initialize()
+            if self.slot_sizes:
+                self.box_dao.define_slot_sizes(self.slot_sizes)
+            rows = self.box_dao.fetch_slots()
+            if self.allocator is not None:
+                self.allocator.rebuild(rows)
+            self.occupancy.rebuild(rows)
+            self.barcodes.rebuild(self.box_dao.fetch_barcodes(), len(rows))
+        finally:
+            # the parcel operations report their own errors if the warm up failed
+            self.ready.set()
+
+    def add_listener(self, listener):
+        """
+        :param listener: called with (slot_id, used) on the worker thread after a slot changed its state
+        """
+        self.listeners.append(listener)
+
+    def slot_changed(self, slot_id, used):
+        self.occupancy.set(slot_id, used)
+        for listener in self.listeners:
+            try:
+                listener(slot_id, used)
+            except BaseException as e:
+                logger.error('slot state listener failed: %s', str(e))
+
+    def slot_counts(self):
+        """
+        :return: a (free slots, all slots) tuple, counted from the occupancy map without a database query
+        """
+        return self.occupancy.counts()
+
+    def reserve_slot(self, barcode, size, slot_hint=None):
+        """
+        :param slot_hint: the slot preferred by the back office; ignored if it is not free
+        :return: the slot id claimed for the parcel or -1 if there is no suitable free slot
+        """
+        if slot_hint is not None:
+            if (self.allocator is None or self.allocator.take_slot(slot_hint, size)) \
+                    and self.box_dao.claim_slot(slot_hint, barcode):
+                return slot_hint
+            logger.debug('the hinted slot [%s] is not available for barcode [%s]', slot_hint, barcode)
+        if self.allocator is None:
+            return self.box_dao.reserve_slot(barcode)
+        while True:
+            slot_id = self.allocator.take(size)
+            if slot_id is None:
+                return -1
+            if self.box_dao.claim_slot(slot_id, barcode):
+                return slot_id
+            logger.warn('slot [%s] offered by the allocator is already used, trying the next one', slot_id)
+
+    def store_parcel(self, barcode, size=allocation.SIZE_SMALL, slot_hint=None):
         try:
+            self.ready.wait()
             logger.debug('preparing to store parcel identified by barcode [%s]', barcode)
-            empty_slots = self.box_dao.fetch_empty_slots()
-            if empty_slots is None or len(empty_slots) == 0:
+            self.barcodes.add(barcode)
+            try:
+                slot_id = self.reserve_slot(barcode, size, slot_hint)
+            except BaseException:
+                self.barcodes.remove(barcode)
+                raise
+            if slot_id <= 0:
+                self.barcodes.remove(barcode)
                 logger.warn('there are no free slots available for storing parcel')
                 return result_codes.SLOTS_NOT_AVAILABLE, 0
             else:
-                slot_id = empty_slots[0][0]
-                self.gpio.open_slot(slot_id)
-                self.box_dao.update_box(slot_id, True, barcode)
+                try:
+                    self.gpio.open_slot(slot_id)
+                except BaseException:
+                    # the slot could not be opened: give back the reservation
+                    self.box_dao.unclaim_slot(slot_id)
+                    if self.allocator is not None:
+                        self.allocator.put_back(slot_id)
+                    self.barcodes.remove(barcode)
+                    raise
                 logger.debug('parcel stored at slot id [%s] with barcode [%s]', slot_id, barcode)
+                self.slot_changed(slot_id, True)
                 return result_codes.STORED, slot_id
         except BaseException as ex:
             logger.error('Error while storing parcel: %s', str(ex))
             return result_codes.GENERIC_FAILURE, 0
 
+    def claim_slots(self, barcodes, size):
+        """
+        Claims the slots offered by the allocator in one transaction per round; the barcodes whose slot turned out to
+        be used already get the next offer, as in reserve_slot
+        :return: barcode -> slot id dictionary of the claimed slots
+        """
+        slots = dict()
+        pending = list(barcodes)
+        while pending:
+            assignments = []
+            for barcode in pending:
+                slot_id = self.allocator.take(size)
+                if slot_id is None:
+                    break
+                assignments.append((slot_id, barcode))
+            if not assignments:
+                break
+            claimed = self.box_dao.claim_slots(assignments)
+            retry = []
+            for slot_id, barcode in assignments:
+                if slot_id in claimed:
+                    slots[barcode] = slot_id
+                else:
+                    logger.warn('slot [%s] offered by the allocator is already used, trying the next one', slot_id)
+                    retry.append(barcode)
+            if len(assignments) < len(pending):
+                # the allocator ran out of slots: the barcodes without an offer stay unassigned
+                break
+            pending = retry
+        return slots
+
+    def store_parcels(self, barcodes, size=allocation.SIZE_SMALL):
+        """
+        Stores several parcels (eg. a courier drop off) with one transaction and one staggered batch of latch pulses
+        :param barcodes: the parcel identifiers
+        :param size: the size class of the parcels
+        :return: a list of (barcode, result code, slot id) tuples in the order of the barcodes
+        """
+        try:
+            self.ready.wait()
+            logger.debug('preparing to store parcels identified by barcodes %s', barcodes)
+            valid = []
+            for barcode in barcodes:
+                if barcode and barcode not in valid:
+                    valid.append(barcode)
+                    self.barcodes.add(barcode)
+            if self.allocator is None:
+                slots = dict(zip(valid, self.box_dao.reserve_slots(valid)))
+            else:
+                slots = self.claim_slots(valid, size)
+            results = []
+            for barcode in barcodes:
+                slot_id = slots.get(barcode, -1)
+                if not barcode:
+                    results.append((barcode, result_codes.INVALID_DATA, 0))
+                elif slot_id <= 0:
+                    results.append((barcode, result_codes.SLOTS_NOT_AVAILABLE, 0))
+                else:
+                    results.append((barcode, result_codes.STORED, slot_id))
+            for barcode in valid:
+                if slots.get(barcode, -1) <= 0:
+                    self.barcodes.remove(barcode)
+            stored = [slots[barcode] for barcode in valid if slots.get(barcode, -1) > 0]
+            try:
+                self.gpio.open_slots(stored)
+            except BaseException:
+                # the slots could not be opened: give back the reservations
+                self.box_dao.unclaim_slots(stored)
+                for barcode in valid:
+                    if slots.get(barcode, -1) > 0:
+                        if self.allocator is not None:
+                            self.allocator.put_back(slots[barcode])
+                        self.barcodes.remove(barcode)
+                raise
+            for slot_id in stored:
+                self.slot_changed(slot_id, True)
+            return results
+        except BaseException as ex:
+            logger.error('Error while storing parcels: %s', str(ex))
+            return [(barcode, result_codes.GENERIC_FAILURE, 0) for barcode in barcodes]
+
+    def release_parcels(self, barcodes):
+        """
+        Releases several parcels (eg. a recipient collecting all of them) with one transaction and one staggered batch
+        of latch pulses
+        :param barcodes: the parcel identifiers
+        :return: a list of (barcode, result code, slot id) tuples in the order of the barcodes
+        """
+        try:
+            self.ready.wait()
+            logger.debug('searching for parcels with barcodes %s for release', barcodes)
+            lookups = dict()
+            for barcode in set(barcode for barcode in barcodes if barcode):
+                lookups[barcode] = self.barcodes.lookup(barcode)
+            found = self.box_dao.release_slots([barcode for barcode, (absent, _) in lookups.iteritems() if not absent])
+            for barcode, (absent, generation) in lookups.iteritems():
+                if barcode in found:
+                    self.barcodes.found()
+                    self.barcodes.remove(barcode)
+                elif not absent:
+                    self.barcodes.not_found(barcode, generation)
+            results = []
+            for barcode in barcodes:
+                if not barcode:
+                    results.append((barcode, result_codes.INVALID_DATA, 0))
+                elif barcode in found:
+                    results.append((barcode, result_codes.PARCEL_RELEASED, found[barcode]))
+                else:
+                    results.append((barcode, result_codes.PARCEL_NOT_FOUND, 0))
+            if self.allocator is not None:
+                for slot_id in found.itervalues():
+                    self.allocator.release(slot_id)
+            self.gpio.open_slots(found.values())
+            for slot_id in found.itervalues():
+                self.slot_changed(slot_id, False)
+            return results
+        except BaseException as ex:
+            logger.error('Error while releasing parcels: %s', str(ex))
+            return [(barcode, result_codes.GENERIC_FAILURE, 0) for barcode in barcodes]
+
     def release_parcel(self, barcode):
         try:
+            self.ready.wait()
             logger.debug('searching for parcel with barcode [%s] for release', barcode)
+            absent, generation = self.barcodes.lookup(barcode)
+            if absent:
+                logger.warn('required parcel [%s] is not found (without database lookup).', barcode)
+                return result_codes.PARCEL_NOT_FOUND, 0
             slot_id = self.box_dao.fetch_slot_by_barcode(barcode)
             if slot_id <= 0:
+                self.barcodes.not_found(barcode, generation)
                 logger.warn('required parcel [%s] is not found.', barcode)
                 return result_codes.PARCEL_NOT_FOUND, 0
             else:
+                self.barcodes.found()
                 self.box_dao.update_box(slot_id, False, '')
+                self.barcodes.remove(barcode)
+                if self.allocator is not None:
+                    self.allocator.release(slot_id)
                 self.gpio.open_slot(slot_id)
                 logger.debug('parcel identified by [%s] is released from slot [%s]', barcode, slot_id)
+                self.slot_changed(slot_id, False)
                 return result_codes.PARCEL_RELEASED, slot_id
         except BaseException as ex:
             logger.error('Error while releasing parcel: %s', str(ex))
@@ -64,56 +288,101 @@ class BoxManager:
 
 
 class BoxService(Service):
-    BOX_SRV_UUID = '8fad8bdd-d619-4bd9-b3c1-816129f417ca'
 
-    def __init__(self, box_dao, gpio_connector, bus, index):
+    def __init__(self, box_dao, gpio_connector, bus, spec, executor, allocator=None, deferred_warm_up=False,
+                 guard=None, slot_sizes=None):
         """
             :param bus: the dbus connection
-            :param index: the index of the service
+            :param spec: the box service of the GATT schema
+            :param executor: runs the parcel operations off the main loop
+            :param allocator: the slot allocation policy of the deployment
+            :param deferred_warm_up: see BoxManager
+            :param guard: verifies the signed tokens of the parcel writes (None: plain barcodes are accepted)
+            :param slot_sizes: see BoxManager
             :type box_dao: persistence.BoxDao
             :type gpio_connector: gpio.GpioConnector
+            :type allocator: allocation.SlotAllocator
+            :type spec: boxee.schema.ServiceSpec
+            :type guard: boxee.tokens.WriteGuard
         """
-        Service.__init__(self, self.service_write_cb, bus, index, self.BOX_SRV_UUID, True)
-        self.box_manager = BoxManager(box_dao, gpio_connector)
-        self.add_characteristic(ParcelStoreCharacteristic(bus, 0, self.box_manager, self))
-        self.add_characteristic(ParcelReleaseCharacteristic(bus, 1, self.box_manager, self))
+        Service.__init__(self, self.service_write_cb, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        self.box_manager = BoxManager(box_dao, gpio_connector, allocator, deferred_warm_up, slot_sizes)
+        self.add_characteristics(spec, {
+            'parcel_store': lambda chrc_spec: ParcelStoreCharacteristic(bus, chrc_spec, self.box_manager, self,
+                                                                        executor, guard),
+            'parcel_release': lambda chrc_spec: ParcelReleaseCharacteristic(bus, chrc_spec, self.box_manager, self,
+                                                                            executor, guard),
+            'slot_occupancy': lambda chrc_spec: SlotOccupancyCharacteristic(bus, chrc_spec, self.box_manager, self)
+        })
 
     def service_write_cb(self, signal_dictionary):
         pass
         # characteristic.notify_cb()
 
 
-class ParcelCharacteristic(Characteristic):
-    def __init__(self, bus, index, box_manager, service):
+class ParcelCharacteristic(DeferredCharacteristic):
+    # the operation of the signed tokens accepted (see boxee.tokens)
+    operation = None
+
+    def __init__(self, bus, spec, box_manager, service, executor, guard=None):
         """
-        Parcel storage bluetooth low enegergy characteristic
+        Parcel storage bluetooth low enegergy characteristic; the write is acknowledged immediately, the box manager
+        operation is executed on the executor's worker threads (in arrival order per barcode) and the result code is
+        notified from the main loop.
         :param bus:
-        :param index:
+        :param spec: the characteristic spec of the GATT schema
         :param box_manager:
         :param service:
+        :param executor:
+        :param guard: if set, only signed tokens are accepted (verified on the main loop)
         :type box_manager: BoxManager
+        :type spec: boxee.schema.CharacteristicSpec
+        :type guard: boxee.tokens.WriteGuard
         :return:
         """
-        Characteristic.__init__(self, bus, index, self.return_uuid(), ['read', 'notify', 'write'], service)
+        DeferredCharacteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, executor,
+                                        early_ack=True, path=spec.path)
+        self.add_descriptors(spec.descriptors)
         self.box_manager = box_manager
+        self.guard = guard
         self.notifying = False
 
-    def return_uuid(self):
-        logger.warn('Default return UUID is called  (not implemented). Please override this method.')
-        raise NotSupportedException()
-
-    def write_action(self, value):
+    def write_action(self, barcode, slot_hint):
         logger.warn('Default write is called  (not implemented). Please override this method.')
         raise NotSupportedException()
 
-    def WriteValue(self, value):
-        # self.get_service().callback({self.__class__.__name__:value})
-        if len(value) == 0:
+    def prepare_write(self, value, device):
+        """
+        Runs on the main loop
+        :return: the (barcode, slot hint) tuple
+        """
+        if self.guard is not None:
+            return self.guard.check(value, device, self.operation)
+        return "".join(map(chr, value)), None
+
+    def write_value(self, value):
+        """
+        Runs on a worker thread
+        :param value: the (barcode, slot hint) tuple of prepare_write
+        :return: the (result code, slot id) tuple of the box manager operation
+        """
+        barcode, slot_hint = value
+        if len(barcode) == 0:
             # no barcode value is sent
-            self.notify(result_codes.INVALID_DATA, 0)
+            return result_codes.INVALID_DATA, 0
         else:
             # barcode value is available
-            self.write_action(value)
+            return self.write_action(barcode, slot_hint)
+
+    def ordering_key(self, value):
+        # the barcode determines the slot, so the store and release of a parcel never overtake each other
+        return value[0]
+
+    def write_done(self, result):
+        try:
+            self.notify(result[0], result[1])
+        except BaseException as e:
+            logger.error('notification failed during write due to: %s', str(e))
 
     def StartNotify(self):
         if self.notifying:
@@ -142,33 +411,78 @@ class ParcelCharacteristic(Characteristic):
 
 
 class ParcelStoreCharacteristic(ParcelCharacteristic):
-    def __init__(self, bus, index, box_manager, service):
-        ParcelCharacteristic.__init__(self, bus, index, box_manager, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Parcel Store Characteristic"))
+    operation = tokens.OP_STORE
 
-    def return_uuid(self):
-        return 'f76e76fc-a36a-49ab-85d3-9ac389b12ef8'
+    def __init__(self, bus, spec, box_manager, service, executor, guard=None):
+        """
+        The parcel_size option of the characteristic spec sets the size class of the parcels stored (see
+        boxee.allocation, default: small)
+        """
+        ParcelCharacteristic.__init__(self, bus, spec, box_manager, service, executor, guard)
+        self.parcel_size = spec.options.get('parcel_size', allocation.SIZE_SMALL)
 
-    def write_action(self, value):
-        try:
-            res = self.box_manager.store_parcel("".join(map(chr, value)))
-            self.notify(res[0], res[1])
-        except BaseException as e:
-            logger.error('notification failed during write due to: %s', str(e))
+    def write_action(self, barcode, slot_hint):
+        return self.box_manager.store_parcel(barcode, self.parcel_size, slot_hint)
 
 
 class ParcelReleaseCharacteristic(ParcelCharacteristic):
-    def __init__(self, bus, index, box_manager, service):
-        ParcelCharacteristic.__init__(self, bus, index, box_manager, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Parcel Release Characteristic"))
+    operation = tokens.OP_RELEASE
 
-    def return_uuid(self):
-        return 'e8dbd220-6391-4498-a19b-33adb3543a33'
+    def write_action(self, barcode, slot_hint):
+        return self.box_manager.release_parcel(barcode)
 
-    def write_action(self, value):
-        try:
-            res = self.box_manager.release_parcel("".join(map(chr, value)))
-            print ('notification results: %s and %s ', res[0], res[1])
-            self.notify(res[0], res[1])
-        except BaseException as e:
-            logger.error('notification failed during write due to: %s', str(e))
+
+class SlotOccupancyCharacteristic(Characteristic):
+    def __init__(self, bus, spec, box_manager, service):
+        """
+        Exposes the occupancy map of the slots (one bit per slot, see boxee.occupancy): a read returns the full map,
+        the notifications only carry the changed byte ranges.
+        :param spec: the characteristic spec of the GATT schema; the max_notification option sets the maximum size
+        of a notification (default: 20 bytes, the payload of the default ATT MTU, at least MIN_DELTA_SIZE)
+        :type box_manager: BoxManager
+        :type spec: boxee.schema.CharacteristicSpec
+        """
+        Characteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, spec.path)
+        self.add_descriptors(spec.descriptors)
+        self.occupancy = box_manager.occupancy
+        self.max_notification = spec.options.get('max_notification', 20)
+        if self.max_notification < MIN_DELTA_SIZE:
+            raise ValueError('[%s] max_notification must be at least [%s] bytes' % (spec.name, MIN_DELTA_SIZE))
+        self.notifying = False
+        self.flush_lock = threading.Lock()
+        self.flush_pending = False
+        box_manager.add_listener(self.slot_changed_cb)
+
+    def slot_changed_cb(self, slot_id, used):
+        """
+        Called on a worker thread after the occupancy map was updated; the changes are collected until the main loop
+        gets to the flush, so a burst of changes goes out in as few notifications as possible
+        """
+        with self.flush_lock:
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+        gobject.idle_add(self.flush_cb)
+
+    def flush_cb(self):
+        with self.flush_lock:
+            self.flush_pending = False
+        deltas = self.occupancy.take_delta(self.max_notification)
+        if self.notifying:
+            for delta in deltas:
+                self.PropertiesChanged(core.GATT_CHRC_IFACE, {'Value': dbus.ByteArray(delta)}, [])
+            logger.debug('occupancy delta notified in [%s] notifications', len(deltas))
+        return False
+
+    def ReadValue(self, options=None):
+        return dbus.ByteArray(self.occupancy.encode())
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        # the changes before the subscription are covered by the read of the full map
+        self.occupancy.take_delta(self.max_notification)
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
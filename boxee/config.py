@@ -0,0 +1,194 @@
+"""
+Runtime configuration of the locker. The settings are read from a JSON file (-c <file>); the missing keys keep their
+defaults. The file is reloaded on SIGHUP or by the Reload method of the org.bluez.boxee.Config1 interface
+(/org/bluez/boxee/config); the new settings are compared with the running ones and only the changed settings are
+applied, in place: the connections and the advertisements stay up.
+
+    {"out_channels": [17, 18], "slots": [17, 18], "allocation": "wear", "locker_id": 1, "company_id": 65535,
+     "log_level": "INFO", "session_spread": 0, "slot_sizes": {"17": 0, "18": 2},
+     "gpio": {"pulse_ms": 3000, "stagger_ms": 250, "max_energized": 4},
+     "advertising_intervals": {"connectable": [150, 210], "state_beacon": [100, 150], "service_beacon": [500, 1000]},
+     "notifications": {"cpu_percentage": {"min_interval": 1000, "max_interval": 60000, "abs_threshold": 5}}}
+
+    dbus-send --system --print-reply --dest=<boxee bus name> /org/bluez/boxee/config org.bluez.boxee.Config1.Reload
+"""
+import copy
+import json
+import logging
+import dbus
+import dbus.service
+from boxee.exceptions import FailedException
+from boxee.allocation import SIZE_CLASSES
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+CONFIG_IFACE = 'org.bluez.boxee.Config1'
+CONFIG_PATH = '/org/bluez/boxee/config'
+
+DEFAULTS = {
+    'out_channels': [17, 18],
+    'slots': [17, 18],
+    'allocation': 'wear',
+    'locker_id': 1,
+    'company_id': 0xffff,
+    'log_level': 'INFO',
+    'session_spread': 0,
+    # slot id (a string in JSON) -> size class (0: small, 1: medium, 2: large); the slots not listed are small
+    'slot_sizes': {},
+    'gpio': {'pulse_ms': 3000, 'stagger_ms': 250, 'max_energized': 4},
+    'advertising_intervals': {'connectable': [150, 210], 'state_beacon': [100, 150], 'service_beacon': [500, 1000]},
+    # characteristic name -> NotificationPolicy settings; the characteristics not listed keep their own policy
+    'notifications': {}
+}
+# the settings which are only read at startup
+RESTART_KEYS = frozenset(['slots', 'allocation', 'slot_sizes'])
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+POLICY_KEYS = frozenset(['min_interval', 'max_interval', 'abs_threshold', 'pct_threshold'])
+
+
+def default_config():
+    return copy.deepcopy(DEFAULTS)
+
+
+def is_count(value):
+    """
+    :return: True if the value is a non-negative integer (a bool is not accepted, though it is an int in Python)
+    """
+    return isinstance(value, (int, long)) and not isinstance(value, bool) and value >= 0
+
+
+def load_config(path):
+    """
+    :param path: the JSON configuration file
+    :return: the configuration dict, the missing keys filled with the defaults
+    :raise ValueError: if the file is not valid JSON or a setting is invalid (every error is reported at once)
+    """
+    with open(path) as config_file:
+        settings = json.load(config_file)
+    if not isinstance(settings, dict):
+        raise ValueError('the configuration must be a JSON object')
+    config = default_config()
+    for key, value in settings.iteritems():
+        if isinstance(config.get(key), dict) and isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    errors = validate(config)
+    if errors:
+        raise ValueError('invalid configuration [%s]:\n\t%s' % (path, '\n\t'.join(errors)))
+    return config
+
+
+def validate(config):
+    """
+    :return: the list of the errors found in the configuration
+    """
+    errors = ['unknown setting [%s]' % key for key in config if key not in DEFAULTS]
+    for key in ('out_channels', 'slots'):
+        if not isinstance(config[key], list) or not all(isinstance(item, int) for item in config[key]):
+            errors.append('[%s] must be a list of integers' % key)
+    for key in ('locker_id', 'company_id', 'session_spread'):
+        if not isinstance(config[key], int) or not 0 <= config[key] <= 0xffff:
+            errors.append('[%s] must be an integer between 0 and 65535' % key)
+    for slot_id, size in config['slot_sizes'].iteritems():
+        if not str(slot_id).isdigit() or size not in SIZE_CLASSES or isinstance(size, bool):
+            errors.append('[slot_sizes.%s] must map a slot id to a size class %s' % (slot_id, list(SIZE_CLASSES)))
+    if config['log_level'] not in LOG_LEVELS:
+        errors.append('[log_level] must be one of %s' % list(LOG_LEVELS))
+    for key, value in config['gpio'].iteritems():
+        if key not in DEFAULTS['gpio'] or not is_count(value):
+            errors.append('[gpio.%s] is unknown or not a non-negative integer' % key)
+    for kind, interval in config['advertising_intervals'].iteritems():
+        if kind not in DEFAULTS['advertising_intervals']:
+            errors.append('unknown advertisement kind [advertising_intervals.%s]' % kind)
+        elif not isinstance(interval, list) or len(interval) != 2 or not 20 <= interval[0] <= interval[1]:
+            errors.append('[advertising_intervals.%s] must be a [min, max] pair of milliseconds (min >= 20)' % kind)
+    for name, policy in config['notifications'].iteritems():
+        if not isinstance(policy, dict) or not set(policy).issubset(POLICY_KEYS):
+            errors.append('[notifications.%s] may only set %s' % (name, sorted(POLICY_KEYS)))
+            continue
+        for key, value in policy.iteritems():
+            # a null max_interval disables the heartbeat
+            if not is_count(value) and not (key == 'max_interval' and value is None):
+                errors.append('[notifications.%s.%s] must be a non-negative integer' % (name, key))
+    return errors
+
+
+def diff(running, new):
+    """
+    :return: the sorted names of the settings which differ
+    """
+    return sorted(key for key in set(running) | set(new) if running.get(key) != new.get(key))
+
+
+class ConfigReloader:
+    """
+    Reloads the configuration file and applies the changed settings through the appliers; used on the main loop only.
+    A setting is only taken over when its applier succeeded, so a failed setting is retried by the next reload.
+    """
+
+    def __init__(self, path, config, appliers):
+        """
+        :param path: the configuration file
+        :param config: the running configuration
+        :param appliers: setting name -> callable(old value, new value) applying the change in place
+        """
+        self.path = path
+        self.config = config
+        self.appliers = appliers
+        self.reloads = 0
+
+    def reload(self):
+        """
+        :return: the names of the settings applied
+        :raise ValueError: if the file is invalid (the running configuration is kept)
+        """
+        new = load_config(self.path)
+        self.reloads += 1
+        applied = []
+        for key in diff(self.config, new):
+            if key in RESTART_KEYS:
+                logger.warn('[%s] is only changed by a restart', key)
+                continue
+            try:
+                self.appliers[key](self.config[key], new[key])
+            except BaseException as e:
+                logger.error('could not apply [%s]: %s', key, str(e))
+                continue
+            logger.info('[%s] changed from [%s] to [%s]', key, self.config[key], new[key])
+            self.config[key] = new[key]
+            applied.append(key)
+        logger.info('configuration reloaded from [%s], [%s] settings applied', self.path, len(applied))
+        return applied
+
+    def reload_cb(self):
+        """
+        The reload as a main loop callback (eg. scheduled by the SIGHUP handler)
+        """
+        try:
+            self.reload()
+        except BaseException as e:
+            logger.error('the configuration could not be reloaded: %s', str(e))
+        return False
+
+
+class ConfigObject(dbus.service.Object):
+    """
+    Exposes the reload on D-Bus
+    """
+
+    def __init__(self, bus, reloader):
+        """
+        :type reloader: ConfigReloader
+        """
+        self.reloader = reloader
+        dbus.service.Object.__init__(self, bus, CONFIG_PATH)
+
+    @dbus.service.method(CONFIG_IFACE, in_signature='', out_signature='as')
+    def Reload(self):
+        try:
+            return dbus.Array(self.reloader.reload(), signature='s')
+        except BaseException as e:
+            logger.error('the configuration could not be reloaded: %s', str(e))
+            raise FailedException(str(e))
@@ -10,10 +10,12 @@ Central (~ Client): that can actually send a connection request to estalish a co
 import dbus.service
 import dbus
 import dbus.exceptions
-import array
 import logging
+import time
 import gobject
-from exceptions import InvalidArgsException, NotSupportedException, NotPermittedException
+from exceptions import InvalidArgsException, NotSupportedException, NotPermittedException, FailedException
+from executor import ExecutorBusyException
+import recorder as traffic
 
 __author__ = 'tamas'
 
@@ -30,6 +32,36 @@ GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
 GATT_DESC_IFACE = 'org.bluez.GattDescriptor1'
 logger = logging.getLogger(__name__)
 
+# flags tuple -> the same tuple and its dbus.Array: the objects with equal flags share one instance of both
+_FLAGS = dict()
+
+
+def shared_flags(flags):
+    """
+    :return: the canonical (interned) tuple of the flags and the dbus.Array used in the properties
+    """
+    key = tuple(flags)
+    shared = _FLAGS.get(key)
+    if shared is None:
+        shared = (tuple(intern(str(flag)) for flag in key), dbus.Array(key, signature='s'))
+        _FLAGS[key] = shared
+    return shared
+
+
+def to_bytes(value):
+    """
+    :return: the value as an immutable byte string (str); a list of byte values or a string is accepted, unicode
+    (eg. loaded from a JSON profile) is utf-8 encoded
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, basestring):
+        return str(value)
+    return str(bytearray(value))
+
+
 class Service(dbus.service.Object):
     """
     Main GATT Service with path base: /org/bluez/example/service
@@ -40,41 +72,63 @@ class Service(dbus.service.Object):
     """
     PATH_BASE = '/org/bluez/boxee/service'
 
-    def __init__(self, write_callback_func, bus, index, uuid, primary):
+    def __init__(self, write_callback_func, bus, index, uuid, primary, path=None):
         """
             :param write_callback_func: the callback function when some results need to be passed
             :param bus: the dbus connection
             :param index: the GATT service index (handler)
             :param uuid: the service UUID
             :param primary: true or false, depending if primary or secondary service
+            :param path: the object path resolved by the GATT schema (computed from the index by default)
         """
         self.callback_func = write_callback_func
-        self.path = self.PATH_BASE + str(index)
+        self.path = path if path is not None else self.PATH_BASE + str(index)
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        # characteristic name (of the GATT schema) -> characteristic
+        self.named_characteristics = dict()
+        # the properties are built on the first request and kept until the tree changes
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    def add_characteristics(self, spec, factories):
+        """
+        Creates the enabled characteristics of the service spec
+            :param spec: the service spec of the GATT schema
+            :param factories: characteristic name -> callable creating the characteristic from its spec
+            :type spec: boxee.schema.ServiceSpec
+        """
+        for chrc_spec in spec.characteristics:
+            if chrc_spec.name not in factories:
+                raise ValueError('no implementation for characteristic [%s]' % chrc_spec.name)
+            characteristic = factories[chrc_spec.name](chrc_spec)
+            self.named_characteristics[chrc_spec.name] = characteristic
+            self.add_characteristic(characteristic)
+
     def callback(self, result_dic):
         self.callback_func(result_dic)
 
     def get_properties(self):
-        return {
-            GATT_SERVICE_IFACE: {
-                'UUID': self.uuid,
-                'Primary': self.primary,
-                'Characteristics': dbus.Array(
-                    self.get_characteristic_paths(),
-                    signature='o')
+        if self.properties is None:
+            self.properties = {
+                GATT_SERVICE_IFACE: {
+                    'UUID': self.uuid,
+                    'Primary': self.primary,
+                    'Characteristics': dbus.Array(
+                        self.get_characteristic_paths(),
+                        signature='o')
+                }
             }
-        }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.properties = None
 
     def get_characteristic_paths(self):
         result = []
@@ -97,7 +151,7 @@ class Service(dbus.service.Object):
         if interface != GATT_SERVICE_IFACE:
             raise InvalidArgsException()
 
-        return self.get_properties[GATT_SERVICE_IFACE]
+        return self.get_properties()[GATT_SERVICE_IFACE]
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
@@ -116,7 +170,7 @@ class Service(dbus.service.Object):
 
 
 class Characteristic(dbus.service.Object):
-    def __init__(self, bus, index, uuid, flags, service):
+    def __init__(self, bus, index, uuid, flags, service, path=None):
         """
             The constructor of a characteristics which is part of a Service
             :param bus: the dbus connection
@@ -124,35 +178,64 @@ class Characteristic(dbus.service.Object):
             :param uuid: the unique id of this characteristics
             :param flags: possible values: read | write | notify | extended-properties | reliable-write | writable-auxiliaries
             :param service: the service reference (pointer)
+            :param path: the object path resolved by the GATT schema (computed from the index by default)
         """
-        self.path = service.path + '/char' + str(index)
-        self.bus = bus
-        self.uuid = uuid
+        self.path = path if path is not None else service.path + '/char' + str(index)
+        # bus: the connection is kept by dbus.service.Object (see the bus property)
+        self.uuid = intern(str(uuid))
         self.service = service
-        self.flags = flags
-        self.descriptors = []
+        self.flags = shared_flags(flags)[0]
+        # a shared empty tuple until the first descriptor is added (most of the characteristics have one or none)
+        self.descriptors = ()
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    @property
+    def bus(self):
+        return self.connection
+
+    def add_descriptors(self, specs):
+        """
+        Creates the descriptors of the characteristic spec (the user description and static values)
+            :type specs: list of boxee.schema.DescriptorSpec
+        """
+        for spec in specs:
+            if spec.uuid == CharacteristicUserDescriptionDescriptor.CUD_UUID:
+                self.add_descriptor(CharacteristicUserDescriptionDescriptor(self.bus, spec.index, self, spec.value,
+                                                                            spec.flags, spec.path))
+            else:
+                self.add_descriptor(StaticDescriptor(self.bus, spec.index, spec.uuid, spec.flags, self, spec.value,
+                                                     spec.path))
+
     def get_service(self):
         return self.service
 
+    def _message_cb(self, connection, message):
+        # every incoming method call passes here, so the GATT traffic is recorded without touching the handlers
+        if traffic.recorder is not None:
+            traffic.recorder.record_message(self.path, message)
+        dbus.service.Object._message_cb(self, connection, message)
+
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                'Service': self.service.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.get_descriptor_paths(),
-                    signature='o')
+        if self.properties is None:
+            self.properties = {
+                GATT_CHRC_IFACE: {
+                    'Service': self.service.get_path(),
+                    'UUID': self.uuid,
+                    'Flags': shared_flags(self.flags)[1],
+                    'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
+                }
             }
-        }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
-        self.descriptors.append(descriptor)
+        self.descriptors += (descriptor,)
+        self.properties = None
 
     def get_descriptor_paths(self):
         result = []
@@ -170,15 +253,15 @@ class Characteristic(dbus.service.Object):
         if interface != GATT_CHRC_IFACE:
             raise InvalidArgsException()
 
-        return self.get_properties[GATT_CHRC_IFACE]
+        return self.get_properties()[GATT_CHRC_IFACE]
 
     @dbus.service.method(GATT_CHRC_IFACE, out_signature='ay')
-    def ReadValue(self):
+    def ReadValue(self, options=None):
         logger.warn('Default ReadValue called (not implemented), returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='ay')
-    def WriteValue(self, value):
+    def WriteValue(self, value, options=None):
         # print('Default WriteValue called, returning error')
         # raise NotSupportedException()
         self.get_service().callback({self.__class__.__name__:value})
@@ -195,7 +278,7 @@ class Characteristic(dbus.service.Object):
 
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
-    def qPropertiesChanged(self, interface, changed, invalidated):
+    def PropertiesChanged(self, interface, changed, invalidated):
         """
             Fires a property changed signal to the dbus
             :param interface: the GATT Characteristics Interface (org.bluez.GattCharacteristic1)
@@ -205,31 +288,236 @@ class Characteristic(dbus.service.Object):
         pass
 
 
-class NotificationAbleCharacteristic(Characteristic):
-    def __init__(self, bus, index, service, flags=['read', 'notify']):
-        Characteristic.__init__(
-            self, bus, index,
-            self.return_uuid(),
-            flags,
-            service)
-        self.notifying = False
+class DeferredCharacteristic(Characteristic):
+    """
+    A characteristic whose read and write handlers run on a worker thread of the executor. The D-Bus reply is sent
+    asynchronously once the handler completed, so the main loop keeps serving the other centrals meanwhile.
+    Subclasses implement read_value / write_value (worker thread) and optionally prepare_write / write_done (main
+    loop).
+    With early_ack the write is acknowledged as soon as it is accepted by the executor, and the outcome is only
+    reported by write_done (eg. with a notification).
+    """
+
+    def __init__(self, bus, index, uuid, flags, service, executor, early_ack=False, path=None):
+        """
+            :param executor: the executor running the handlers
+            :param early_ack: reply to WriteValue before the write handler is executed
+            :type executor: boxee.executor.MainLoopExecutor
+        """
+        Characteristic.__init__(self, bus, index, uuid, flags, service, path)
+        self.executor = executor
+        self.early_ack = early_ack
 
-    def return_uuid(self):
-        logger.warn('Default return UUID is called. Please override this method.')
+    def read_value(self):
+        logger.warn('Default read_value called (not implemented), returning error')
         raise NotSupportedException()
 
+    def write_value(self, value):
+        logger.warn('Default write_value called (not implemented), returning error')
+        raise NotSupportedException()
+
+    def write_done(self, result):
+        """
+        Called on the main loop with the return value of write_value, before the D-Bus reply is sent
+        """
+        pass
+
+    def prepare_write(self, value, device):
+        """
+        Called on the main loop before the write is submitted to the executor, so the invalid writes can be rejected
+        without a worker thread
+        :param device: the object path of the writing central (None if bluez does not pass it)
+        :return: the argument of ordering_key and write_value
+        :raise dbus.exceptions.DBusException: to reject the write
+        """
+        return value
+
+    def ordering_key(self, value):
+        """
+        :return: writes with the same ordering key are executed and completed in the order they were received;
+        None means no ordering constraint
+        """
+        return None
+
+    @dbus.service.method(GATT_CHRC_IFACE, out_signature='ay', async_callbacks=('reply_handler', 'error_handler'))
+    def ReadValue(self, options=None, reply_handler=None, error_handler=None):
+        self.executor.submit(self.read_value, (), reply_handler, error_handler)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='ay', async_callbacks=('reply_handler', 'error_handler'))
+    def WriteValue(self, value, options=None, reply_handler=None, error_handler=None):
+        """
+        :param options: passed by bluez 5.46 and newer (eg. the device)
+        """
+        def completed(result):
+            try:
+                self.write_done(result)
+            finally:
+                if not self.early_ack:
+                    reply_handler()
+
+        try:
+            value = self.prepare_write(value, options.get('device') if options else None)
+        except dbus.exceptions.DBusException as e:
+            error_handler(e)
+            return
+        try:
+            self.executor.submit(self.write_value, (value,), completed,
+                                 None if self.early_ack else error_handler, self.ordering_key(value))
+        except ExecutorBusyException as e:
+            logger.warn('rejecting write on [%s]: %s', self.path, str(e))
+            error_handler(FailedException('busy'))
+            return
+        if self.early_ack:
+            reply_handler()
+
+
+class NotificationPolicy(object):
+    """
+    Decides whether a freshly sampled characteristic value is worth a PropertiesChanged signal (every signal costs
+    radio airtime on the BLE link and battery on the phone).
+
+    The policy caches the last value sent and suppresses a new one unless:
+        * nothing was sent yet (first value after StartNotify), or
+        * the heartbeat (max_interval) elapsed since the last notification, or
+        * the value changed by at least abs_threshold (absolute) or pct_threshold (percent of the previous value);
+          when no threshold is configured any change is notified.
+    Nothing is ever sent sooner than min_interval after the previous notification.
+    """
+
+    __slots__ = ('min_interval', 'max_interval', 'abs_threshold', 'pct_threshold', 'last_value', 'last_sent')
+
+    def __init__(self, min_interval=1000, max_interval=None, abs_threshold=0, pct_threshold=0):
+        """
+            :param min_interval: the minimum time between two notifications in milliseconds (also the sampling period)
+            :param max_interval: heartbeat in milliseconds: an unchanged value is re-sent after this time; None disables it
+            :param abs_threshold: the minimum absolute change of any byte of the value to be notified
+            :param pct_threshold: the minimum change of any byte of the value in percent of its previous value
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.abs_threshold = abs_threshold
+        self.pct_threshold = pct_threshold
+        self.last_value = None
+        self.last_sent = None
+
+    def reset(self):
+        """
+        Forgets the cached value, so the next sample is notified unconditionally (eg. a new subscriber)
+        """
+        self.last_value = None
+        self.last_sent = None
+
+    def should_notify(self, value, now=None):
+        """
+        :param value: the freshly sampled value (dbus.Byte, dbus.ByteArray or an array of bytes)
+        :param now: the current time in milliseconds (defaults to the wall clock)
+        :return: True if the value must be sent to the subscribers
+        """
+        if self.last_sent is None:
+            return True
+        now = _now_ms() if now is None else now
+        elapsed = now - self.last_sent
+        if elapsed < self.min_interval:
+            return False
+        if self.max_interval is not None and elapsed >= self.max_interval:
+            return True
+        return self.has_changed(_as_byte_values(value))
+
+    def has_changed(self, current):
+        previous = self.last_value
+        if len(previous) != len(current):
+            return True
+        for prev, curr in zip(previous, current):
+            if not isinstance(prev, (int, long)) or not isinstance(curr, (int, long)):
+                if prev != curr:
+                    return True
+                continue
+            delta = abs(curr - prev)
+            if delta == 0:
+                continue
+            if not self.abs_threshold and not self.pct_threshold:
+                return True
+            if self.abs_threshold and delta >= self.abs_threshold:
+                return True
+            if self.pct_threshold and (prev == 0 or delta * 100.0 / abs(prev) >= self.pct_threshold):
+                return True
+        return False
+
+    def mark_sent(self, value, now=None):
+        """
+        Caches the value which was just notified
+        """
+        self.last_value = _as_byte_values(value)
+        self.last_sent = _now_ms() if now is None else now
+
+
+def _now_ms():
+    return time.time() * 1000
+
+
+def _as_byte_values(value):
+    """
+    Normalizes the different value representations used by the characteristics into a comparable tuple
+    """
+    if value is None:
+        return ()
+    if isinstance(value, (int, long)):
+        return (int(value),)
+    if isinstance(value, basestring):
+        return tuple(ord(c) for c in value)
+    result = []
+    for item in value:
+        if isinstance(item, (int, long)):
+            result.append(int(item))
+        elif isinstance(item, basestring) and len(item) == 1:
+            result.append(ord(item))
+        else:
+            result.append(item)
+    return tuple(result)
+
+
+class NotificationAbleCharacteristic(Characteristic):
+    def __init__(self, bus, spec, service, policy=None):
+        """
+            :param spec: the characteristic spec of the GATT schema (uuid, flags, path and descriptors)
+            :param policy: the notification policy of this characteristic; by default the value is sampled every
+            second and only sent when it has changed
+            :type spec: boxee.schema.CharacteristicSpec
+            :type policy: NotificationPolicy
+        """
+        Characteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, spec.path)
+        self.add_descriptors(spec.descriptors)
+        self.notifying = False
+        self.notify_source = None
+        self.policy = policy if policy is not None else NotificationPolicy()
+
     def get_values(self):
         logger.warn('Default get_values is called. Please override this method.')
         raise NotSupportedException()
 
-    def ReadValue(self):
+    def ReadValue(self, options=None):
         logger.debug('read value in read and notification characteristic')
         return self.get_values()
 
     def notify_cb(self):
-        logger.debug('notifying in read and notification characteristic')
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': self.get_values()}, [])
-        return self.notifying
+        """
+        The sampling timer; a failed sample only skips this tick, the timer (and notify_source) stays valid until
+        the notifications are stopped
+        """
+        if not self.notifying:
+            self.notify_source = None
+            return False
+        try:
+            values = self.get_values()
+            if values is None:
+                logger.warn('no value sampled for [%s], skipping the notification', self.uuid)
+            elif self.policy.should_notify(values):
+                logger.debug('notifying in read and notification characteristic')
+                self.policy.mark_sent(values)
+                self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': values}, [])
+        except BaseException as e:
+            logger.error('sampling [%s] failed, skipping the notification: %s', self.uuid, str(e))
+        return True
 
     def StartNotify(self):
         if self.notifying:
@@ -237,31 +525,55 @@ class NotificationAbleCharacteristic(Characteristic):
             return
 
         self.notifying = True
-        gobject.timeout_add(1000, self.notify_cb)
+        self.policy.reset()
+        self.notify_source = gobject.timeout_add(self.policy.min_interval, self.notify_cb)
+
+    def retune(self, **settings):
+        """
+        Changes the notification policy in place (eg. on a configuration reload); a running sampling timer is
+        restarted with the new min_interval
+            :param settings: NotificationPolicy attributes (min_interval, max_interval, abs_threshold, pct_threshold)
+        """
+        for name, value in settings.iteritems():
+            if name not in NotificationPolicy.__slots__:
+                raise ValueError('unknown notification policy setting [%s]' % name)
+            setattr(self.policy, name, value)
+        if self.notify_source is not None:
+            gobject.source_remove(self.notify_source)
+            self.notify_source = gobject.timeout_add(self.policy.min_interval, self.notify_cb)
 
     def StopNotify(self):
         if not self.notifying:
             # Not notifying, nothing to do
             return
         self.notifying = False
+        if self.notify_source is not None:
+            gobject.source_remove(self.notify_source)
+            self.notify_source = None
 
 class Descriptor(dbus.service.Object):
-    def __init__(self, bus, index, uuid, flags, characteristic):
-        self.path = characteristic.path + '/desc' + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.flags = flags
+    def __init__(self, bus, index, uuid, flags, characteristic, path=None):
+        self.path = path if path is not None else characteristic.path + '/desc' + str(index)
+        self.uuid = intern(str(uuid))
+        self.flags = shared_flags(flags)[0]
         self.chrc = characteristic
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    @property
+    def bus(self):
+        return self.connection
+
     def get_properties(self):
-        return {
-            GATT_DESC_IFACE: {
-                'Characteristic': self.chrc.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
+        if self.properties is None:
+            self.properties = {
+                GATT_DESC_IFACE: {
+                    'Characteristic': self.chrc.get_path(),
+                    'UUID': self.uuid,
+                    'Flags': shared_flags(self.flags)[1],
+                }
             }
-        }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -273,15 +585,15 @@ class Descriptor(dbus.service.Object):
         if interface != GATT_DESC_IFACE:
             raise InvalidArgsException()
 
-        return self.get_properties[GATT_CHRC_IFACE]
+        return self.get_properties()[GATT_DESC_IFACE]
 
     @dbus.service.method(GATT_DESC_IFACE, out_signature='ay')
-    def ReadValue(self):
+    def ReadValue(self, options=None):
         logger.warn('Default ReadValue called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='ay')
-    def WriteValue(self, value):
+    def WriteValue(self, value, options=None):
         logger.warn('Default WriteValue called, returning error')
         raise NotSupportedException()
 
@@ -292,30 +604,47 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
     CUD_UUID = '2901'
 
-    def __init__(self, bus, index, characteristic, description):
+    def __init__(self, bus, index, characteristic, description, flags=('read', 'write'), path=None):
         """
             :param bus:
             :param index:
             :param characteristic:
             :param description: the User Description value
+            :param flags: the descriptor flags
+            :param path: the object path resolved by the GATT schema
 
         """
-        self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', description)
-        self.value = self.value.tolist()
+        # kept as an immutable byte string, converted to a byte array only when it is read
+        self.value = to_bytes(description)
         Descriptor.__init__(
             self, bus, index,
             self.CUD_UUID,
-            ['read', 'write'],
-            characteristic)
+            flags,
+            characteristic, path)
 
-    def ReadValue(self):
-        return self.value
+    def ReadValue(self, options=None):
+        return dbus.ByteArray(self.value)
 
-    def WriteValue(self, value):
-        if not self.writable:
+    def WriteValue(self, value, options=None):
+        if 'writable-auxiliaries' not in self.chrc.flags:
             raise NotPermittedException()
-        self.value = value
+        self.value = to_bytes(value)
+
+
+class StaticDescriptor(Descriptor):
+    """
+    A read-only descriptor with a constant value defined in the GATT schema (eg. a presentation format)
+    """
+
+    def __init__(self, bus, index, uuid, flags, characteristic, value, path=None):
+        """
+            :param value: the descriptor value: a string or a list of byte values
+        """
+        Descriptor.__init__(self, bus, index, uuid, flags, characteristic, path)
+        self.value = to_bytes(value)
+
+    def ReadValue(self, options=None):
+        return dbus.ByteArray(self.value)
 
 
 class Advertisement(dbus.service.Object):
@@ -329,7 +658,7 @@ class Advertisement(dbus.service.Object):
         Initializes the GATT advertisement
         :param bus: the dbus connection reference
         :param index: the index of this advertisement
-        :param advertising_type: possible values are: peripheral
+        :param advertising_type: possible values are: peripheral (connectable) and broadcast (non-connectable)
         :return:
         """
         self.path = self.PATH_BASE + str(index)
@@ -340,6 +669,9 @@ class Advertisement(dbus.service.Object):
         self.solicit_uuids = None
         self.service_data = None
         self.include_tx_power = None
+        # the advertising interval in milliseconds (None: the controller default)
+        self.min_interval = None
+        self.max_interval = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -357,11 +689,23 @@ class Advertisement(dbus.service.Object):
                                                         signature='say')
         if self.include_tx_power is not None:
             properties['IncludeTxPower'] = dbus.Boolean(self.include_tx_power)
+        if self.min_interval is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval)
+        if self.max_interval is not None:
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval)
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def set_interval(self, min_interval, max_interval):
+        """
+        :param min_interval: the minimum advertising interval in milliseconds
+        :param max_interval: the maximum advertising interval in milliseconds
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
     def add_service_uuid(self, uuid):
         if not self.service_uuids:
             self.service_uuids = []
@@ -0,0 +1,99 @@
+from core import Service, DeferredCharacteristic
+import logging
+import time
+import dbus
+import core
+from latency import PROBE_REQUEST, PROBE_RESPONSE, CLOCK_MASK
+from exceptions import InvalidValueLengthException
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+def now_us():
+    return int(time.time() * 1000000)
+
+
+class DiagnosticsService(Service):
+    def __init__(self, bus, spec, executor, box_dao=None):
+        """
+            :param spec: the diagnostics service of the GATT schema
+            :param executor: runs the probe handlers, as it runs the parcel operations
+            :param box_dao: read by the probes asking for database work
+            :type spec: boxee.schema.ServiceSpec
+        """
+        Service.__init__(self, self.service_write_cb, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        self.add_characteristics(spec, {
+            'latency_probe': lambda chrc_spec: LatencyProbeCharacteristic(bus, chrc_spec, self, executor, box_dao)
+        })
+
+    def service_write_cb(self, signal_dictionary):
+        pass
+
+
+class LatencyProbeCharacteristic(DeferredCharacteristic):
+    """
+    Echoes the probes of the phone with the server side timestamps (see boxee.latency for the formats and the
+    aggregation). The probe takes the path of a parcel write: the receipt is stamped in WriteValue on the main loop,
+    the handler runs on a worker thread of the executor and the notification is sent from the main loop. The
+    notification is packed into a preallocated buffer.
+    """
+
+    def __init__(self, bus, spec, service, executor, box_dao=None):
+        """
+            :type spec: boxee.schema.CharacteristicSpec
+            :type box_dao: boxee.persistence.BoxDao
+        """
+        DeferredCharacteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, executor,
+                                        early_ack=True, path=spec.path)
+        self.add_descriptors(spec.descriptors)
+        self.box_dao = box_dao
+        self.notifying = False
+        self.buffer = bytearray(PROBE_RESPONSE.size)
+        self.changed = {'Value': None}
+        self.probes = 0
+
+    def prepare_write(self, value, device):
+        """
+        Runs on the main loop, right after the WriteValue call arrived
+        :return: the (seq, phone clock, receipt, work) tuple
+        """
+        received = now_us()
+        if len(value) < PROBE_REQUEST.size:
+            raise InvalidValueLengthException()
+        seq, sent = PROBE_REQUEST.unpack(''.join(chr(byte) for byte in value[:PROBE_REQUEST.size]))
+        work = len(value) > PROBE_REQUEST.size and value[PROBE_REQUEST.size] == 1
+        return seq, sent, received, work
+
+    def write_value(self, value):
+        """
+        Runs on a worker thread
+        :return: the probe with the handler start and end
+        """
+        start = now_us()
+        if value[3] and self.box_dao is not None:
+            self.box_dao.count_slots()
+        return value + (start, now_us())
+
+    def write_done(self, result):
+        seq, sent, received, work, start, end = result
+        self.probes += 1
+        PROBE_RESPONSE.pack_into(self.buffer, 0, seq, sent, received & CLOCK_MASK, min(start - received, CLOCK_MASK),
+                                 min(end - received, CLOCK_MASK))
+        if self.notifying:
+            self.changed['Value'] = dbus.ByteArray(str(self.buffer))
+            self.PropertiesChanged(core.GATT_CHRC_IFACE, self.changed, [])
+
+    def read_value(self):
+        """
+        :return: the last probe notification
+        """
+        return dbus.ByteArray(str(self.buffer))
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        if self.notifying:
+            logger.info('[%s] latency probes answered', self.probes)
+        self.notifying = False
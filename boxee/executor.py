@@ -0,0 +1,136 @@
+import logging
+import threading
+import collections
+import Queue
+import dbus.mainloop.glib
+import gobject
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+def init_threads():
+    """
+    Makes the GLib main loop and the dbus bindings thread aware. Must be called before the main loop is created and
+    before any worker thread is started.
+    """
+    gobject.threads_init()
+    dbus.mainloop.glib.threads_init()
+
+
+def _run_once(func, arg):
+    """
+    GLib idle callback wrapper: runs the function once on the main loop and removes itself
+    """
+    try:
+        func(arg)
+    except BaseException as e:
+        logger.error('Error while completing a deferred task on the main loop: %s', str(e))
+    return False
+
+
+class ExecutorBusyException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+class MainLoopExecutor:
+    """
+    Runs blocking work (SQLite, GPIO, psutil) on a bounded pool of worker threads and delivers the result back on the
+    GLib main loop, so a slow handler does not hold every other central's request.
+    Tasks submitted with the same key are executed one after the other in submission order, and their callbacks are
+    called in the same order; tasks with different keys run in parallel.
+    """
+
+    def __init__(self, workers=2, max_pending=None, name='boxee-worker'):
+        """
+            :param workers: the number of worker threads
+            :param max_pending: the maximum number of submitted but not yet completed tasks (None: unbounded)
+            :param name: the name prefix of the worker threads
+        """
+        self.tasks = Queue.Queue()
+        self.max_pending = max_pending
+        self.pending = 0
+        # key -> the tasks waiting for the running task with the same key
+        self.keyed = dict()
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='%s-%s' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, args=(), callback=None, errback=None, key=None):
+        """
+        Schedules the function on a worker thread.
+            :param func: the function to be executed on the worker thread
+            :param args: the arguments of the function
+            :param callback: called on the main loop with the return value of the function
+            :param errback: called on the main loop with the exception raised by the function
+            :param key: the ordering key: tasks with the same key are executed and completed in submission order
+            :raise ExecutorBusyException: if the number of pending tasks reached max_pending
+        """
+        task = (func, args, callback, errback, key)
+        with self.lock:
+            if self.max_pending is not None and self.pending >= self.max_pending:
+                raise ExecutorBusyException('%s tasks are already pending' % self.pending)
+            self.pending += 1
+            if key is not None:
+                if key in self.keyed:
+                    # a task with the same key is running: this one is started once that is completed
+                    self.keyed[key].append(task)
+                    return
+                self.keyed[key] = collections.deque()
+        self.tasks.put(task)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            func, args, callback, errback, key = task
+            try:
+                result = func(*args)
+            except BaseException as e:
+                logger.error('Deferred task [%s] failed: %s', getattr(func, '__name__', func), str(e))
+                if errback is not None:
+                    gobject.idle_add(_run_once, errback, e)
+            else:
+                if callback is not None:
+                    gobject.idle_add(_run_once, callback, result)
+            finally:
+                self._completed(key)
+
+    def _completed(self, key):
+        following = None
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.drained.notify_all()
+            if key is not None:
+                waiting = self.keyed[key]
+                if waiting:
+                    following = waiting.popleft()
+                else:
+                    del self.keyed[key]
+        if following is not None:
+            self.tasks.put(following)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads
+            :param wait: block until the already submitted tasks are completed and the worker threads are terminated
+        """
+        logger.info('shutting down executor with [%s] workers', len(self.threads))
+        if wait:
+            with self.lock:
+                while self.pending > 0:
+                    self.drained.wait()
+        for _ in self.threads:
+            self.tasks.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
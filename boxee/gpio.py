@@ -2,10 +2,11 @@ __author__ = 'tamas'
 import logging
 import dbus
 import sys
-import RPi.GPIO as GPIO
 import gobject
 
 logger = logging.getLogger()
+# RPi.GPIO is imported when the first connector is created, so it does not slow down the startup of the server
+GPIO = None
 """
 http://app.programmingfonts.org/
 Inconsolata, Monaco, Consolas, 'Courier New', Courier;
@@ -13,7 +14,22 @@ Inconsolata, Monaco, Consolas, 'Courier New', Courier;
 
 
 class GpioConnector:
-    def __init__(self, out_channels=None, in_channels=None):
+    def __init__(self, out_channels=None, in_channels=None, pulse_ms=3000, stagger_ms=250, max_energized=4):
+        """
+            :param out_channels: the output channels (slot latches)
+            :param in_channels: the input channels (not yet supported)
+            :param pulse_ms: how long a slot latch is kept open
+            :param stagger_ms: the delay between the start of two latch pulses of a batch, so the inrush currents of
+            the solenoids do not add up
+            :param max_energized: the maximum number of latches energized at the same time (the power budget)
+        """
+        self.pulse_ms = pulse_ms
+        self.stagger_ms = stagger_ms
+        self.max_energized = max_energized
+        global GPIO
+        if GPIO is None:
+            import RPi.GPIO
+            GPIO = RPi.GPIO
         logger.info('RPI board info: %s' % GPIO.RPI_INFO)
         GPIO.setmode(GPIO.BCM)
         if GPIO.getmode() != GPIO.BCM:
@@ -39,6 +55,26 @@ class GpioConnector:
         else:
             logger.warning('No input channels are initialized.')
 
+    def set_out_channels(self, out_channels):
+        """
+        Sets up the new output channels and releases the ones which are not used any more (eg. on a configuration
+        reload); the channel list is updated in place
+        :param out_channels: the new output channels
+        """
+        current = self.out_channels if self.out_channels is not None else []
+        added = [channel for channel in out_channels if channel not in current]
+        removed = [channel for channel in current if channel not in out_channels]
+        if added:
+            logger.info('Initializing out channels %s' % added)
+            GPIO.setup(added, GPIO.OUT)
+        if removed:
+            logger.info('Releasing out channels %s' % removed)
+            GPIO.output(removed, GPIO.LOW)
+            GPIO.cleanup(removed)
+        if self.out_channels is None:
+            self.out_channels = []
+        self.out_channels[:] = out_channels
+
     def open_slot(self, slot_id):
         """
         Open the slot identified by the slot_id for 1 seconds, afterwards it closing it again
@@ -47,7 +83,29 @@ class GpioConnector:
         """
         logger.debug('setting channel [%s] to HIGH', slot_id)
         GPIO.output(slot_id, GPIO.HIGH)
-        gobject.timeout_add(3000, self.close_slot, slot_id)
+        gobject.timeout_add(self.pulse_ms, self.close_slot, slot_id)
+
+    def open_slots(self, slot_ids):
+        """
+        Opens several slots as one batch: the pulses start stagger_ms after each other and at most max_energized
+        latches are open at the same time; the next group is started once the previous one is closed
+        :param slot_ids: the slots to be opened
+        :return:
+        """
+        group_ms = self.pulse_ms + self.stagger_ms * self.max_energized
+        for position, slot_id in enumerate(slot_ids):
+            delay = (position // self.max_energized) * group_ms + (position % self.max_energized) * self.stagger_ms
+            if delay == 0:
+                self.open_slot(slot_id)
+            else:
+                gobject.timeout_add(delay, self._open_slot_cb, slot_id)
+
+    def _open_slot_cb(self, slot_id):
+        try:
+            self.open_slot(slot_id)
+        except BaseException as e:
+            logger.error('could not open slot [%s]: %s', slot_id, str(e))
+        return False
 
     @staticmethod
     def close_slot(slot_id):
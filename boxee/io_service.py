@@ -4,7 +4,7 @@ from random import randint
 from exceptions import InvalidValueLengthException, FailedException
 import dbus
 import boxee
-from core import Service, Characteristic, CharacteristicUserDescriptionDescriptor
+from core import Service, Characteristic, NotificationPolicy
 
 __author__ = 'tamas'
 logger = logging.getLogger(__name__)
@@ -16,29 +16,26 @@ class AutomationIOService(Service):
     The Automation IO service is used to expose the analog inputs/outputs and digital input/outputs of a generic IO module (IOM).
     This service has no dependencies on other GATT-based services.
     """
-    AUTIO_UUID = '1815'
 
-    def __init__(self, bus, index, write_callback_func):
+    def __init__(self, bus, spec, write_callback_func):
         """
             :param bus: the dbus connection
-            :param index: the index of the service
+            :param spec: the automation_io service of the GATT schema
+            :type spec: boxee.schema.ServiceSpec
         """
-        Service.__init__(self, write_callback_func, bus, index, self.AUTIO_UUID, True)
-        self.add_characteristic(AutIODigitalChrc(bus, 0, self))
+        Service.__init__(self, write_callback_func, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        self.add_characteristics(spec, {'digital_io': lambda chrc_spec: AutIODigitalChrc(bus, chrc_spec, self)})
         self.energy_expended = 0
 
 
 class AutIODigitalChrc(Characteristic):
-    AUT_IO_DIG_CHRC_UUID = '2A56'
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index,
-            self.AUT_IO_DIG_CHRC_UUID,
-            ['write', 'notify', 'reliable-write'],
-            service)
+
+    def __init__(self, bus, spec, service):
+        Characteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, spec.path)
+        self.add_descriptors(spec.descriptors)
         self.notifying = False
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Automation Digital IO"))
+        self.notify_source = None
+        self.policy = NotificationPolicy(min_interval=1000, max_interval=10000, abs_threshold=5)
         self.hr_ee_count = 0
 
     def hr_msrmt_cb(self):
@@ -57,10 +54,10 @@ class AutIODigitalChrc(Characteristic):
         self.service.energy_expended = \
             min(0xffff, self.service.energy_expended + 1)
         self.hr_ee_count += 1
-        print(repr(value))
-        print(len(value))
+        if not self.policy.should_notify(value):
+            return self.notifying
         logger.debug('Updating value: [%s] with length [%s]', repr(value), len(value))
-        logger.debug('raw value: [%s]', value)
+        self.policy.mark_sent(value)
         self.PropertiesChanged(boxee.core.GATT_CHRC_IFACE, {'Value': value}, [])
 
         return self.notifying
@@ -69,9 +66,13 @@ class AutIODigitalChrc(Characteristic):
         logger.debug('Update HR Measurement Simulation')
 
         if not self.notifying:
+            if self.notify_source is not None:
+                gobject.source_remove(self.notify_source)
+                self.notify_source = None
             return
 
-        gobject.timeout_add(1000, self.hr_msrmt_cb)
+        self.policy.reset()
+        self.notify_source = gobject.timeout_add(self.policy.min_interval, self.hr_msrmt_cb)
 
     def StartNotify(self):
         if self.notifying:
@@ -0,0 +1,145 @@
+"""
+End-to-end BLE latency probes (see diagnostics_service.LatencyProbeCharacteristic). The phone writes a probe and logs
+the notification it gets back; this module splits the round trips into stages and prints a latency histogram for every
+stage.
+
+Probe write (little endian): sequence number (I), phone clock in microseconds mod 2^32 (I), [work flag (B): 1 reads
+the slot counts from the database in the handler, as the parcel handlers do]
+
+Probe notification (little endian, 20 bytes, fits the default ATT MTU):
+    sequence number (I), the phone clock of the write echoed (I), server clock at WriteValue in microseconds mod 2^32
+    (I), handler start (I) and handler end (I) in microseconds after WriteValue
+
+Stages:
+    inbound    phone write -> WriteValue (radio, bluez, D-Bus)
+    dispatch   WriteValue -> handler start (executor queue, worker thread wake up)
+    handler    handler start -> handler end
+    outbound   handler end -> phone (main loop, D-Bus signal, bluez, radio)
+    round trip phone write -> notification received
+The clocks of the phone and the server are not synchronized: the clock offset is estimated from the fastest probe,
+assuming that its inbound and outbound legs took the same time.
+
+The log has one probe per line: <phone clock at the notification in microseconds> <notification in hex>
+
+    python -m boxee.latency <probe log>
+"""
+import sys
+import struct
+import logging
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+PROBE_REQUEST = struct.Struct('<II')
+PROBE_RESPONSE = struct.Struct('<IIIII')
+CLOCK_MASK = 0xffffffff
+STAGES = ('inbound', 'dispatch', 'handler', 'outbound', 'round trip')
+# the upper bounds of the histogram buckets in milliseconds (the last bucket is open)
+BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def clock_diff(later, earlier):
+    """
+    :return: the signed difference of two 32 bit microsecond clocks (correct across a wrap around)
+    """
+    diff = (later - earlier) & CLOCK_MASK
+    return diff - (CLOCK_MASK + 1) if diff > CLOCK_MASK // 2 else diff
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.values = []
+
+    def add(self, value_ms):
+        index = 0
+        while index < len(self.buckets) and value_ms > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.values.append(value_ms)
+
+    def percentile(self, percent):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(int(len(ordered) * percent / 100.0), len(ordered) - 1)]
+
+    def render(self, width=40):
+        lines = []
+        peak = max(self.counts) or 1
+        for index, count in enumerate(self.counts):
+            label = '<= %s ms' % self.buckets[index] if index < len(self.buckets) else '>  %s ms' % self.buckets[-1]
+            lines.append('  %-12s %6s %s' % (label, count, '#' * int(round(count * width / float(peak)))))
+        return '\n'.join(lines)
+
+
+def parse_log(lines):
+    """
+    :return: the (seq, sent, received at WriteValue, handler start, handler end, phone received) tuples of the probes
+    """
+    probes = []
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            phone_received, notification = line.split()
+            probes.append(PROBE_RESPONSE.unpack(notification.decode('hex')) + (int(phone_received) & CLOCK_MASK,))
+        except (ValueError, TypeError, struct.error) as e:
+            logger.warn('skipping line [%s]: %s', number + 1, str(e))
+    return probes
+
+
+def stage_latencies(probes):
+    """
+    :return: stage -> list of latencies in milliseconds
+    """
+    latencies = dict((stage, []) for stage in STAGES)
+    if not probes:
+        return latencies
+    # the fastest network legs give the clock offset (server clock - phone clock)
+    fastest = min(probes, key=lambda probe: clock_diff(probe[5], probe[1]) - probe[4])
+    offset = clock_diff(fastest[2], fastest[1]) - (clock_diff(fastest[5], fastest[1]) - fastest[4]) / 2.0
+    for seq, sent, received, start, end, phone_received in probes:
+        round_trip = clock_diff(phone_received, sent)
+        inbound = clock_diff(received, sent) - offset
+        for stage, value in zip(STAGES, (inbound, start, end - start, round_trip - end - inbound, round_trip)):
+            latencies[stage].append(value / 1000.0)
+    return latencies
+
+
+def report(probes):
+    """
+    :return: the histograms of the stages and the lost probes as text
+    """
+    lines = ['[%s] probes' % len(probes)]
+    if probes:
+        sequences = set(probe[0] for probe in probes)
+        lost = max(sequences) - min(sequences) + 1 - len(sequences)
+        lines[0] += ', [%s] lost (gaps in the sequence numbers)' % lost
+    latencies = stage_latencies(probes)
+    for stage in STAGES:
+        histogram = Histogram()
+        for value in latencies[stage]:
+            histogram.add(value)
+        if not histogram.values:
+            continue
+        lines.append('%s: p50 [%.2f] ms, p90 [%.2f] ms, p99 [%.2f] ms, max [%.2f] ms' % (
+            stage, histogram.percentile(50), histogram.percentile(90), histogram.percentile(99),
+            max(histogram.values)))
+        lines.append(histogram.render())
+    return '\n'.join(lines)
+
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: python -m boxee.latency <probe log>')
+        sys.exit(2)
+    logging.basicConfig(format='%(levelname)s - %(module)s.%(funcName)s: %(message)s')
+    with open(argv[0]) as log_file:
+        print(report(parse_log(log_file)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,157 @@
+__author__ = 'tamas'
+"""
+In-memory answers for the barcode lookups of the parcel release: most of the scanned barcodes are typos, parcels
+collected already or parcels of another locker, which should not cost a database query.
+
+A counting Bloom filter holds the barcodes of the stored parcels (a counter per cell instead of a bit, so a released
+parcel can be removed again); a barcode it does not contain is certainly not in the locker. The barcodes which passed
+the filter but were not found in the database (false positives, which get repeated by the users) are kept in a small
+LRU negative cache.
+"""
+import collections
+import hashlib
+import math
+import struct
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+SATURATED = 0xff
+
+
+class CountingBloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        :param capacity: the expected number of elements (the slot count)
+        :param error_rate: the false positive probability at capacity
+        """
+        capacity = max(capacity, 16)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.counters = bytearray(self.size)
+        self.count = 0
+
+    def _indexes(self, element):
+        if isinstance(element, unicode):
+            element = element.encode('utf-8')
+        # double hashing: the k indexes are derived from the two halves of one digest
+        first, second = struct.unpack('<QQ', hashlib.md5(element).digest())
+        return [(first + i * second) % self.size for i in xrange(self.hashes)]
+
+    def add(self, element):
+        for index in self._indexes(element):
+            if self.counters[index] < SATURATED:
+                self.counters[index] += 1
+        self.count += 1
+
+    def remove(self, element):
+        """
+        The element must have been added before, otherwise the counters of other elements are decremented
+        """
+        indexes = self._indexes(element)
+        if not all(self.counters[index] for index in indexes):
+            return
+        for index in indexes:
+            # a saturated counter does not know its real value any more, it stays
+            if self.counters[index] < SATURATED:
+                self.counters[index] -= 1
+        self.count -= 1
+
+    def __contains__(self, element):
+        return all(self.counters[index] for index in self._indexes(element))
+
+
+class BarcodeIndex(object):
+    """
+    The filter and the negative cache of the BoxManager; called from the worker threads.
+    """
+
+    def __init__(self, negative_cache_size=256, error_rate=0.01):
+        self.negative_cache_size = negative_cache_size
+        self.error_rate = error_rate
+        self.filter = None
+        self.negative = collections.OrderedDict()
+        # incremented by every add: a lookup which overlapped with a store must not cache its miss
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.filter_rejects = 0
+        self.negative_hits = 0
+        self.db_hits = 0
+        self.false_positives = 0
+
+    def rebuild(self, barcodes, capacity):
+        """
+        :param barcodes: the barcodes of the stored parcels
+        :param capacity: the number of slots
+        """
+        bloom = CountingBloomFilter(capacity, self.error_rate)
+        for barcode in barcodes:
+            bloom.add(barcode)
+        with self.lock:
+            self.filter = bloom
+            self.negative.clear()
+            self.generation += 1
+        logger.info('barcode filter rebuilt with [%s] barcodes, [%s] cells and [%s] hashes', bloom.count, bloom.size,
+                    bloom.hashes)
+
+    def add(self, barcode):
+        """
+        Called before the parcel is stored, so a concurrent release can not miss it
+        """
+        with self.lock:
+            self.generation += 1
+            self.negative.pop(barcode, None)
+            if self.filter is not None:
+                self.filter.add(barcode)
+
+    def remove(self, barcode):
+        with self.lock:
+            if self.filter is not None:
+                self.filter.remove(barcode)
+
+    def lookup(self, barcode):
+        """
+        :return: (absent, generation): absent is True if the barcode is certainly not stored; the generation has to be
+        passed to not_found after a database miss
+        """
+        with self.lock:
+            self.lookups += 1
+            if self.filter is not None and barcode not in self.filter:
+                self.filter_rejects += 1
+                return True, self.generation
+            if barcode in self.negative:
+                self.negative[barcode] = self.negative.pop(barcode)
+                self.negative_hits += 1
+                return True, self.generation
+            return False, self.generation
+
+    def found(self):
+        with self.lock:
+            self.db_hits += 1
+
+    def not_found(self, barcode, generation):
+        """
+        Records a database miss of a barcode which passed the filter
+        """
+        with self.lock:
+            self.false_positives += 1
+            if generation != self.generation:
+                return
+            self.negative[barcode] = True
+            if len(self.negative) > self.negative_cache_size:
+                self.negative.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'lookups': self.lookups, 'filter_rejects': self.filter_rejects,
+                    'negative_hits': self.negative_hits, 'db_hits': self.db_hits,
+                    'false_positives': self.false_positives}
+
+    def describe(self):
+        stats = self.stats()
+        saved = stats['filter_rejects'] + stats['negative_hits']
+        return ('[%(lookups)s] barcode lookups: [%(filter_rejects)s] rejected by the filter, [%(negative_hits)s] '
+                'answered by the negative cache, [%(db_hits)s] found, [%(false_positives)s] false positives' % stats +
+                ' ([%.1f%%] without database query)' % (100.0 * saved / stats['lookups'] if stats['lookups'] else 0))
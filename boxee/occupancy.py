@@ -0,0 +1,110 @@
+__author__ = 'tamas'
+"""
+In-memory occupancy map of the slots: one bit per slot (1: a parcel is stored), so 1000 slots fit into 125 bytes.
+The bytes changed since the last notification are tracked, so only the changed ranges have to be sent.
+
+Wire format (little endian):
+    full map (read):  0x00, slot count (H), bitmap bytes
+    delta (notify):   0x01, then per changed range: byte offset (H), length (B), bitmap bytes
+The bit of a slot is bit (n % 8) of byte (n / 8), where n is the position of the slot id in the ascending slot ids.
+"""
+import struct
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+FULL_MAP = 0x00
+DELTA = 0x01
+RANGE_HEADER = struct.Struct('<HB')
+# the smallest notification which carries a changed byte: the delta marker, a range header and one bitmap byte
+MIN_DELTA_SIZE = 1 + RANGE_HEADER.size + 1
+
+
+class OccupancyBitmap(object):
+    def __init__(self):
+        self.positions = dict()
+        self.bits = bytearray()
+        # the number of the full slots
+        self.used = 0
+        # the indexes of the bytes changed since the last delta
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def rebuild(self, rows):
+        """
+        :param rows: (slot_id, used, size, usage_count) rows as returned by BoxDao.fetch_slots
+        """
+        with self.lock:
+            slot_ids = sorted(row[0] for row in rows)
+            self.positions = dict((slot_id, position) for position, slot_id in enumerate(slot_ids))
+            self.bits = bytearray((len(slot_ids) + 7) // 8)
+            self.dirty = set()
+            self.used = 0
+            for row in rows:
+                if row[1] == 'T':
+                    position = self.positions[row[0]]
+                    self.bits[position // 8] |= 1 << (position % 8)
+                    self.used += 1
+        logger.info('occupancy map rebuilt with [%s] slots', len(self.positions))
+
+    def set(self, slot_id, used):
+        """
+        :return: True if this is the first change since the last delta (a flush has to be scheduled)
+        """
+        with self.lock:
+            position = self.positions.get(slot_id)
+            if position is None:
+                return False
+            index, mask = position // 8, 1 << (position % 8)
+            value = self.bits[index] | mask if used else self.bits[index] & ~mask
+            if value == self.bits[index]:
+                return False
+            self.bits[index] = value
+            self.used += 1 if used else -1
+            first = not self.dirty
+            self.dirty.add(index)
+            return first
+
+    def counts(self):
+        """
+        :return: a (free slots, all slots) tuple
+        """
+        with self.lock:
+            return len(self.positions) - self.used, len(self.positions)
+
+    def encode(self):
+        """
+        :return: the full map
+        """
+        with self.lock:
+            return str(bytearray([FULL_MAP]) + bytearray(struct.pack('<H', len(self.positions))) + self.bits)
+
+    def take_delta(self, max_size=20):
+        """
+        Collects the changed byte ranges and resets the change tracking
+        :param max_size: the maximum size of one notification (the ATT MTU - 3)
+        :return: the list of delta messages, each one at most max_size long (empty if nothing changed)
+        :raise ValueError: if max_size is smaller than MIN_DELTA_SIZE (no bitmap byte would fit into a message)
+        """
+        if max_size < MIN_DELTA_SIZE:
+            raise ValueError('a delta needs at least [%s] bytes, not [%s]' % (MIN_DELTA_SIZE, max_size))
+        with self.lock:
+            ranges = []
+            for index in sorted(self.dirty):
+                if ranges and ranges[-1][1] == index and ranges[-1][1] - ranges[-1][0] < 0xff:
+                    ranges[-1][1] = index + 1
+                else:
+                    ranges.append([index, index + 1])
+            self.dirty = set()
+            messages = []
+            message = None
+            for start, end in ranges:
+                while start < end:
+                    if message is None or len(message) + RANGE_HEADER.size >= max_size:
+                        message = bytearray([DELTA])
+                        messages.append(message)
+                    length = min(end - start, max_size - len(message) - RANGE_HEADER.size)
+                    message += RANGE_HEADER.pack(start, length) + self.bits[start:start + length]
+                    start += length
+            return [str(message) for message in messages]
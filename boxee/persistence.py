@@ -1,11 +1,16 @@
 import sqlite3
+import contextlib
 import logging
+import threading
 import traceback
 
 __author__ = 'tamas'
 
 logger = logging.getLogger(__name__)
 
+# UPDATE ... RETURNING is supported from sqlite 3.35
+RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
 
 # http://zetcode.com/db/sqlitepythontutorial/
 # http://www.scadacore.com/field-applications/programming-calculators/online-hex-converter
@@ -16,41 +21,206 @@ class PersistenceException(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
-class BoxDao:
+class ConnectionManager:
     """
-    The data access object for the box locker
+    One writer connection, shared by the threads and serialized by the lock, and a read only connection for every
+    thread which reads. In WAL mode each read runs in its own snapshot: the readers never wait for the writer nor for
+    each other, so the metrics, the audit reads and the backups can run off the main loop in parallel.
     """
 
-    def __init__(self, box_range, current_folder):
-        self.connection = None
+    def __init__(self, path, timeout=5.0):
+        """
+        :param path: the database file
+        :param timeout: the seconds a connection waits for a lock held by another connection
+        """
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.writer = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.local = threading.local()
+        # every reader connection, so that they can be closed from any thread
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.wal = False
+
+    def enable_wal(self):
+        """
+        Switches the database to the WAL journal mode (kept by the database file); falls back to the rollback journal
+        where WAL is not supported (eg. on some network file systems)
+        """
+        with self.lock:
+            mode = self.writer.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            self.wal = mode.lower() == 'wal'
+        if not self.wal:
+            logger.warn('the [%s] journal mode is used, the readers may wait for the writer', mode)
+
+    def reader(self):
+        """
+        :return: the read only connection of the current thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit mode: the read transactions are started explicitly by reading
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA query_only=1')
+            self.local.connection = connection
+            with self.readers_lock:
+                self.readers.append(connection)
+            logger.debug('reader connection opened for [%s]', threading.current_thread().name)
+        return connection
+
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        A new cursor of the reader connection of the current thread; the statements see one consistent snapshot
+        """
+        cursor = self.reader().cursor()
         try:
-            logger.info("Creating Box DB at: " + current_folder + "/boxee.db")
-            self.connection = sqlite3.connect(current_folder + "/boxee.db")
-            self.cursor = self.connection.cursor()
-            self.cursor.executescript("""
-              create table if not exists locker(id integer primary key autoincrement, slot_id int not null, used char(1) not null, barcode text not null);
-              create unique index if not exists uq_sl on locker (slot_id);
-              """)
-            # create unique index if not exists uq_brc on locker (barcode);
-            init_pieces = []
-            for box in box_range:
-                init_pieces.append(
-                    "insert into locker(slot_id, used, barcode) select {0},'F','' where not exists (select 1 from locker where slot_id={0});".format(
-                        box))
-            init_string = ''.join(init_pieces)
-            ## if not exists
-            logger.debug('Initializing data: [%s]', init_string)
-            self.cursor.executescript(init_string)
-            self.connection.commit()
+            cursor.execute('BEGIN')
+            try:
+                yield cursor
+            finally:
+                cursor.execute('COMMIT')
+        except PersistenceException:
+            raise
         except BaseException as e:
-            traceback.print_exc()
-            logger.error('Error while initializing database: %s', str(e))
-            if self.connection:
-                self.connection.rollback()
-                logger.warn('closing connection due to previous error.')
-                self.connection.close()
+            raise PersistenceException(str(e))
         finally:
-            pass
+            cursor.close()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        A new cursor of the writer connection; the transaction is committed at the end, or rolled back on error
+        """
+        with self.lock:
+            cursor = self.writer.cursor()
+            try:
+                yield cursor
+                self.writer.commit()
+            except BaseException as e:
+                self.writer.rollback()
+                if isinstance(e, PersistenceException):
+                    raise
+                raise PersistenceException(str(e))
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self.readers_lock:
+            for connection in self.readers:
+                connection.close()
+            del self.readers[:]
+        self.local = threading.local()
+        with self.lock:
+            self.writer.close()
+
+
+class BoxDao:
+    """
+    The data access object for the box locker. The writes of the main loop and the executor's worker threads are
+    serialized on the writer connection, the reads run on the reader connection of the calling thread (see
+    ConnectionManager). Every operation creates its own cursor.
+    """
+
+    def __init__(self, box_range, current_folder, deferred_init=False):
+        """
+        :param box_range: the slot ids of the locker
+        :param current_folder: the folder of the boxee.db file
+        :param deferred_init: only open the connection; the schema and the slots are created by initialize (eg. in the
+        background once the server is advertising)
+        """
+        self.box_range = box_range
+        self.path = current_folder + "/boxee.db"
+        logger.info("Creating Box DB at: " + self.path)
+        self.connections = ConnectionManager(self.path)
+        self.connection = self.connections.writer
+        self.lock = self.connections.lock
+        if not deferred_init:
+            self.initialize()
+
+    def initialize(self):
+        """
+        Creates (or migrates) the locker and the replication outbox tables and inserts the missing slots
+        """
+        with self.lock:
+            try:
+                self.connections.enable_wal()
+                cursor = self.connection.cursor()
+                cursor.executescript("""
+                  create table if not exists locker(id integer primary key autoincrement, slot_id int not null, used char(1) not null, barcode text not null, size int not null default 0, usage_count int not null default 0);
+                  create unique index if not exists uq_sl on locker (slot_id);
+                  create table if not exists outbox(seq integer primary key autoincrement, slot_id int not null, used char(1) not null, barcode text not null, created real not null);
+                  """)
+                self.migrate_locker_columns(cursor)
+                # covering index: the slot allocator is rebuilt from the index only
+                cursor.execute('create index if not exists ix_alloc on locker (slot_id, used, size, usage_count)')
+                # create unique index if not exists uq_brc on locker (barcode);
+                # every state change of a slot is queued for the replication in the same transaction, whichever
+                # statement makes it
+                cursor.execute("""
+                  create trigger if not exists tr_outbox after update of used, barcode on locker
+                  when old.used != new.used or old.barcode != new.barcode
+                  begin
+                    insert into outbox(slot_id, used, barcode, created)
+                    values (new.slot_id, new.used, new.barcode, (julianday('now') - 2440587.5) * 86400.0);
+                  end""")
+                logger.debug('Initializing slots: %s', self.box_range)
+                cursor.executemany("insert or ignore into locker(slot_id, used, barcode) values (?, 'F', '')",
+                                   [(box,) for box in self.box_range])
+                self.connection.commit()
+            except BaseException as e:
+                traceback.print_exc()
+                logger.error('Error while initializing database: %s', str(e))
+                self.connection.rollback()
+                raise PersistenceException(str(e))
+
+    def migrate_locker_columns(self, cursor):
+        """
+        Adds the size and usage_count columns to a locker table created by an older version
+        """
+        cursor.execute('PRAGMA table_info(locker)')
+        columns = [row[1] for row in cursor.fetchall()]
+        for column in ('size', 'usage_count'):
+            if column not in columns:
+                logger.info('adding column [%s] to the locker table', column)
+                cursor.execute('alter table locker add column {0} int not null default 0'.format(column))
+
+    def define_slot_sizes(self, slot_sizes):
+        """
+        Sets the size class of the slots (see boxee.allocation)
+        :param slot_sizes: slot_id -> size class dictionary
+        """
+        with self.connections.writing() as cursor:
+            cursor.executemany('UPDATE locker SET size=? WHERE slot_id=?',
+                               [(size, slot_id) for slot_id, size in slot_sizes.iteritems()])
+
+    def fetch_slots(self):
+        """
+        Returns the allocation state of every slot;\n
+        :return: a list of (slot_id, used, size, usage_count) rows
+        """
+        with self.connections.reading() as cursor:
+            cursor.execute('SELECT slot_id, used, size, usage_count FROM locker')
+            return cursor.fetchall()
+
+    def fetch_barcodes(self):
+        """
+        :return: the barcodes of the stored parcels
+        """
+        with self.connections.reading() as cursor:
+            cursor.execute("SELECT barcode FROM locker WHERE used='T'")
+            return [row[0] for row in cursor.fetchall()]
+
+    def count_slots(self):
+        """
+        :return: a (free slots, all slots) tuple
+        """
+        with self.connections.reading() as cursor:
+            cursor.execute("SELECT count(*), coalesce(sum(used='F'), 0) FROM locker")
+            total, free = cursor.fetchone()
+        return free, total
 
     def fetch_empty_slots(self):
         """
@@ -58,16 +228,13 @@ class BoxDao:
         Runs the query: select slot_id from locker where used=F;\n
         :return: the rows found (can be iterated) and referred to by row[0] or row['slot_id']. If nothing found None is returned;
         """
-        try:
-            self.cursor.execute('SELECT slot_id FROM locker WHERE used=?', 'F')
-            self.connection.commit()
-            rows = self.cursor.fetchall()
-            if len(rows) == 0:
-                return None
-            else:
-                return rows
-        except BaseException as e:
-            raise PersistenceException(str(e))
+        with self.connections.reading() as cursor:
+            cursor.execute('SELECT slot_id FROM locker WHERE used=?', 'F')
+            rows = cursor.fetchall()
+        if len(rows) == 0:
+            return None
+        else:
+            return rows
 
     def fetch_slot_by_barcode(self, barcode):
         """
@@ -76,9 +243,9 @@ class BoxDao:
         :return: the slot_id which can be than opened
         """
         try:
-            self.cursor.execute('SELECT slot_id FROM locker WHERE barcode = ?', [barcode])
-            self.connection.commit()
-            row = self.cursor.fetchone()
+            with self.connections.reading() as cursor:
+                cursor.execute('SELECT slot_id FROM locker WHERE barcode = ?', [barcode])
+                row = cursor.fetchone()
             if row is None or len(row) == 0:
                 logger.debug(
                     'fetching by barcode [%s] with return-row-size [0] (= not found). Slot ID: -1 will be returned.',
@@ -91,6 +258,118 @@ class BoxDao:
             logger.error('could not fetch row by barcode due to: %s', str(e))
             raise PersistenceException(str(e))
 
+    def reserve_slot(self, barcode):
+        """
+        Atomically claims the lowest free slot for the parcel identified by barcode: the slot is marked as used in the
+        same statement which selects it, so two concurrent stores can never be assigned the same slot.
+        :param barcode: the parcel identifier
+        :return: the claimed slot_id or -1 if there are no free slots
+        """
+        logger.debug('reserving slot for barcode [%s]', barcode)
+        with self.connections.writing() as cursor:
+            if RETURNING_SUPPORTED:
+                cursor.execute(
+                    "UPDATE locker SET used='T', barcode=?, usage_count=usage_count+1 WHERE used='F' AND slot_id = "
+                    "(SELECT slot_id FROM locker WHERE used='F' ORDER BY slot_id LIMIT 1) RETURNING slot_id",
+                    [barcode])
+                row = cursor.fetchone()
+            else:
+                # older sqlite: the select and the guarded update are executed in one immediate transaction
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute("SELECT slot_id FROM locker WHERE used='F' ORDER BY slot_id LIMIT 1")
+                row = cursor.fetchone()
+                if row is not None:
+                    cursor.execute("UPDATE locker SET used='T', barcode=?, usage_count=usage_count+1 "
+                                   "WHERE slot_id=? AND used='F'", [barcode, row[0]])
+        if row is None:
+            logger.debug('no free slot could be reserved for barcode [%s]', barcode)
+            return -1
+        logger.debug('slot [%s] reserved for barcode [%s]', row[0], barcode)
+        return row[0]
+
+    def claim_slot(self, slot_id, barcode):
+        """
+        Marks the slot chosen by the slot allocator as used, provided that it is still free
+        :param slot_id: the slot selected for the parcel
+        :param barcode: the parcel identifier
+        :return: True if the slot was claimed, False if it is not free any more
+        """
+        with self.connections.writing() as cursor:
+            cursor.execute("UPDATE locker SET used='T', barcode=?, usage_count=usage_count+1 "
+                           "WHERE slot_id=? AND used='F'", [barcode, slot_id])
+            claimed = cursor.rowcount == 1
+        logger.debug('claiming slot [%s] for barcode [%s]: [%s]', slot_id, barcode, claimed)
+        return claimed
+
+    def unclaim_slot(self, slot_id):
+        """
+        Undoes a claim (eg. the slot could not be opened): the slot is freed and its usage count is decremented in the
+        same statement, so the usage count stays in line with the slot allocator
+        :param slot_id: the slot claimed for the parcel
+        """
+        self.unclaim_slots([slot_id])
+
+    def unclaim_slots(self, slot_ids):
+        """
+        Undoes the claim of several slots in one transaction (see unclaim_slot)
+        :param slot_ids: the slots claimed for the parcels
+        """
+        logger.debug('unclaiming slots %s', slot_ids)
+        with self.connections.writing() as cursor:
+            cursor.executemany("UPDATE locker SET used='F', barcode='', usage_count=usage_count-1 "
+                               "WHERE slot_id=? AND used='T'", [(slot_id,) for slot_id in slot_ids])
+
+    def reserve_slots(self, barcodes):
+        """
+        Claims the lowest free slots for several parcels in one transaction
+        :param barcodes: the parcel identifiers
+        :return: the list of claimed slot ids in the order of the barcodes; -1 where no free slot was left
+        """
+        with self.connections.writing() as cursor:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT slot_id FROM locker WHERE used='F' ORDER BY slot_id LIMIT ?", [len(barcodes)])
+            slot_ids = [row[0] for row in cursor.fetchall()]
+            cursor.executemany("UPDATE locker SET used='T', barcode=?, usage_count=usage_count+1 "
+                               "WHERE slot_id=? AND used='F'", zip(barcodes, slot_ids))
+        logger.debug('slots %s reserved for barcodes %s', slot_ids, barcodes)
+        return slot_ids + [-1] * (len(barcodes) - len(slot_ids))
+
+    def claim_slots(self, assignments):
+        """
+        Marks several slots chosen by the slot allocator as used in one transaction; slots which are not free any more
+        are left untouched
+        :param assignments: a list of (slot_id, barcode) tuples
+        :return: the set of slot ids which were claimed
+        """
+        if not assignments:
+            return set()
+        with self.connections.writing() as cursor:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT slot_id FROM locker WHERE used='F' AND slot_id IN ({0})".format(
+                ','.join('?' * len(assignments))), [slot_id for slot_id, _ in assignments])
+            free = set(row[0] for row in cursor.fetchall())
+            cursor.executemany("UPDATE locker SET used='T', barcode=?, usage_count=usage_count+1 WHERE slot_id=?",
+                               [(barcode, slot_id) for slot_id, barcode in assignments if slot_id in free])
+        return free
+
+    def release_slots(self, barcodes):
+        """
+        Looks up and frees the slots of several parcels in one transaction
+        :param barcodes: the parcel identifiers
+        :return: barcode -> slot_id dictionary of the parcels found (and released)
+        """
+        if not barcodes:
+            return dict()
+        with self.connections.writing() as cursor:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT barcode, slot_id FROM locker WHERE used='T' AND barcode IN ({0})".format(
+                ','.join('?' * len(barcodes))), list(barcodes))
+            found = dict(cursor.fetchall())
+            cursor.executemany("UPDATE locker SET used='F', barcode='' WHERE slot_id=?",
+                               [(slot_id,) for slot_id in found.itervalues()])
+        logger.debug('released slots by barcode: %s', found)
+        return found
+
     def update_box(self, slot_id, used=False, barcode=''):
         """
         Updates the slot information (used or not, and if used what is the parcel identifier barcode)
@@ -99,28 +378,73 @@ class BoxDao:
         :param barcode: the parcel identifier
         :return:
         """
-        try:
-            logger.debug('updating box with slot id [%s] used [%s] and barcode [%s]', slot_id, used, barcode)
-            self.cursor.execute(
-                "update locker set used='{0}', barcode='{1}' where slot_id='{2}';".format('T' if used else 'F', barcode,
-                                                                                          slot_id))
-            self.connection.commit()
-        except BaseException as e:
-            self.connection.rollback()
-            raise PersistenceException(str(e))
+        logger.debug('updating box with slot id [%s] used [%s] and barcode [%s]', slot_id, used, barcode)
+        with self.connections.writing() as cursor:
+            cursor.execute('UPDATE locker SET used=?, barcode=? WHERE slot_id=?',
+                           ['T' if used else 'F', barcode, slot_id])
+            updated = cursor.rowcount
 
-        if self.cursor.rowcount == 0:
+        if updated == 0:
             issue = 'the updated row count is 0'
             logger.error(issue)
             raise PersistenceException(issue)
 
 
+    def fetch_outbox(self, limit):
+        """
+        :param limit: the maximum number of changes returned
+        :return: the oldest (seq, slot_id, used, barcode, created) rows of the outbox
+        """
+        with self.connections.reading() as cursor:
+            cursor.execute('SELECT seq, slot_id, used, barcode, created FROM outbox ORDER BY seq LIMIT ?', [limit])
+            return cursor.fetchall()
+
+    def fetch_snapshot(self):
+        """
+        :return: (the last outbox sequence number, the (slot_id, used, barcode) rows of every slot), read consistently
+        """
+        with self.connections.reading() as cursor:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='outbox'")
+            row = cursor.fetchone()
+            cursor.execute('SELECT slot_id, used, barcode FROM locker ORDER BY slot_id')
+            rows = cursor.fetchall()
+        return (row[0] if row else 0), rows
+
+    def trim_outbox(self, seq=None, keep=None):
+        """
+        Deletes the replicated (or the too old) changes
+        :param seq: the changes up to this sequence number are deleted
+        :param keep: only this many of the newest changes are kept
+        """
+        with self.connections.writing() as cursor:
+            if seq is not None:
+                cursor.execute('DELETE FROM outbox WHERE seq <= ?', [seq])
+            if keep is not None:
+                cursor.execute('DELETE FROM outbox WHERE seq <= (SELECT max(seq) FROM outbox) - ?', [keep])
+
     def destroy(self):
         """
-        Closes the connection
+        Closes the writer and the reader connections
         :return:
         """
         logger.info('destroying %s', __name__)
-        self.connection.close()
+        self.connections.close()
 
 # insert into slot(slot_id, used, barcode) values (18,'T','abrakadabra');
+
+
+STORAGE_ENGINES = ('sqlite', 'slotfile')
+
+
+def create_dao(engine, box_range, current_folder, deferred_init=False):
+    """
+    :param engine: sqlite (BoxDao) or slotfile (slotstore.SlotFileDao: memory mapped slot table and change log; the
+    barcodes are limited to 64 bytes)
+    :return: the data access object of the locker
+    """
+    if engine == 'sqlite':
+        return BoxDao(box_range, current_folder, deferred_init)
+    if engine == 'slotfile':
+        from slotstore import SlotFileDao
+        return SlotFileDao(box_range, current_folder, deferred_init)
+    raise ValueError('unknown storage engine [%s], choose one of %s' % (engine, list(STORAGE_ENGINES)))
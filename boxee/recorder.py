@@ -0,0 +1,147 @@
+"""
+Records the incoming GATT traffic (ReadValue, WriteValue, StartNotify, StopNotify) and the device connection signals
+into a compact binary log, which can be replayed offline by boxee.replay.
+
+Log format (little endian):
+    header: 'BXRC', version (B), wall clock time of the start (d)
+    record: offset from the start in seconds (d), event (B), path id (H), payload length (H), payload
+The object paths are written once, by an EVENT_PATH record assigning the path id; the later records only refer to it.
+"""
+import struct
+import threading
+import time
+import logging
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+MAGIC = 'BXRC'
+VERSION = 1
+HEADER = struct.Struct('<4sBd')
+RECORD = struct.Struct('<dBHH')
+
+EVENT_PATH = 0
+EVENT_READ = 1
+EVENT_WRITE = 2
+EVENT_START_NOTIFY = 3
+EVENT_STOP_NOTIFY = 4
+EVENT_CONNECTED = 5
+EVENT_DISCONNECTED = 6
+
+METHOD_EVENTS = {
+    'ReadValue': EVENT_READ,
+    'WriteValue': EVENT_WRITE,
+    'StartNotify': EVENT_START_NOTIFY,
+    'StopNotify': EVENT_STOP_NOTIFY
+}
+EVENT_NAMES = dict((event, name) for name, event in METHOD_EVENTS.iteritems())
+EVENT_NAMES.update({EVENT_PATH: 'path', EVENT_CONNECTED: 'connected', EVENT_DISCONNECTED: 'disconnected'})
+
+# the active recorder; None while recording is off, so the hooks cost a single global lookup
+recorder = None
+
+
+class TrafficRecorder:
+    def __init__(self, file_name, flush_interval=1.0):
+        """
+        :param file_name: the log file (overwritten)
+        :param flush_interval: the buffered records are flushed at most this many seconds apart
+        """
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self.log_file = open(file_name, 'wb')
+        self.started = time.time()
+        self.last_flush = self.started
+        self.paths = dict()
+        self.records = 0
+        # the D-Bus handlers and the worker threads may record at the same time
+        self.lock = threading.Lock()
+        self.log_file.write(HEADER.pack(MAGIC, VERSION, self.started))
+
+    def record(self, event, path, payload=''):
+        """
+        :param event: one of the EVENT_ constants
+        :param path: the object path (characteristic or device)
+        :param payload: the raw bytes of the value (a str)
+        """
+        now = time.time()
+        with self.lock:
+            if self.log_file is None:
+                return
+            path_id = self.paths.get(path)
+            if path_id is None:
+                path_id = len(self.paths)
+                self.paths[path] = path_id
+                self._write(now, EVENT_PATH, path_id, str(path))
+            self._write(now, event, path_id, payload[:0xffff])
+            self.records += 1
+            if now - self.last_flush >= self.flush_interval:
+                self.log_file.flush()
+                self.last_flush = now
+
+    def _write(self, now, event, path_id, payload):
+        self.log_file.write(RECORD.pack(now - self.started, event, path_id, len(payload)))
+        if payload:
+            self.log_file.write(payload)
+
+    def record_message(self, path, message):
+        """
+        Records an incoming D-Bus method call (only the GATT methods are recorded)
+        :type message: dbus.lowlevel.MethodCallMessage
+        """
+        event = METHOD_EVENTS.get(message.get_member())
+        if event is None:
+            return
+        payload = ''
+        if event == EVENT_WRITE:
+            args = message.get_args_list(byte_arrays=True)
+            if args:
+                payload = str(args[0])
+        self.record(event, path, payload)
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+        logger.info('[%s] records written to [%s]', self.records, self.file_name)
+
+
+def start_recording(file_name):
+    global recorder
+    recorder = TrafficRecorder(file_name)
+    logger.info('Recording the GATT traffic into [%s]', file_name)
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        active, recorder = recorder, None
+        active.close()
+
+
+def read_log(file_name):
+    """
+    :return: generator of (offset in seconds, event, path, payload) tuples; the path records are resolved
+    """
+    with open(file_name, 'rb') as log_file:
+        header = log_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('[%s] is not a traffic log' % file_name)
+        magic, version, started = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('[%s] is not a traffic log (version %s)' % (file_name, VERSION))
+        paths = dict()
+        while True:
+            head = log_file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                # the end, or a record cut short by a crash
+                break
+            offset, event, path_id, length = RECORD.unpack(head)
+            payload = log_file.read(length) if length else ''
+            if len(payload) < length:
+                break
+            if event == EVENT_PATH:
+                paths[path_id] = payload
+            else:
+                yield offset, event, paths.get(path_id), payload
@@ -0,0 +1,296 @@
+"""
+Replays a traffic log written by the recorder (boxee.py -r) against the GATT services, offline: the services are
+exported on a fake bus (no bus daemon, no bluez), the slots are opened on a fake GPIO and the database lives in a
+temporary folder. The events are fed at the recorded pace (optionally sped up) or as fast as possible, and the
+latencies of the handlers are reported.
+
+    python -m boxee.replay [-m] [-s <speed factor>] [-g <gatt profile>] <traffic log>
+"""
+import sys
+import getopt
+import logging
+import shutil
+import tempfile
+import time
+import collections
+import dbus
+import gobject
+import boxee.executor
+import boxee.gpio
+import boxee.persistence
+import boxee.allocation
+from boxee import recorder
+from boxee.schema import GattSchema
+from boxee.io_service import AutomationIOService
+from boxee.box_service import BoxService
+from boxee.executor import MainLoopExecutor
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+class FakeBus(object):
+    """
+    Stands in for the dbus.SystemBus connection of dbus.service.Object: the objects are exported into a dict and the
+    emitted signals are handed to a listener instead of the bus daemon
+    """
+
+    def __init__(self, listener=None):
+        """
+        :param listener: called with (path, member) for every emitted signal (eg. PropertiesChanged)
+        """
+        self.objects = dict()
+        self.signals = 0
+        self.listener = listener
+
+    def _register_object_path(self, path, on_message, on_unregister=None, fallback=False):
+        self.objects[path] = on_message
+
+    def _unregister_object_path(self, path):
+        self.objects.pop(path, None)
+
+    def send_message(self, message):
+        self.signals += 1
+        if self.listener is not None:
+            self.listener(message.get_path(), message.get_member())
+
+
+class FakeGPIO(object):
+    """
+    The subset of RPi.GPIO used by the GpioConnector; counts the latch pulses
+    """
+    RPI_INFO = {'TYPE': 'replay'}
+    BCM = 11
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.mode = None
+        self.levels = dict()
+        self.pulses = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def setup(self, channels, direction):
+        for channel in (channels if isinstance(channels, list) else [channels]):
+            self.levels[channel] = self.LOW
+
+    def output(self, channel, level):
+        if level == self.HIGH and self.levels.get(channel) != self.HIGH:
+            self.pulses += 1
+        self.levels[channel] = level
+
+    def cleanup(self):
+        self.levels = dict()
+
+
+class LatencyStats:
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+
+    def add(self, latency_ms):
+        self.samples.append(latency_ms)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def describe(self):
+        return '%6d calls %4d errors  p50 %8.2f  p95 %8.2f  p99 %8.2f  max %8.2f ms' % (
+            len(self.samples), self.errors, self.percentile(0.5), self.percentile(0.95), self.percentile(0.99),
+            max(self.samples) if self.samples else 0.0)
+
+
+class ReplayDriver:
+    def __init__(self, events, characteristics, executor, speed=1.0):
+        """
+        :param events: the (offset, event, path, payload) tuples of the traffic log
+        :param characteristics: object path -> characteristic
+        :param executor: the executor of the deferred characteristics (drained at the end)
+        :param speed: the replay speed factor (None: as fast as possible)
+        :type executor: MainLoopExecutor
+        """
+        self.events = iter(events)
+        self.characteristics = characteristics
+        self.executor = executor
+        self.speed = speed
+        self.stats = collections.defaultdict(LatencyStats)
+        # path -> the start times of the acknowledged writes, completed by their notification
+        self.pending_completions = collections.defaultdict(collections.deque)
+        self.outstanding = 0
+        self.max_lag = 0.0
+        self.sessions = set()
+        self.max_sessions = 0
+        self.unknown_paths = set()
+        self.started = None
+        self.finished = None
+        self.mainloop = None
+
+    def run(self):
+        self.mainloop = gobject.MainLoop()
+        self.started = time.time()
+        gobject.idle_add(self.next_event)
+        self.mainloop.run()
+        return time.time() - self.started
+
+    def next_event(self):
+        for offset, event, path, payload in self.events:
+            if self.speed is None:
+                self.dispatch(event, path, payload)
+                gobject.idle_add(self.next_event)
+                return False
+            delay = self.started + offset / self.speed - time.time()
+            if delay > 0.001:
+                gobject.timeout_add(int(delay * 1000), self.timed_event_cb, offset, event, path, payload)
+                return False
+            self.max_lag = max(self.max_lag, -delay * 1000)
+            self.dispatch(event, path, payload)
+        # all the events are fed, wait for the deferred operations
+        self.finished = time.time()
+        gobject.timeout_add(50, self.drain_cb)
+        return False
+
+    def timed_event_cb(self, offset, event, path, payload):
+        self.max_lag = max(self.max_lag, (time.time() - self.started - offset / self.speed) * 1000)
+        self.dispatch(event, path, payload)
+        gobject.idle_add(self.next_event)
+        return False
+
+    def drain_cb(self):
+        if self.executor.pending or self.outstanding:
+            return True
+        self.mainloop.quit()
+        return False
+
+    def dispatch(self, event, path, payload):
+        if event in (recorder.EVENT_CONNECTED, recorder.EVENT_DISCONNECTED):
+            if event == recorder.EVENT_CONNECTED:
+                self.sessions.add(path)
+            else:
+                self.sessions.discard(path)
+            self.max_sessions = max(self.max_sessions, len(self.sessions))
+            return
+        chrc = self.characteristics.get(path)
+        if chrc is None:
+            self.unknown_paths.add(path)
+            return
+        name = recorder.EVENT_NAMES[event]
+        args = ()
+        if event == recorder.EVENT_WRITE:
+            args = (dbus.Array([dbus.Byte(ord(c)) for c in payload], signature='y'),)
+        method = getattr(chrc, {recorder.EVENT_READ: 'ReadValue', recorder.EVENT_WRITE: 'WriteValue',
+                                recorder.EVENT_START_NOTIFY: 'StartNotify',
+                                recorder.EVENT_STOP_NOTIFY: 'StopNotify'}[event])
+        stats = self.stats[name]
+        started = time.time()
+        if event == recorder.EVENT_WRITE:
+            self.pending_completions[path].append(started)
+        if getattr(method, '_dbus_async_callbacks', None):
+            self.outstanding += 1
+
+            def replied(*result):
+                self.outstanding -= 1
+                stats.add((time.time() - started) * 1000)
+
+            def failed(error):
+                self.outstanding -= 1
+                stats.errors += 1
+
+            method(*args, reply_handler=replied, error_handler=failed)
+        else:
+            try:
+                method(*args)
+                stats.add((time.time() - started) * 1000)
+            except BaseException:
+                stats.errors += 1
+
+    def signal_cb(self, path, member):
+        """
+        A notification completes the oldest acknowledged write on the characteristic
+        """
+        waiting = self.pending_completions.get(path)
+        if member == 'PropertiesChanged' and waiting:
+            self.stats['write completion'].add((time.time() - waiting.popleft()) * 1000)
+
+    def report(self, duration, recorded):
+        lines = ['replayed [%.2f] s of traffic in [%.2f] s, max schedule lag [%.2f] ms, max sessions [%s]' % (
+            recorded, duration, self.max_lag, self.max_sessions)]
+        for name in sorted(self.stats):
+            lines.append('%-18s %s' % (name, self.stats[name].describe()))
+        if self.unknown_paths:
+            lines.append('unknown object paths (other GATT profile?): %s' % sorted(self.unknown_paths))
+        return '\n'.join(lines)
+
+
+def usage():
+    print ('Usage: python -m boxee.replay [options] <traffic log>')
+    print ('\t -h --help \t list all command line options')
+    print ('\t -m --max-speed \t feeds the events as fast as possible')
+    print ('\t -s --speed <factor> \t replays faster (2) or slower (0.5) than recorded')
+    print ('\t -g --gatt-profile <file> \t the GATT profile of the recording server')
+
+
+def main(argv):
+    speed = 1.0
+    gatt_profile = None
+    try:
+        opts, args = getopt.getopt(argv, "hms:g:", ["help", "max-speed", "speed=", "gatt-profile="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-m', '--max-speed'):
+            speed = None
+        elif opt in ('-s', '--speed'):
+            speed = float(arg)
+        elif opt in ('-g', '--gatt-profile'):
+            gatt_profile = arg
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+    logging.basicConfig(format='%(levelname)s - %(module)s.%(funcName)s: %(message)s', level=logging.WARNING)
+
+    events = list(recorder.read_log(args[0]))
+    print('[%s] events loaded from [%s]' % (len(events), args[0]))
+    db_folder = tempfile.mkdtemp(prefix='boxee-replay')
+    executor = None
+    box_dao = None
+    try:
+        boxee.executor.init_threads()
+        boxee.gpio.GPIO = FakeGPIO()
+        gpio = boxee.gpio.GpioConnector(out_channels=[17, 18])
+        box_dao = boxee.persistence.BoxDao(range(17, 19), db_folder)
+        executor = MainLoopExecutor(workers=4, max_pending=64)
+        schema = GattSchema.load(gatt_profile) if gatt_profile is not None else GattSchema()
+        bus = FakeBus()
+        services = [AutomationIOService(bus, schema.service('automation_io'),
+                                        lambda signal: gpio.handle_out_channel_control_array(signal.values()[0])),
+                    BoxService(box_dao, gpio, bus, schema.service('box'), executor,
+                               boxee.allocation.create_allocator('wear'))]
+        characteristics = dict((chrc.path, chrc) for service in services for chrc in service.get_characteristics())
+        driver = ReplayDriver(events, characteristics, executor, speed)
+        bus.listener = driver.signal_cb
+        duration = driver.run()
+        print(driver.report(duration, events[-1][0] if events else 0))
+        print('GPIO latch pulses: [%s], signals emitted: [%s]' % (boxee.gpio.GPIO.pulses, bus.signals))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if box_dao is not None:
+            box_dao.destroy()
+        shutil.rmtree(db_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
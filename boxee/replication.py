@@ -0,0 +1,333 @@
+"""
+Replicates the slot states of the locker to a central store. Every change of the locker table is queued in the outbox
+table by a trigger, in the same transaction as the change itself (see BoxDao.initialize); the OutboxShipper sends the
+queued changes in zlib compressed JSON batches to an HTTP or unix socket endpoint from a background thread.
+
+Every change carries its outbox sequence number, so a batch which was delivered but not acknowledged can be sent
+again: the receiver applies only the changes newer than its last sequence number. A receiver which has no state of the
+locker yet, or which missed changes (eg. the outbox was trimmed while the endpoint was unreachable), asks for a
+snapshot of every slot.
+
+    request:  {'locker': 1, 'kind': 'delta', 'after': 41, 'changes': [[42, slot_id, 'T', barcode, created], ...]}
+              {'locker': 1, 'kind': 'snapshot', 'seq': 57, 'slots': [[slot_id, 'F', ''], ...]}
+    response: {'seq': 57} or {'seq': 0, 'resync': true}
+
+The MirrorStore is a stand-in receiver for the tests and the development:
+
+    python -m boxee.replication [-p <http port>] [-u <unix socket>]
+"""
+import sys
+import os
+import getopt
+import json
+import zlib
+import socket
+import struct
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+import logging
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+# the length prefix of the messages on the unix socket
+FRAME = struct.Struct('!I')
+
+
+def decode(body):
+    return json.loads(zlib.decompress(body))
+
+
+class HttpTransport:
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, body):
+        """
+        :param body: the compressed request
+        :return: the (uncompressed) JSON response
+        """
+        request = urllib2.Request(self.url, body, {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+class UnixSocketTransport:
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+
+    def send(self, body):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(FRAME.pack(len(body)) + body)
+            return read_frame(sock.makefile('rb'))
+        finally:
+            sock.close()
+
+
+def read_frame(stream):
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        raise IOError('connection closed')
+    length = FRAME.unpack(header)[0]
+    body = stream.read(length)
+    if len(body) < length:
+        raise IOError('connection closed in the middle of a message')
+    return body
+
+
+def create_transport(endpoint):
+    """
+    :param endpoint: an http(s):// URL or unix:<socket path>
+    :raise ValueError: if the endpoint is not supported
+    """
+    if endpoint.startswith('http://') or endpoint.startswith('https://'):
+        return HttpTransport(endpoint)
+    if endpoint.startswith('unix:'):
+        return UnixSocketTransport(endpoint[len('unix:'):])
+    raise ValueError('unsupported replication endpoint [%s] (http://... or unix:<path>)' % endpoint)
+
+
+class OutboxShipper:
+    def __init__(self, box_dao, locker_id, transport, interval=15.0, batch_size=500, max_backlog=10000,
+                 max_retry_interval=300.0):
+        """
+        :param locker_id: the identifier of the locker in the central store
+        :param interval: the seconds between two shipments (the changes are batched meanwhile)
+        :param batch_size: the maximum number of changes in one request
+        :param max_backlog: while the endpoint is not reachable only this many changes are kept in the outbox; the
+        receiver gets a snapshot instead of the dropped ones
+        :param max_retry_interval: the upper limit of the backoff after failed shipments
+        :type box_dao: boxee.persistence.BoxDao
+        """
+        self.box_dao = box_dao
+        self.locker_id = locker_id
+        self.transport = transport
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        self.max_retry_interval = max_retry_interval
+        # the receiver state is not known after a start: the first request is sent even if the outbox is empty
+        self.synced = False
+        self.resync = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.changes = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.failures = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='boxee-replication')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('replicating the locker state to [%s] every [%s] s', self.transport.__class__.__name__,
+                    self.interval)
+
+    def stop(self, timeout=5.0):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        logger.info(self.describe())
+
+    def _run(self):
+        delay = 0
+        while not self.stopped.wait(delay):
+            try:
+                self.ship()
+                delay = self.interval
+            except BaseException as e:
+                self.failures += 1
+                delay = min(max(delay, self.interval) * 2, self.max_retry_interval)
+                logger.warn('replication failed, retrying in [%s] s: %s', delay, str(e))
+                try:
+                    self.box_dao.trim_outbox(keep=self.max_backlog)
+                except BaseException as trim_error:
+                    logger.error('could not trim the outbox: %s', str(trim_error))
+
+    def ship(self):
+        """
+        Sends the queued changes (in several batches if needed)
+        """
+        while not self.stopped.is_set():
+            if self.resync:
+                self.send_snapshot()
+                continue
+            rows = self.box_dao.fetch_outbox(self.batch_size)
+            if not rows and self.synced:
+                return
+            if rows:
+                after = rows[0][0] - 1
+            else:
+                after = self.box_dao.fetch_snapshot()[0]
+            self.send({'locker': self.locker_id, 'kind': 'delta', 'after': after,
+                       'changes': [list(row) for row in rows]}, rows[-1][0] if rows else after)
+            if not self.resync and len(rows) < self.batch_size:
+                return
+
+    def send_snapshot(self):
+        seq, slots = self.box_dao.fetch_snapshot()
+        logger.info('sending a snapshot of [%s] slots up to change [%s]', len(slots), seq)
+        self.send({'locker': self.locker_id, 'kind': 'snapshot', 'seq': seq, 'slots': [list(row) for row in slots]},
+                  seq)
+
+    def send(self, message, last_seq):
+        """
+        :param last_seq: the sequence number of the last change in the message
+        """
+        raw = json.dumps(message, separators=(',', ':'))
+        body = zlib.compress(raw, 6)
+        response = json.loads(self.transport.send(body))
+        self.requests += 1
+        self.raw_bytes += len(raw)
+        self.sent_bytes += len(body)
+        self.resync = bool(response.get('resync'))
+        if self.resync:
+            logger.info('the receiver asks for a snapshot (its last change is [%s])', response.get('seq'))
+            return
+        self.synced = True
+        self.changes += len(message.get('changes', ()))
+        # the receiver may be ahead (an earlier acknowledgement was lost), never trim what it has not confirmed
+        self.box_dao.trim_outbox(seq=min(last_seq, response['seq']))
+
+    def describe(self):
+        return ('replication: [%s] requests with [%s] changes, [%s] bytes sent ([%s] bytes uncompressed), '
+                '[%s] failures' % (self.requests, self.changes, self.sent_bytes, self.raw_bytes, self.failures))
+
+
+class MirrorStore:
+    """
+    The stand-in receiver: mirrors the slot states of the lockers in memory
+    """
+
+    def __init__(self):
+        # locker id -> [last sequence number, slot_id -> (used, barcode)]
+        self.lockers = dict()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def apply(self, body):
+        """
+        :param body: the compressed request
+        :return: the JSON response
+        """
+        message = decode(body)
+        locker_id = message['locker']
+        with self.lock:
+            self.requests += 1
+            state = self.lockers.get(locker_id)
+            if message['kind'] == 'snapshot':
+                state = [message['seq'], dict((slot_id, (used, barcode)) for slot_id, used, barcode in
+                                              message['slots'])]
+                self.lockers[locker_id] = state
+            elif state is None or state[0] < message['after']:
+                logger.info('locker [%s] has missing changes after [%s], asking for a snapshot', locker_id,
+                            state[0] if state else None)
+                return json.dumps({'seq': state[0] if state else 0, 'resync': True})
+            else:
+                for seq, slot_id, used, barcode, created in message['changes']:
+                    # the changes delivered before are skipped
+                    if seq > state[0]:
+                        state[1][slot_id] = (used, barcode)
+                        state[0] = seq
+            logger.debug('locker [%s] mirrored up to change [%s]', locker_id, state[0])
+            return json.dumps({'seq': state[0]})
+
+    def slots(self, locker_id):
+        with self.lock:
+            state = self.lockers.get(locker_id)
+            return dict(state[1]) if state else None
+
+
+class MirrorHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            response = self.server.store.apply(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+            self.send_response(200)
+        except BaseException as e:
+            logger.error('invalid replication request: %s', str(e))
+            response = json.dumps({'error': str(e)})
+            self.send_response(400)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MirrorUnixHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        response = self.server.store.apply(read_frame(self.rfile))
+        self.wfile.write(FRAME.pack(len(response)) + response)
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_receiver(store, port=None, path=None):
+    """
+    :return: the HTTP server listening on the localhost port or the unix socket server listening on the path; it is
+    started by serve_forever
+    """
+    if path is not None:
+        if os.path.exists(path):
+            os.remove(path)
+        server = ThreadingUnixServer(path, MirrorUnixHandler)
+    else:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MirrorHttpHandler)
+    server.store = store
+    return server
+
+
+def usage():
+    print ('Usage: python -m boxee.replication [options]')
+    print ('\t -h --help \t list all command line options')
+    print ('\t -p --port <port> \t receives the changes over HTTP on localhost (default: 8642)')
+    print ('\t -u --unix-socket <path> \t receives the changes on a unix socket')
+
+
+def main(argv):
+    port = 8642
+    path = None
+    try:
+        opts, args = getopt.getopt(argv, "hp:u:", ["help", "port=", "unix-socket="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-u', '--unix-socket'):
+            path = arg
+    logging.basicConfig(format='%(levelname)s - %(module)s.%(funcName)s: %(message)s', level=logging.INFO)
+    store = MirrorStore()
+    server = create_receiver(store, port, path)
+    print('mirroring the lockers on [%s]' % (path if path is not None else 'http://127.0.0.1:%s/' % port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        for locker_id in sorted(store.lockers):
+            seq, slots = store.lockers[locker_id]
+            print('locker [%s] at change [%s]: %s' % (locker_id, seq, sorted(slots.items())))
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,234 @@
+"""
+Declarative GATT profile. The services, characteristics and descriptors are described by a dict (or a JSON / YAML file
+of the same structure) which is validated and resolved once at startup: the UUIDs are normalized and checked for
+uniqueness, the flags are checked against the bluez GattCharacteristic1 / GattDescriptor1 flag sets and the object
+paths are computed. The service classes only pick up the resolved specs and attach their behaviour.
+
+    {'services': [
+        {'name': 'box', 'uuid': '8fad8bdd-...', 'primary': True, 'characteristics': [
+            {'name': 'parcel_store', 'uuid': 'f76e76fc-...', 'flags': ['read', 'notify', 'write'],
+             'description': 'Parcel Store Characteristic',
+             'descriptors': [{'uuid': '2904', 'flags': ['read'], 'value': [0x19, 0, 0, 0x27, 1, 0, 0]}],
+             'enabled': True}]}]}
+"""
+import json
+import re
+import logging
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+SERVICE_PATH_BASE = '/org/bluez/boxee/service'
+CUD_UUID = '2901'
+SIG_BASE_UUID = '-0000-1000-8000-00805f9b34fb'
+
+CHRC_FLAGS = frozenset(['broadcast', 'read', 'write-without-response', 'write', 'notify', 'indicate',
+                        'authenticated-signed-writes', 'reliable-write', 'writable-auxiliaries', 'encrypt-read',
+                        'encrypt-write', 'encrypt-authenticated-read', 'encrypt-authenticated-write'])
+DESC_FLAGS = frozenset(['read', 'write', 'encrypt-read', 'encrypt-write', 'encrypt-authenticated-read',
+                        'encrypt-authenticated-write'])
+
+_SHORT_UUID = re.compile(r'^([0-9a-fA-F]{4}|[0-9a-fA-F]{8})$')
+_LONG_UUID = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+BOXEE_PROFILE = {
+    'services': [
+        {'name': 'automation_io', 'uuid': '1815', 'characteristics': [
+            {'name': 'digital_io', 'uuid': '2A56', 'flags': ['write', 'notify', 'reliable-write'],
+             'description': 'Automation Digital IO'}]},
+        {'name': 'system', 'uuid': '5d2ade4e-5f83-4c49-b5c9-8d9e2f9db41a', 'characteristics': [
+            {'name': 'memory_percentage', 'uuid': 'b03eef61-bce5-4849-aaa3-9cc5f652cf03', 'flags': ['read', 'notify'],
+             'description': 'Memory Percentage'},
+            {'name': 'cpu_percentage', 'uuid': 'b0cf5f03-e079-4c77-8e1b-7763e734e5f4', 'flags': ['read', 'notify'],
+             'description': 'CPU Percentage'},
+            {'name': 'memory_data', 'uuid': '84c2a2ea-a8ea-45e0-8c29-a3134b0e973f', 'flags': ['read', 'notify'],
+             'description': 'Memory Data', 'enabled': False},
+            {'name': 'cpu_data', 'uuid': '6ca3211a-0f51-440a-86fb-17a438ae33a5', 'flags': ['read', 'notify'],
+             'description': 'CPU Data', 'enabled': False},
+            {'name': 'disk_data', 'uuid': 'fe10746c-880e-4d4d-8b40-2f2b84596ba9', 'flags': ['read', 'notify'],
+             'description': 'Disk Characteristic', 'enabled': False}]},
+        {'name': 'box', 'uuid': '8fad8bdd-d619-4bd9-b3c1-816129f417ca', 'characteristics': [
+            {'name': 'parcel_store', 'uuid': 'f76e76fc-a36a-49ab-85d3-9ac389b12ef8',
+             'flags': ['read', 'notify', 'write'], 'description': 'Parcel Store Characteristic', 'parcel_size': 0},
+            {'name': 'parcel_release', 'uuid': 'e8dbd220-6391-4498-a19b-33adb3543a33',
+             'flags': ['read', 'notify', 'write'], 'description': 'Parcel Release Characteristic'},
+            {'name': 'slot_occupancy', 'uuid': '5a1f0c3e-7d2b-4c8e-9f61-0b3d2e4a7c19', 'flags': ['read', 'notify'],
+             'description': 'Slot Occupancy', 'max_notification': 20}]},
+        {'name': 'diagnostics', 'uuid': 'de2e2e16-828c-4605-b444-77faba44c83a', 'characteristics': [
+            {'name': 'latency_probe', 'uuid': 'e7a5d16e-c49b-4ea9-ad43-742f210315d0',
+             'flags': ['read', 'write', 'write-without-response', 'notify'], 'description': 'Latency Probe'}]},
+        {'name': 'throughput', 'uuid': '371f423f-79d4-491b-aca7-f41b4a7ca6fa', 'characteristics': [
+            {'name': 'throughput_stream', 'uuid': '9dc2435f-66af-4b09-92dd-b0115b2f3773', 'flags': ['read', 'notify'],
+             'description': 'Throughput Stream', 'payload_size': 20, 'burst': 8},
+            {'name': 'throughput_sink', 'uuid': 'c8ffda4e-d3e9-4f78-b7f6-80d97139d001',
+             'flags': ['write', 'write-without-response'], 'description': 'Throughput Sink'},
+            {'name': 'throughput_stats', 'uuid': '18e39578-b5f4-4959-8f8f-12f77400ca25', 'flags': ['read'],
+             'description': 'Throughput Statistics'}]}
+    ]
+}
+
+
+def expand_uuid(uuid):
+    """
+    :return: the lower case 128 bit form of the UUID (16 and 32 bit UUIDs are based on the Bluetooth SIG base UUID)
+    :raise ValueError: if the UUID is malformed
+    """
+    if _SHORT_UUID.match(uuid):
+        return uuid.lower().rjust(8, '0') + SIG_BASE_UUID
+    if _LONG_UUID.match(uuid):
+        return uuid.lower()
+    raise ValueError('malformed UUID [%s]' % uuid)
+
+
+class DescriptorSpec(object):
+    __slots__ = ('name', 'index', 'uuid', 'flags', 'path', 'value')
+
+    def __init__(self, name, index, uuid, flags, path, value):
+        self.name = name
+        self.index = index
+        self.uuid = uuid
+        self.flags = flags
+        self.path = path
+        self.value = value
+
+
+class CharacteristicSpec(object):
+    __slots__ = ('name', 'index', 'uuid', 'flags', 'path', 'descriptors', 'options')
+
+    def __init__(self, name, index, uuid, flags, path, descriptors, options):
+        self.name = name
+        self.index = index
+        self.uuid = uuid
+        self.flags = flags
+        self.path = path
+        self.descriptors = descriptors
+        # the keys of the definition not interpreted by the schema (eg. the notification intervals)
+        self.options = options
+
+
+class ServiceSpec(object):
+    __slots__ = ('name', 'index', 'uuid', 'primary', 'path', 'characteristics')
+
+    def __init__(self, name, index, uuid, primary, path, characteristics):
+        self.name = name
+        self.index = index
+        self.uuid = uuid
+        self.primary = primary
+        self.path = path
+        self.characteristics = characteristics
+
+    def characteristic(self, name):
+        for spec in self.characteristics:
+            if spec.name == name:
+                return spec
+        raise KeyError('characteristic [%s] is not defined (or not enabled) in service [%s]' % (name, self.name))
+
+
+class GattSchema(object):
+    """
+    The resolved GATT profile; the definition is validated in one pass and every error is reported at once.
+    """
+    _CHRC_KEYS = frozenset(['name', 'uuid', 'flags', 'description', 'descriptors', 'enabled'])
+
+    def __init__(self, definition=None):
+        """
+        :param definition: the profile dict (the built-in BOXEE_PROFILE by default)
+        :raise ValueError: if the definition is invalid
+        """
+        self.services = []
+        self.errors = []
+        self._build(definition if definition is not None else BOXEE_PROFILE)
+        if self.errors:
+            raise ValueError('invalid GATT profile:\n\t' + '\n\t'.join(self.errors))
+        logger.debug('GATT profile resolved with [%s] services', len(self.services))
+
+    @staticmethod
+    def load(path):
+        """
+        Loads the profile from a JSON file, or from a YAML file (.yaml / .yml) if PyYAML is installed
+        """
+        with open(path) as profile_file:
+            if path.endswith('.yaml') or path.endswith('.yml'):
+                import yaml
+                return GattSchema(yaml.safe_load(profile_file))
+            return GattSchema(json.load(profile_file))
+
+    def service(self, name):
+        for spec in self.services:
+            if spec.name == name:
+                return spec
+        raise KeyError('service [%s] is not defined in the GATT profile' % name)
+
+    def _build(self, definition):
+        # expanded UUID -> the name of the service or characteristic using it
+        uuids = dict()
+        names = set()
+        for index, service in enumerate(definition.get('services', [])):
+            name = service.get('name', 'service%s' % index)
+            if name in names:
+                self.errors.append('duplicate service name [%s]' % name)
+            names.add(name)
+            uuid = self._uuid(service.get('uuid'), name, uuids)
+            path = SERVICE_PATH_BASE + str(index)
+            characteristics = []
+            chrc_names = set()
+            for chrc_index, chrc in enumerate(service.get('characteristics', [])):
+                chrc_spec = self._characteristic(chrc, chrc_index, '%s.%s' % (name, chrc.get('name')), path, uuids)
+                if chrc_spec.name in chrc_names:
+                    self.errors.append('duplicate characteristic name [%s] in service [%s]' % (chrc_spec.name, name))
+                chrc_names.add(chrc_spec.name)
+                if chrc.get('enabled', True):
+                    characteristics.append(chrc_spec)
+            self.services.append(ServiceSpec(intern(str(name)), index, uuid, bool(service.get('primary', True)),
+                                             path, tuple(characteristics)))
+
+    def _characteristic(self, chrc, index, qualified_name, service_path, uuids):
+        path = service_path + '/char' + str(index)
+        flags = self._flags(chrc.get('flags'), CHRC_FLAGS, qualified_name)
+        descriptors = []
+        desc_uuids = set()
+        definitions = list(chrc.get('descriptors', []))
+        if chrc.get('description') is not None:
+            flags_cud = ['read', 'write'] if 'writable-auxiliaries' in flags else ['read']
+            definitions.insert(0, {'uuid': CUD_UUID, 'flags': flags_cud, 'value': chrc['description']})
+        for desc_index, desc in enumerate(definitions):
+            desc_name = '%s.desc%s' % (qualified_name, desc_index)
+            desc_uuid = self._uuid(desc.get('uuid'), desc_name, None)
+            if desc_uuid in desc_uuids:
+                self.errors.append('duplicate descriptor UUID [%s] in [%s]' % (desc_uuid, qualified_name))
+            desc_uuids.add(desc_uuid)
+            descriptors.append(DescriptorSpec(intern(str(desc_name)), desc_index, desc_uuid,
+                                              self._flags(desc.get('flags', ['read']), DESC_FLAGS, desc_name),
+                                              path + '/desc' + str(desc_index), desc.get('value')))
+        options = dict((key, value) for key, value in chrc.iteritems() if key not in self._CHRC_KEYS)
+        return CharacteristicSpec(intern(str(chrc.get('name', 'char%s' % index))), index,
+                                  self._uuid(chrc.get('uuid'), qualified_name, uuids), flags, path,
+                                  tuple(descriptors), options)
+
+    def _uuid(self, uuid, owner, uuids):
+        """
+        :param uuids: the UUIDs already in use, checked for uniqueness (None: no check)
+        :return: the UUID as written in the definition (bluez accepts the 16 bit form)
+        """
+        if not uuid:
+            self.errors.append('[%s] has no UUID' % owner)
+            return None
+        try:
+            expanded = expand_uuid(uuid)
+        except ValueError as e:
+            self.errors.append('[%s]: %s' % (owner, str(e)))
+            return uuid
+        if uuids is not None:
+            if expanded in uuids:
+                self.errors.append('[%s] uses the UUID [%s] of [%s]' % (owner, uuid, uuids[expanded]))
+            uuids[expanded] = owner
+        return intern(str(uuid))
+
+    def _flags(self, flags, valid, owner):
+        if not flags:
+            self.errors.append('[%s] has no flags' % owner)
+            return ()
+        unknown = [flag for flag in flags if flag not in valid]
+        if unknown:
+            self.errors.append('[%s] has unknown flags %s' % (owner, unknown))
+        return tuple(intern(str(flag)) for flag in flags)
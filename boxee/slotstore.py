@@ -0,0 +1,497 @@
+"""
+Storage engine for the locker state without SQLite, behind the BoxDao interface (see persistence.create_dao).
+
+The state of a locker is a fixed table (slot id, used flag, size class, usage count, barcode), kept in two files:
+ - boxee.slots: a header and one fixed size record per slot, memory mapped (copy on write), so a read is a struct
+   unpack at a known offset; the file itself is only rewritten by the compaction
+ - boxee.log: the append-only change log; every change is a checksummed full image of the changed slot record, the
+   records of one operation (eg. a bulk store) are applied together or not at all. The writes of the concurrent
+   operations are made durable by one shared fsync (group commit).
+
+The compaction writes the current slot table into a new slot file carrying the sequence number of the last change it
+contains, renames it over the old one and truncates the log. The recovery after a power loss replays the complete
+operations of the log newer than that sequence number and cuts off a torn tail.
+
+Header (little endian): 'BXSL', version (B), record size (H), slot count (I), sequence number of the last change (Q),
+crc32 of the preceding fields (I)
+Slot record: slot id (I), used (B), size (B), usage count (I), barcode length (B), barcode (64s)
+Log record: crc32 of the rest (I), sequence number (Q), time (d), last record of the operation (B), slot record
+"""
+import os
+import heapq
+import mmap
+import struct
+import threading
+import time
+import zlib
+import collections
+import logging
+from persistence import PersistenceException
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+MAGIC = 'BXSL'
+VERSION = 1
+MAX_BARCODE = 64
+HEADER = struct.Struct('<4sBHIQ')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<IBBIB%ss' % MAX_BARCODE)
+LOG_HEAD = struct.Struct('<QdB')
+CRC = struct.Struct('<I')
+LOG_RECORD_SIZE = CRC.size + LOG_HEAD.size + RECORD.size
+
+
+def crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class SlotFileDao:
+    """
+    The slot file storage engine. The methods have the semantics of the BoxDao methods of the same name; every method
+    is serialized by the lock, except the fsync which is shared by the concurrent writers.
+    Unlike the SQLite engine, a barcode is at most MAX_BARCODE (64) bytes long (utf-8 encoded); a longer one is rejected
+    with a PersistenceException before any slot is touched.
+    """
+
+    def __init__(self, box_range, current_folder, deferred_init=False, max_log_size=1 << 20, sync=True,
+                 max_outbox=10000):
+        """
+        :param box_range: the slot ids of the locker
+        :param current_folder: the folder of the slot file and of the log
+        :param deferred_init: the files are opened (and recovered) later by initialize
+        :param max_log_size: the log is compacted into the slot file when it grows beyond this size (bytes)
+        :param sync: fsync the log before an operation returns (False: the changes of the last seconds may be lost
+        by a power loss, but never half applied)
+        :param max_outbox: the number of changes kept in memory for the replication (see boxee.replication)
+        """
+        self.box_range = box_range
+        self.path = os.path.join(current_folder, 'boxee.slots')
+        self.log_path = os.path.join(current_folder, 'boxee.log')
+        self.max_log_size = max_log_size
+        self.sync = sync
+        self.lock = threading.RLock()
+        self.sync_condition = threading.Condition(threading.Lock())
+        self.syncing = False
+        self.synced_seq = 0
+        self.written_seq = 0
+        self.seq = 0
+        # the sequence number of the last change contained by the slot file
+        self.base_seq = 0
+        self.slot_file = None
+        self.slots = None
+        self.log_fd = None
+        self.log_size = 0
+        # slot_id -> the position of its record; barcode -> the slot ids holding it; the free slot ids (lazy heap)
+        self.positions = dict()
+        self.barcodes = collections.defaultdict(set)
+        self.free = []
+        self.outbox = collections.deque(maxlen=max_outbox)
+        self.fsyncs = 0
+        logger.info("Creating slot file storage at: " + self.path)
+        if not deferred_init:
+            self.initialize()
+
+    def initialize(self):
+        """
+        Opens the slot file (created at the first start), replays the log and adds the missing slots
+        """
+        with self.lock:
+            try:
+                started = time.time()
+                if not os.path.exists(self.path):
+                    self._write_slot_file([(slot_id, False, 0, 0, '') for slot_id in self.box_range], 0)
+                self._open()
+                replayed = self._recover()
+                missing = [slot_id for slot_id in self.box_range if slot_id not in self.positions]
+                if missing:
+                    logger.debug('Initializing slots: %s', missing)
+                    self._compact(extra=[(slot_id, False, 0, 0, '') for slot_id in missing])
+                logger.info('slot file opened with [%s] slots in [%.1f] ms, [%s] log records replayed',
+                            len(self.positions), (time.time() - started) * 1000, replayed)
+            except BaseException as e:
+                logger.error('Error while initializing the slot file: %s', str(e))
+                raise PersistenceException(str(e))
+
+    def _write_slot_file(self, rows, seq):
+        """
+        Writes a complete slot file under a temporary name, then renames it over the current one
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as slot_file:
+            header = HEADER.pack(MAGIC, VERSION, RECORD.size, len(rows), seq)
+            slot_file.write((header + CRC.pack(crc(header))).ljust(HEADER_SIZE, '\0'))
+            for row in rows:
+                slot_file.write(self._pack(row))
+            slot_file.flush()
+            os.fsync(slot_file.fileno())
+        os.rename(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _open(self):
+        if self.slots is not None:
+            self.slots.close()
+            self.slot_file.close()
+        self.slot_file = open(self.path, 'rb')
+        # copy on write: the changes stay in memory until the compaction writes a new file
+        self.slots = mmap.mmap(self.slot_file.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, record_size, count, seq = HEADER.unpack_from(self.slots, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise PersistenceException('[%s] is not a slot file (version %s)' % (self.path, VERSION))
+        if CRC.unpack_from(self.slots, HEADER.size)[0] != crc(self.slots[:HEADER.size]):
+            raise PersistenceException('the header of [%s] is corrupt' % self.path)
+        if len(self.slots) < HEADER_SIZE + count * RECORD.size:
+            raise PersistenceException('[%s] is truncated' % self.path)
+        self.seq = max(self.seq, seq)
+        self.base_seq = seq
+        self.positions = dict()
+        self.barcodes = collections.defaultdict(set)
+        free = []
+        for position in xrange(count):
+            slot_id, used, size, usage_count, barcode = self._row(position)
+            self.positions[slot_id] = position
+            if used:
+                self.barcodes[barcode].add(slot_id)
+            else:
+                free.append(slot_id)
+        heapq.heapify(free)
+        self.free = free
+
+    def _recover(self):
+        """
+        Replays the operations of the log newer than the slot file and cuts off the incomplete tail
+        :return: the number of replayed records
+        """
+        if self.log_fd is None:
+            self.log_fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        data = os.read(self.log_fd, os.fstat(self.log_fd).st_size) if os.fstat(self.log_fd).st_size else ''
+        valid = 0
+        replayed = 0
+        operation = []
+        for offset in xrange(0, len(data) - LOG_RECORD_SIZE + 1, LOG_RECORD_SIZE):
+            record = data[offset:offset + LOG_RECORD_SIZE]
+            if CRC.unpack_from(record)[0] != crc(record[CRC.size:]):
+                logger.warn('corrupt log record at [%s], the rest of the log is dropped', offset)
+                break
+            seq, created, last = LOG_HEAD.unpack_from(record, CRC.size)
+            operation.append((seq, created, self._unpack(RECORD.unpack_from(record, CRC.size + LOG_HEAD.size))))
+            if not last:
+                continue
+            for seq, created, row in operation:
+                if seq > self.base_seq:
+                    self._apply(row)
+                    self.outbox.append((seq, row[0], 'T' if row[1] else 'F', row[4], created))
+                    replayed += 1
+                self.seq = max(self.seq, seq)
+            operation = []
+            valid = offset + LOG_RECORD_SIZE
+        if valid < len(data):
+            logger.warn('[%s] bytes of incomplete operations are cut off the log', len(data) - valid)
+            os.ftruncate(self.log_fd, valid)
+            os.fsync(self.log_fd)
+        self.log_size = valid
+        self.written_seq = self.synced_seq = self.seq
+        return replayed
+
+    def _compact(self, extra=()):
+        """
+        Folds the log into a new slot file and truncates the log
+        :param extra: slot rows appended to the table (new slots)
+        """
+        started = time.time()
+        rows = [self._row(position) for position in xrange(len(self.positions))] + list(extra)
+        self._write_slot_file(rows, self.seq)
+        self._open()
+        os.ftruncate(self.log_fd, 0)
+        os.fsync(self.log_fd)
+        compacted, self.log_size = self.log_size, 0
+        logger.info('[%s] bytes of log compacted into the slot file in [%.1f] ms', compacted,
+                    (time.time() - started) * 1000)
+
+    @staticmethod
+    def check_barcodes(barcodes):
+        """
+        :raise PersistenceException: if a barcode does not fit into a slot record
+        """
+        for barcode in barcodes:
+            if len(barcode.encode('utf-8') if isinstance(barcode, unicode) else barcode) > MAX_BARCODE:
+                raise PersistenceException('barcode [%s] is longer than %s bytes' % (barcode, MAX_BARCODE))
+
+    @staticmethod
+    def _pack(row):
+        slot_id, used, size, usage_count, barcode = row
+        if isinstance(barcode, unicode):
+            barcode = barcode.encode('utf-8')
+        if len(barcode) > MAX_BARCODE:
+            raise PersistenceException('barcode [%s] is longer than %s bytes' % (barcode, MAX_BARCODE))
+        return RECORD.pack(slot_id, 1 if used else 0, size, usage_count, len(barcode), barcode)
+
+    @staticmethod
+    def _unpack(fields):
+        slot_id, used, size, usage_count, length, barcode = fields
+        return slot_id, bool(used), size, usage_count, barcode[:length]
+
+    def _row(self, position):
+        return self._unpack(RECORD.unpack_from(self.slots, HEADER_SIZE + position * RECORD.size))
+
+    def _get(self, slot_id):
+        position = self.positions.get(slot_id)
+        return None if position is None else self._row(position)
+
+    def _apply(self, row):
+        """
+        Writes the row into the mapped slot table and maintains the indexes
+        """
+        position = self.positions[row[0]]
+        previous = self._row(position)
+        if previous[1]:
+            self.barcodes[previous[4]].discard(row[0])
+            if not self.barcodes[previous[4]]:
+                del self.barcodes[previous[4]]
+        if row[1]:
+            self.barcodes[row[4]].add(row[0])
+        elif previous[1]:
+            heapq.heappush(self.free, row[0])
+        offset = HEADER_SIZE + position * RECORD.size
+        self.slots[offset:offset + RECORD.size] = self._pack(row)
+
+    def _commit(self, rows):
+        """
+        Logs the rows as one operation and applies them; must be called with the lock held
+        :return: the sequence number to wait for (see _sync)
+        """
+        if not rows:
+            return self.written_seq
+        now = time.time()
+        records = []
+        for index, row in enumerate(rows):
+            self.seq += 1
+            body = LOG_HEAD.pack(self.seq, now, 1 if index == len(rows) - 1 else 0) + self._pack(row)
+            records.append(CRC.pack(crc(body)) + body)
+        data = ''.join(records)
+        os.write(self.log_fd, data)
+        self.log_size += len(data)
+        self.written_seq = self.seq
+        seq = self.seq - len(rows)
+        for row in rows:
+            seq += 1
+            self._apply(row)
+            self.outbox.append((seq, row[0], 'T' if row[1] else 'F', row[4], now))
+        return self.seq
+
+    def _sync(self, seq):
+        """
+        Waits until the log is durable up to seq; one of the waiting writers calls fsync for all of them
+        """
+        if not self.sync:
+            return
+        with self.sync_condition:
+            while self.synced_seq < seq:
+                if self.syncing:
+                    self.sync_condition.wait()
+                    continue
+                self.syncing = True
+                target = self.written_seq
+                break
+            else:
+                return
+        try:
+            os.fsync(self.log_fd)
+            self.fsyncs += 1
+        finally:
+            with self.sync_condition:
+                self.syncing = False
+                self.synced_seq = max(self.synced_seq, target)
+                self.sync_condition.notify_all()
+
+    def _write(self, operation, *args):
+        """
+        Runs the operation (which returns its result and the changed rows) under the lock, then waits for the fsync
+        """
+        try:
+            with self.lock:
+                result, rows = operation(*args)
+                seq = self._commit(rows)
+            self._sync(seq)
+            if self.log_size > self.max_log_size:
+                with self.lock:
+                    if self.log_size > self.max_log_size:
+                        self._compact()
+            return result
+        except PersistenceException:
+            raise
+        except BaseException as e:
+            raise PersistenceException(str(e))
+
+    def define_slot_sizes(self, slot_sizes):
+        def operation():
+            rows = []
+            for slot_id, size in slot_sizes.iteritems():
+                row = self._get(slot_id)
+                if row is not None and row[2] != size:
+                    rows.append((slot_id, row[1], size, row[3], row[4]))
+            return None, rows
+        self._write(operation)
+
+    def fetch_slots(self):
+        with self.lock:
+            return [(row[0], 'T' if row[1] else 'F', row[2], row[3]) for row in
+                    (self._row(position) for position in xrange(len(self.positions)))]
+
+    def fetch_barcodes(self):
+        with self.lock:
+            return [barcode for barcode, slot_ids in self.barcodes.iteritems() for slot_id in slot_ids]
+
+    def count_slots(self):
+        with self.lock:
+            used = sum(len(slot_ids) for slot_ids in self.barcodes.itervalues())
+            return len(self.positions) - used, len(self.positions)
+
+    def fetch_empty_slots(self):
+        with self.lock:
+            rows = [(slot_id,) for slot_id in sorted(self.positions) if not self._get(slot_id)[1]]
+        return rows if rows else None
+
+    def fetch_slot_by_barcode(self, barcode):
+        with self.lock:
+            slot_ids = self.barcodes.get(barcode)
+            return min(slot_ids) if slot_ids else -1
+
+    def _take_free(self):
+        """
+        :return: the lowest free slot id or None
+        """
+        while self.free:
+            slot_id = heapq.heappop(self.free)
+            row = self._get(slot_id)
+            # the heap is lazy: a slot may be in it more than once or may have been claimed directly
+            if row is not None and not row[1]:
+                return slot_id
+        return None
+
+    def _use(self, slot_id, barcode):
+        row = self._get(slot_id)
+        return slot_id, True, row[2], row[3] + 1, barcode
+
+    def reserve_slot(self, barcode):
+        def operation():
+            slot_id = self._take_free()
+            if slot_id is None:
+                logger.debug('no free slot could be reserved for barcode [%s]', barcode)
+                return -1, []
+            return slot_id, [self._use(slot_id, barcode)]
+        self.check_barcodes([barcode])
+        return self._write(operation)
+
+    def claim_slot(self, slot_id, barcode):
+        def operation():
+            row = self._get(slot_id)
+            if row is None or row[1]:
+                return False, []
+            return True, [self._use(slot_id, barcode)]
+        self.check_barcodes([barcode])
+        return self._write(operation)
+
+    def reserve_slots(self, barcodes):
+        def operation():
+            slot_ids = []
+            for barcode in barcodes:
+                slot_id = self._take_free()
+                if slot_id is None:
+                    break
+                slot_ids.append(slot_id)
+            return slot_ids + [-1] * (len(barcodes) - len(slot_ids)), [
+                self._use(slot_id, barcode) for slot_id, barcode in zip(slot_ids, barcodes)]
+        self.check_barcodes(barcodes)
+        return self._write(operation)
+
+    def claim_slots(self, assignments):
+        def operation():
+            free = set()
+            rows = []
+            for slot_id, barcode in assignments:
+                row = self._get(slot_id)
+                if row is not None and not row[1] and slot_id not in free:
+                    free.add(slot_id)
+                    rows.append(self._use(slot_id, barcode))
+            return free, rows
+        self.check_barcodes([barcode for _, barcode in assignments])
+        return self._write(operation)
+
+    def _free_row(self, slot_id):
+        row = self._get(slot_id)
+        return slot_id, False, row[2], row[3], ''
+
+    def unclaim_slot(self, slot_id):
+        self.unclaim_slots([slot_id])
+
+    def unclaim_slots(self, slot_ids):
+        def operation():
+            rows = []
+            for slot_id in set(slot_ids):
+                row = self._get(slot_id)
+                if row is not None and row[1]:
+                    rows.append((slot_id, False, row[2], max(row[3] - 1, 0), ''))
+            return None, rows
+        logger.debug('unclaiming slots %s', slot_ids)
+        self._write(operation)
+
+    def release_slots(self, barcodes):
+        def operation():
+            found = dict()
+            rows = []
+            for barcode in set(barcodes):
+                for slot_id in sorted(self.barcodes.get(barcode, ())):
+                    found[barcode] = slot_id
+                    rows.append(self._free_row(slot_id))
+            return found, rows
+        found = self._write(operation)
+        logger.debug('released slots by barcode: %s', found)
+        return found
+
+    def update_box(self, slot_id, used=False, barcode=''):
+        def operation():
+            row = self._get(slot_id)
+            if row is None:
+                raise PersistenceException('the updated row count is 0')
+            if row[1] == bool(used) and row[4] == barcode:
+                return None, []
+            return None, [(slot_id, bool(used), row[2], row[3], barcode)]
+        logger.debug('updating box with slot id [%s] used [%s] and barcode [%s]', slot_id, used, barcode)
+        self.check_barcodes([barcode])
+        self._write(operation)
+
+    def fetch_outbox(self, limit):
+        with self.lock:
+            return list(self.outbox)[:limit]
+
+    def fetch_snapshot(self):
+        with self.lock:
+            return self.seq, [(row[0], 'T' if row[1] else 'F', row[4]) for row in
+                              sorted(self._row(position) for position in xrange(len(self.positions)))]
+
+    def trim_outbox(self, seq=None, keep=None):
+        with self.lock:
+            while self.outbox and seq is not None and self.outbox[0][0] <= seq:
+                self.outbox.popleft()
+            while keep is not None and len(self.outbox) > keep:
+                self.outbox.popleft()
+
+    def destroy(self):
+        """
+        Compacts the log and closes the files
+        """
+        logger.info('destroying %s (%s fsyncs)', __name__, self.fsyncs)
+        with self.lock:
+            if self.slots is None:
+                return
+            if self.log_size:
+                self._compact()
+            self.slots.close()
+            self.slot_file.close()
+            os.close(self.log_fd)
+            self.slots = None
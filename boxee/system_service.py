@@ -1,6 +1,5 @@
 from binascii import unhexlify, hexlify
-from core import Service, Characteristic, NotificationAbleCharacteristic, CharacteristicUserDescriptionDescriptor
-import psutil
+from core import Service, Characteristic, NotificationAbleCharacteristic, NotificationPolicy
 import math
 import boxee, logging, struct, gobject, dbus, dbus.service
 from exceptions import NotSupportedException
@@ -11,37 +10,48 @@ logger = logging.getLogger(__name__)
 
 
 class SystemService(Service):
-    SYS_SRV_UUID = '5d2ade4e-5f83-4c49-b5c9-8d9e2f9db41a'
 
-    def __init__(self, bus, index, write_callback_func):
+    def __init__(self, bus, spec, write_callback_func):
         """
             :param bus: the dbus connection
-            :param index: the index of the service
+            :param spec: the system service of the GATT schema (memory_data, cpu_data and disk_data are disabled by
+            default)
+            :type spec: boxee.schema.ServiceSpec
         """
-        Service.__init__(self, write_callback_func, bus, index, self.SYS_SRV_UUID, True)
-        self.add_characteristic(MemoryPercentageChrc(bus, 0, self))
-        self.add_characteristic(CpuPercentageChrc(bus, 1, self))
-        # self.add_characteristic(MemoryDataChrc(bus, 0, self))
-        # self.add_characteristic(CpuDataChrc(bus, 2, self))
-        # self.add_characteristic(DiskDataChrc(bus, 4, self))
+        Service.__init__(self, write_callback_func, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        self.add_characteristics(spec, {
+            'memory_percentage': lambda chrc_spec: MemoryPercentageChrc(bus, chrc_spec, self),
+            'cpu_percentage': lambda chrc_spec: CpuPercentageChrc(bus, chrc_spec, self),
+            'memory_data': lambda chrc_spec: MemoryDataChrc(bus, chrc_spec, self),
+            'cpu_data': lambda chrc_spec: CpuDataChrc(bus, chrc_spec, self),
+            'disk_data': lambda chrc_spec: DiskDataChrc(bus, chrc_spec, self)
+        })
+
+    @staticmethod
+    def warm_up():
+        """
+        Loads psutil and primes the cpu utilization baseline; executed in the background once the server is advertising
+        """
+        import psutil
+        psutil.cpu_percent(None, False)
+        logger.debug('system metrics initialized')
 
 
 class MemoryPercentageChrc(NotificationAbleCharacteristic):
-    def __init__(self, bus, index, service):
-        NotificationAbleCharacteristic.__init__(self, bus, index, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Memory Percentage"))
-
-    def return_uuid(self):
-        return 'b03eef61-bce5-4849-aaa3-9cc5f652cf03'
+    def __init__(self, bus, spec, service):
+        # the memory usage is notified on a 2% change, but at least once a minute
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service,
+                                                policy=NotificationPolicy(max_interval=60000, abs_threshold=2))
 
     def get_values(self):
+        import psutil
         logger.debug('getting values in [%s]', __name__)
         values = []
         mem = psutil.virtual_memory()
-        mem_percentage = bytes(int(math.floor(mem.percent)))[0]
+        # one byte holding the percentage itself, so the notification thresholds are in percent
+        mem_percentage = int(math.floor(mem.percent))
         logger.debug('providing memory percentage [%s]', mem_percentage)
-        # values.append(dbus.ByteArray(mem_percentage))
-        return dbus.ByteArray(mem_percentage)
+        return dbus.Array([dbus.Byte(mem_percentage)], signature='y')
         # mem_percent_struct = struct.pack('!f', mem.percent)
         # append_bytearray_to_array(values, mem_percent_struct)
         # logger.debug('memory percent [%s], hex bytes [%s], structure byte length: [%s]', mem.percent,
@@ -58,14 +68,11 @@ class MemoryDataChrc(NotificationAbleCharacteristic):
     # svmem(total=1020764160L, available=957878272L, percent=6.2, used=273211392L, free=747552768L, active=94724096, inactive=148664320, buffers=24080384L, cached=186245120)
     """
 
-    def __init__(self, bus, index, service):
-        NotificationAbleCharacteristic.__init__(self, bus, index, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Memory Data"))
-
-    def return_uuid(self):
-        return '84c2a2ea-a8ea-45e0-8c29-a3134b0e973f'
+    def __init__(self, bus, spec, service):
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service)
 
     def get_values(self):
+        import psutil
         values = []
         mem = psutil.virtual_memory()
         # s = struct.Struct('I 2s f')
@@ -85,20 +92,19 @@ class CpuPercentageChrc(NotificationAbleCharacteristic):
         core x: percentage float (4 bytes)
     """
 
-    def __init__(self, bus, index, service):
-        NotificationAbleCharacteristic.__init__(self, bus, index, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "CPU Percentage"))
-
-    def return_uuid(self):
-        return 'b0cf5f03-e079-4c77-8e1b-7763e734e5f4'
+    def __init__(self, bus, spec, service):
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service,
+                                                policy=NotificationPolicy(max_interval=60000, abs_threshold=5))
 
     def get_values(self):
+        import psutil
         logger.debug('getting values in [%s]', type(self).__name__)
         values = []
         try:
-            cpu_percentage = bytes(int(math.floor(psutil.cpu_percent(1, False))))[0]
+            # non blocking: the utilization since the previous call (the notification period) is returned
+            cpu_percentage = int(math.floor(psutil.cpu_percent(None, False)))
             logger.debug('Providing cpu percentage [%s]', cpu_percentage)
-            return dbus.Byte(cpu_percentage)
+            return dbus.Array([dbus.Byte(cpu_percentage)], signature='y')
             # for cpu_percent in psutil.cpu_percent(1, True):
             #     cpu_percent_struct = struct.pack('!f', cpu_percent)
             #     cpu_percent_struct_byte_length = len(cpu_percent_struct)
@@ -125,14 +131,11 @@ class CpuDataChrc(NotificationAbleCharacteristic):
     # 4
     """
 
-    def __init__(self, bus, index, service):
-        NotificationAbleCharacteristic.__init__(self, bus, index, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "CPU Data"))
-
-    def return_uuid(self):
-        return '6ca3211a-0f51-440a-86fb-17a438ae33a5'
+    def __init__(self, bus, spec, service):
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service)
 
     def get_values(self):
+        import psutil
         values = [dbus.Byte(psutil.cpu_count), dbus.Array(psutil.cpu_percent(1, True))]
         return values
 
@@ -157,14 +160,11 @@ class DiskDataChrc(NotificationAbleCharacteristic):
 
     """
 
-    def __init__(self, bus, index, service):
-        NotificationAbleCharacteristic.__init__(self, bus, index, service)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self, "Disk Characteristic"))
-
-    def return_uuid(self):
-        return 'fe10746c-880e-4d4d-8b40-2f2b84596ba9'
+    def __init__(self, bus, spec, service):
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service)
 
     def get_values(self):
+        import psutil
         values = []
         disk_partitions = psutil.disk_partitions()
         values.append(dbus.Byte(len(disk_partitions)))
@@ -0,0 +1,221 @@
+from core import Service, Characteristic, NotificationAbleCharacteristic, GATT_CHRC_IFACE
+import os
+import struct
+import time
+import logging
+import dbus
+import dbus.service
+import gobject
+from exceptions import InvalidValueLengthException
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+# the sequence number at the start of every stream notification and flood write (little endian)
+SEQUENCE = struct.Struct('<I')
+# sink packets, sink bytes, sink dropped, sink bytes/s, sink cpu us/KB, stream packets, stream bytes/s,
+# stream cpu us/KB
+STATS = struct.Struct('<IIIIIIII')
+
+
+def cpu_time():
+    """
+    :return: the user and system CPU seconds of the process (every thread)
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class ThroughputMeter:
+    """
+    Counts the packets of one direction: the achieved bytes/s, the sequence numbers missing and the CPU time spent
+    per KB
+    """
+
+    def __init__(self, clock=time.time, cpu_clock=cpu_time):
+        self.clock = clock
+        self.cpu_clock = cpu_clock
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.expected = None
+        self.started = None
+        self.last = None
+        self.cpu_started = None
+        self.cpu_last = None
+
+    def add(self, size, seq=None):
+        """
+        :param size: the bytes of the packet
+        :param seq: the sequence number of the packet; the gaps are counted as dropped packets
+        """
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+            self.cpu_started = self.cpu_clock()
+        self.packets += 1
+        self.bytes += size
+        self.last = now
+        if seq is not None:
+            if self.expected is not None and seq > self.expected:
+                self.dropped += seq - self.expected
+            if self.expected is None or seq >= self.expected:
+                self.expected = seq + 1
+
+    def sample_cpu(self):
+        """
+        Reads the CPU clock; called at the end of a burst instead of for every packet
+        """
+        if self.started is not None:
+            self.cpu_last = self.cpu_clock()
+
+    def rate(self):
+        """
+        :return: bytes/s between the first and the last packet
+        """
+        if self.started is None or self.last <= self.started:
+            return 0
+        return self.bytes / (self.last - self.started)
+
+    def cpu_per_kb(self):
+        """
+        :return: microseconds of CPU time per KB
+        """
+        if self.cpu_last is None or self.bytes == 0:
+            return 0
+        return (self.cpu_last - self.cpu_started) * 1e6 / (self.bytes / 1024.0)
+
+    def describe(self):
+        return '[%s] packets, [%s] bytes, [%.0f] bytes/s, [%s] dropped, [%.0f] us CPU/KB' % (
+            self.packets, self.bytes, self.rate(), self.dropped, self.cpu_per_kb())
+
+
+class ThroughputService(Service):
+    """
+    Link capacity test, published with -t: the stream characteristic sends sequence numbered notifications as fast as
+    bluez takes them, the sink characteristic counts a flood of sequence numbered writes and the stats characteristic
+    reports both directions. A flood starts with sequence number 0.
+    """
+
+    def __init__(self, bus, spec):
+        """
+            :param spec: the throughput service of the GATT schema
+            :type spec: boxee.schema.ServiceSpec
+        """
+        Service.__init__(self, self.service_write_cb, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        self.stream_meter = ThroughputMeter()
+        self.sink_meter = ThroughputMeter()
+        self.add_characteristics(spec, {
+            'throughput_stream': lambda chrc_spec: StreamCharacteristic(bus, chrc_spec, self, self.stream_meter),
+            'throughput_sink': lambda chrc_spec: SinkCharacteristic(bus, chrc_spec, self, self.sink_meter),
+            'throughput_stats': lambda chrc_spec: StatsCharacteristic(bus, chrc_spec, self)
+        })
+
+    def service_write_cb(self, signal_dictionary):
+        pass
+
+    def stats(self):
+        sink, stream = self.sink_meter, self.stream_meter
+        sink.sample_cpu()
+        stream.sample_cpu()
+        return STATS.pack(*[min(int(value), 0xffffffff) for value in (
+            sink.packets, sink.bytes, sink.dropped, sink.rate(), sink.cpu_per_kb(), stream.packets, stream.rate(),
+            stream.cpu_per_kb())])
+
+    def describe(self):
+        return 'throughput test: sink %s; stream %s' % (self.sink_meter.describe(), self.stream_meter.describe())
+
+
+class StreamCharacteristic(NotificationAbleCharacteristic):
+    def __init__(self, bus, spec, service, meter):
+        """
+        Streams while notifying; every main loop idle iteration sends a burst of notifications and flushes the D-Bus
+        connection, so the stream is throttled by bluez reading the socket instead of piling up in the outgoing queue
+            :param spec: the characteristic spec; the payload_size option sets the size of a notification (default:
+            20 bytes, the payload of the default ATT MTU) and the burst option the notifications per iteration
+            :type meter: ThroughputMeter
+        """
+        NotificationAbleCharacteristic.__init__(self, bus, spec, service)
+        self.meter = meter
+        self.burst = spec.options.get('burst', 8)
+        self.buffer = bytearray(max(spec.options.get('payload_size', 20), SEQUENCE.size))
+        self.changed = {'Value': None}
+        self.seq = 0
+
+    def get_values(self):
+        return dbus.ByteArray(str(self.buffer))
+
+    def notify_cb(self):
+        if not self.notifying:
+            self.notify_source = None
+            return False
+        for _ in xrange(self.burst):
+            SEQUENCE.pack_into(self.buffer, 0, self.seq)
+            self.changed['Value'] = dbus.ByteArray(str(self.buffer))
+            self.PropertiesChanged(GATT_CHRC_IFACE, self.changed, [])
+            self.meter.add(len(self.buffer), self.seq)
+            self.seq += 1
+        self.connection.flush()
+        self.meter.sample_cpu()
+        return True
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
+        self.seq = 0
+        self.meter.reset()
+        self.notify_source = gobject.idle_add(self.notify_cb)
+
+    def StopNotify(self):
+        if not self.notifying:
+            return
+        self.notifying = False
+        if self.notify_source is not None:
+            gobject.source_remove(self.notify_source)
+            self.notify_source = None
+        logger.info('stream stopped: %s', self.meter.describe())
+
+
+class SinkCharacteristic(Characteristic):
+    def __init__(self, bus, spec, service, meter):
+        """
+        Counts the flood of writes on the main loop; the values arrive as byte strings, not as arrays of dbus.Byte
+            :type meter: ThroughputMeter
+        """
+        Characteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, spec.path)
+        self.add_descriptors(spec.descriptors)
+        self.meter = meter
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='ay', byte_arrays=True)
+    def WriteValue(self, value, options=None):
+        """
+        :param options: passed by bluez 5.46 and newer (eg. the device)
+        """
+        if len(value) < SEQUENCE.size:
+            raise InvalidValueLengthException()
+        seq = SEQUENCE.unpack_from(value)[0]
+        if seq == 0:
+            if self.meter.packets:
+                logger.info('flood finished: %s', self.meter.describe())
+            self.meter.reset()
+        self.meter.add(len(value), seq)
+        if self.meter.packets % 64 == 0:
+            self.meter.sample_cpu()
+
+
+class StatsCharacteristic(Characteristic):
+    def __init__(self, bus, spec, service):
+        """
+        The results of both directions (see STATS)
+            :type service: ThroughputService
+        """
+        Characteristic.__init__(self, bus, spec.index, spec.uuid, spec.flags, service, spec.path)
+        self.add_descriptors(spec.descriptors)
+
+    @dbus.service.method(GATT_CHRC_IFACE, out_signature='ay')
+    def ReadValue(self, options=None):
+        return dbus.ByteArray(self.service.stats())
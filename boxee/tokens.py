@@ -0,0 +1,254 @@
+__author__ = 'tamas'
+"""
+Signed parcel tokens. With a per-locker key the parcel characteristics only accept barcodes signed by the back office,
+and the writes which are not are rejected on the main loop, before a worker thread, the database or the GPIO is
+involved.
+
+Token format (big endian):
+    marker 0xB7 (B), operation (B, 1: store, 2: release), expiry in unix seconds (I), slot hint (H, 0: none), barcode,
+    HMAC-SHA256 of the preceding bytes truncated to 16 bytes
+A token is only accepted by the characteristic of its operation: a store token of a courier does not release the
+parcel.
+
+The key is absorbed into the HMAC state once, the verification only copies the precomputed state (a few
+microseconds). A central sending invalid tokens is ignored for a while by the FailureLimiter.
+
+Issuing a token (eg. for the tests):
+    python -m boxee.tokens -k <key file> [-o store|release] [-e <hours valid>] [-s <slot hint>] <barcode>
+"""
+import sys
+import getopt
+import hashlib
+import hmac
+import struct
+import time
+import logging
+from boxee.exceptions import NotPermittedException
+
+logger = logging.getLogger(__name__)
+
+MARKER = 0xB7
+HEAD = struct.Struct('>BBIH')
+MAC_SIZE = 16
+OP_STORE = 1
+OP_RELEASE = 2
+OPERATIONS = {'store': OP_STORE, 'release': OP_RELEASE}
+
+
+class InvalidTokenException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+def _equal(first, second):
+    if len(first) != len(second):
+        return False
+    result = 0
+    for x, y in zip(first, second):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+# constant time comparison (hmac.compare_digest is available from python 2.7.7)
+compare_digest = getattr(hmac, 'compare_digest', _equal)
+
+
+def load_key(path):
+    """
+    :param path: a file with the key of the locker, hex encoded (or raw bytes)
+    """
+    with open(path, 'rb') as key_file:
+        key = key_file.read().strip()
+    try:
+        return key.decode('hex')
+    except TypeError:
+        return key
+
+
+class TokenSigner:
+    """
+    Issues the tokens (the back office side; used by the tests and the tools)
+    """
+
+    def __init__(self, key):
+        self.mac = hmac.new(key, digestmod=hashlib.sha256)
+
+    def sign(self, barcode, expiry, slot_hint=0, operation=OP_STORE):
+        """
+        :param expiry: unix time in seconds
+        :param operation: OP_STORE or OP_RELEASE
+        :return: the token as a str
+        """
+        message = HEAD.pack(MARKER, operation, int(expiry), slot_hint) + barcode
+        mac = self.mac.copy()
+        mac.update(message)
+        return message + mac.digest()[:MAC_SIZE]
+
+
+class TokenVerifier:
+    def __init__(self, key, clock=time.time):
+        """
+        :param key: the key of the locker
+        :param clock: returns the current unix time
+        """
+        self.mac = hmac.new(key, digestmod=hashlib.sha256)
+        self.clock = clock
+
+    def verify(self, token, operation):
+        """
+        :param token: the written value as a str
+        :param operation: the operation of the characteristic written (OP_STORE or OP_RELEASE)
+        :return: the (barcode, slot hint) tuple; the slot hint is None if not set
+        :raise InvalidTokenException: if the token is malformed, forged, expired or issued for another operation
+        """
+        if len(token) <= HEAD.size + MAC_SIZE or ord(token[0]) != MARKER:
+            raise InvalidTokenException('not a token')
+        message, signature = token[:-MAC_SIZE], token[-MAC_SIZE:]
+        mac = self.mac.copy()
+        mac.update(message)
+        if not compare_digest(mac.digest()[:MAC_SIZE], signature):
+            raise InvalidTokenException('invalid signature')
+        marker, token_operation, expiry, slot_hint = HEAD.unpack_from(message)
+        if token_operation != operation:
+            raise InvalidTokenException('issued for operation [%s], not [%s]' % (token_operation, operation))
+        if expiry < self.clock():
+            raise InvalidTokenException('expired at [%s]' % expiry)
+        return message[HEAD.size:], slot_hint or None
+
+
+class FailureLimiter:
+    """
+    Counts the failures of every central; a central with too many recent failures is blocked for a while. Used on the
+    main loop only.
+    """
+
+    def __init__(self, max_failures=5, window=60.0, block_time=300.0, max_tracked=256, clock=time.time):
+        """
+        :param max_failures: the number of failures tolerated within the window
+        :param window: the seconds after which a failure is forgotten
+        :param block_time: the seconds a central is ignored after too many failures
+        :param max_tracked: the number of centrals tracked (the oldest entries are dropped)
+        """
+        self.max_failures = max_failures
+        self.window = window
+        self.block_time = block_time
+        self.max_tracked = max_tracked
+        self.clock = clock
+        # device -> [failure count, start of the window, blocked until]
+        self.devices = dict()
+        self.rejected = 0
+
+    def blocked(self, device):
+        entry = self.devices.get(device)
+        if entry is None or entry[2] < self.clock():
+            return False
+        self.rejected += 1
+        return True
+
+    def failed(self, device):
+        now = self.clock()
+        entry = self.devices.get(device)
+        if entry is None or now - entry[1] > self.window:
+            if entry is None and len(self.devices) >= self.max_tracked:
+                self._forget(now)
+            entry = [0, now, 0]
+            self.devices[device] = entry
+        entry[0] += 1
+        if entry[0] >= self.max_failures:
+            entry[0] = 0
+            entry[1] = now
+            entry[2] = now + self.block_time
+            logger.warn('[%s] is ignored for [%s] s after [%s] failures', device, self.block_time, self.max_failures)
+
+    def _forget(self, now):
+        for device, entry in self.devices.items():
+            if entry[2] < now and now - entry[1] > self.window:
+                del self.devices[device]
+        if len(self.devices) >= self.max_tracked:
+            del self.devices[min(self.devices, key=lambda device: self.devices[device][1])]
+
+
+class WriteGuard:
+    """
+    Checks the parcel writes on the main loop: blocked centrals are rejected without any work, the tokens are verified
+    and the failures are counted per central.
+    """
+
+    def __init__(self, verifier, limiter=None):
+        """
+        :type verifier: TokenVerifier
+        :type limiter: FailureLimiter
+        """
+        self.verifier = verifier
+        self.limiter = limiter if limiter is not None else FailureLimiter()
+        self.accepted = 0
+        self.invalid = 0
+
+    def check(self, value, device, operation):
+        """
+        :param value: the written bytes
+        :param device: the object path of the writing central (None if bluez does not tell it)
+        :param operation: the operation of the written characteristic (OP_STORE or OP_RELEASE)
+        :return: the (barcode, slot hint) tuple
+        :raise NotPermittedException: if the write is rejected
+        """
+        device = device or 'unknown'
+        if self.limiter.blocked(device):
+            raise NotPermittedException()
+        try:
+            result = self.verifier.verify(''.join(chr(byte) for byte in value), operation)
+        except InvalidTokenException as e:
+            self.invalid += 1
+            self.limiter.failed(device)
+            logger.warn('rejecting the write of [%s]: %s', device, str(e))
+            raise NotPermittedException()
+        self.accepted += 1
+        return result
+
+    def describe(self):
+        return '[%s] tokens accepted, [%s] invalid, [%s] writes of blocked centrals ignored' % (
+            self.accepted, self.invalid, self.limiter.rejected)
+
+
+def usage():
+    print ('Usage: python -m boxee.tokens [options] <barcode>')
+    print ('\t -h --help \t list all command line options')
+    print ('\t -k --key <file> \t the key of the locker (hex)')
+    print ('\t -o --operation <store|release> \t the operation the token is issued for (default: store)')
+    print ('\t -e --expires <hours> \t the validity of the token (default: 24)')
+    print ('\t -s --slot <slot id> \t the slot hint')
+
+
+def main(argv):
+    key = None
+    hours = 24.0
+    slot_hint = 0
+    operation = OP_STORE
+    try:
+        opts, args = getopt.getopt(argv, "hk:o:e:s:", ["help", "key=", "operation=", "expires=", "slot="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-k', '--key'):
+            key = load_key(arg)
+        elif opt in ('-o', '--operation'):
+            if arg not in OPERATIONS:
+                usage()
+                sys.exit(2)
+            operation = OPERATIONS[arg]
+        elif opt in ('-e', '--expires'):
+            hours = float(arg)
+        elif opt in ('-s', '--slot'):
+            slot_hint = int(arg)
+    if key is None or len(args) != 1:
+        usage()
+        sys.exit(2)
+    print(TokenSigner(key).sign(args[0], time.time() + hours * 3600, slot_hint, operation).encode('hex'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 __author__ = 'tamas'
+import time
 import dbus
 
 def describe_dbus_dict(dbus_dict):
@@ -16,3 +17,34 @@ def describe_dbus_dict(dbus_dict):
             s.append('%s = %s' % (key, value))
         s.append('\n')
     return "".join(s)
+
+
+class StartupProfile:
+    """
+    Collects the duration of the startup stages (imports, database, GPIO, D-Bus, registrations, background warm up)
+    """
+
+    def __init__(self, started=None):
+        """
+        :param started: the time when the process started (defaults to now)
+        """
+        self.started = started if started is not None else time.time()
+        self.last = self.started
+        self.stages = []
+
+    def mark(self, stage, since=None):
+        """
+        Records the time spent on a stage
+        :param stage: the name of the stage
+        :param since: the start of the stage (defaults to the end of the previous stage)
+        :return: the duration in milliseconds
+        """
+        now = time.time()
+        duration = (now - (since if since is not None else self.last)) * 1000
+        self.stages.append((stage, duration, (now - self.started) * 1000))
+        self.last = now
+        return duration
+
+    def report(self):
+        lines = ['%-32s %9.1f ms  (at %9.1f ms)' % stage for stage in self.stages]
+        return '\n'.join(lines)
@@ -0,0 +1,68 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import logging
+import traceback
+from boxee.advertisement import AdvertisementScheduler, AdvertisementPayload, BoxAdvertisement
+from boxee.config import ConfigReloader, default_config
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+class RecordingAdvertisingManager:
+    """
+    Stands in for org.bluez.LEAdvertisingManager1: the registrations succeed at once and the registered intervals are
+    recorded
+    """
+
+    def __init__(self):
+        self.registered = []
+
+    def RegisterAdvertisement(self, path, options, reply_handler, error_handler):
+        self.registered.append(path)
+        reply_handler()
+
+    def UnregisterAdvertisement(self, path):
+        pass
+
+
+def main(argv):
+    folder = tempfile.mkdtemp(prefix='boxee-config')
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT)
+        config = default_config()
+        manager = RecordingAdvertisingManager()
+        scheduler = AdvertisementScheduler(manager, 'hci0', supported_instances=2)
+        connectable = BoxAdvertisement(None, 0, AdvertisementPayload())
+        connectable.set_interval(*config['advertising_intervals']['connectable'])
+        scheduler.add(connectable, pinned=True)
+        scheduler.start()
+
+        def apply_intervals(old, new):
+            connectable.set_interval(*new['connectable'])
+            scheduler.reconfigure()
+
+        path = os.path.join(folder, 'boxee.json')
+        with open(path, 'w') as config_file:
+            json.dump({'advertising_intervals': {'connectable': [300, 400]}}, config_file)
+        reloader = ConfigReloader(path, config, {'advertising_intervals': apply_intervals})
+        applied = reloader.reload()
+        print('applied: %s' % applied)
+        print('interval [%s, %s], registrations [%s], running config %s' % (
+            connectable.min_interval, connectable.max_interval, len(manager.registered),
+            config['advertising_intervals']['connectable']))
+        print('reload applied: %s' % (applied == ['advertising_intervals'] and len(manager.registered) == 2
+                                      and config['advertising_intervals']['connectable'] == [300, 400]))
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+import json
+import shutil
+import tempfile
+import logging
+import traceback
+from boxee.core import Service, NotificationAbleCharacteristic
+from boxee.replay import FakeBus
+from boxee.schema import GattSchema
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+DESCRIPTION = u'Csomagautomata rekesz № 1 (\xe1tv\xe9tel)'
+
+
+def main(argv):
+    folder = tempfile.mkdtemp(prefix='boxee-profile')
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT)
+        path = os.path.join(folder, 'profile.json')
+        with open(path, 'w') as profile_file:
+            json.dump({'services': [{'name': 'locker', 'uuid': '3c0e6a4e-51f2-4b7a-9a43-6d1f0c1e0001',
+                                     'characteristics': [{'name': 'slot', 'uuid': '2A56', 'flags': ['read', 'notify'],
+                                                          'description': DESCRIPTION}]}]}, profile_file)
+        spec = GattSchema.load(path).service('locker')
+        bus = FakeBus()
+        service = Service(None, bus, spec.index, spec.uuid, spec.primary, spec.path)
+        service.add_characteristics(spec, {'slot': lambda chrc_spec: NotificationAbleCharacteristic(bus, chrc_spec,
+                                                                                                     service)})
+        description = service.get_characteristics()[0].get_descriptors()[0].ReadValue()
+        print('description read back: %s' % description.decode('utf-8'))
+        print('utf-8 encoded: %s' % (description.decode('utf-8') == DESCRIPTION))
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script
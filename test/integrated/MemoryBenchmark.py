@@ -0,0 +1,81 @@
+import gc
+import sys
+import types
+import resource
+import logging
+import traceback
+from boxee.core import Service, NotificationAbleCharacteristic
+from boxee.replay import FakeBus
+from boxee.schema import GattSchema
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+WALL_SRV_UUID = '3c0e6a4e-51f2-4b7a-9a43-6d1f0c1e0000'
+# the objects every instance refers to, but which are not owned by them
+SKIPPED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def wall_profile(slots):
+    """
+    :return: a GATT profile with one read / notify characteristic per slot, as a locker wall would have
+    """
+    return {'services': [{'name': 'wall', 'uuid': WALL_SRV_UUID, 'characteristics': [
+        {'name': 'slot%s' % slot, 'uuid': '%08x-0000-4000-8000-00000000b0c5' % slot, 'flags': ['read', 'notify'],
+         'description': 'Slot %s' % slot} for slot in range(slots)]}]}
+
+
+def build_wall(bus, slots):
+    spec = GattSchema(wall_profile(slots)).service('wall')
+    service = Service(None, bus, spec.index, spec.uuid, spec.primary, spec.path)
+    factory = lambda chrc_spec: NotificationAbleCharacteristic(bus, chrc_spec, service)
+    service.add_characteristics(spec, dict((chrc_spec.name, factory) for chrc_spec in spec.characteristics))
+    return service
+
+
+def deep_size(root, excluded):
+    """
+    :return: the bytes of every object reachable from root, each counted once (classes, modules and functions and
+    the excluded objects are not followed)
+    """
+    seen = set(id(obj) for obj in excluded)
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(argv):
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT)
+        slots = int(argv[0]) if argv else 1000
+        bus = FakeBus()
+        small = build_wall(bus, 1)
+        small_size = deep_size(small, [bus])
+        rss_before = max_rss_kb()
+        wall = build_wall(bus, slots)
+        rss_after = max_rss_kb()
+        wall_size = deep_size(wall, [bus])
+        print ('[%s] characteristics with a user description descriptor each' % slots)
+        print ('object graph: %s bytes in total, %.0f bytes per characteristic' % (
+            wall_size, float(wall_size - small_size) / (slots - 1)))
+        print ('max RSS growth: %s KB, %.0f bytes per characteristic' % (
+            rss_after - rss_before, (rss_after - rss_before) * 1024.0 / slots))
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script
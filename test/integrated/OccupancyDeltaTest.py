@@ -0,0 +1,35 @@
+import sys
+import logging
+import traceback
+from boxee.occupancy import OccupancyBitmap, MIN_DELTA_SIZE
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+def main(argv):
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT)
+        slot_count = 100
+        for max_size in (MIN_DELTA_SIZE, MIN_DELTA_SIZE + 1, 20):
+            occupancy = OccupancyBitmap()
+            occupancy.rebuild([(slot_id, 'F', 0, 0) for slot_id in xrange(slot_count)])
+            for slot_id in xrange(0, slot_count, 3):
+                occupancy.set(slot_id, True)
+            messages = occupancy.take_delta(max_size)
+            print('max size [%s]: [%s] messages, longest [%s] bytes, within the limit: %s' % (
+                max_size, len(messages), max(len(message) for message in messages),
+                all(len(message) <= max_size for message in messages)))
+        try:
+            OccupancyBitmap().take_delta(MIN_DELTA_SIZE - 1)
+            print('too small max size rejected: False')
+        except ValueError:
+            print('too small max size rejected: True')
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script
@@ -0,0 +1,59 @@
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import logging
+import traceback
+from boxee.persistence import BoxDao
+from boxee.replication import MirrorStore, OutboxShipper, create_receiver, create_transport
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+
+def replicate(box_dao, endpoint, store):
+    """
+    Stores and releases parcels while the shipper is running, then compares the mirror with the database
+    """
+    shipper = OutboxShipper(box_dao, 1, create_transport(endpoint), interval=0.2, batch_size=4)
+    shipper.start()
+    for slot_id in range(1, 11):
+        box_dao.update_box(slot_id, True, 'parcel-%s' % slot_id)
+    time.sleep(0.5)
+    for slot_id in range(1, 11, 2):
+        box_dao.update_box(slot_id, False, '')
+    time.sleep(0.5)
+    shipper.stop()
+    expected = dict((slot_id, (used, barcode)) for slot_id, used, barcode in box_dao.fetch_snapshot()[1])
+    print('[%s] mirror in sync: [%s], outbox left: [%s] changes' % (endpoint, store.slots(1) == expected,
+                                                                     len(box_dao.fetch_outbox(1000))))
+    print(shipper.describe())
+
+
+def main(argv):
+    folder = tempfile.mkdtemp(prefix='boxee-replication')
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT, level=logging.INFO)
+        box_dao = BoxDao(range(1, 11), folder)
+        for endpoint, receiver in [('http://127.0.0.1:8642/', dict(port=8642)),
+                                   ('unix:%s/mirror.sock' % folder, dict(path=folder + '/mirror.sock'))]:
+            store = MirrorStore()
+            server = create_receiver(store, **receiver)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            replicate(box_dao, endpoint, store)
+            server.shutdown()
+            server.server_close()
+        box_dao.destroy()
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script
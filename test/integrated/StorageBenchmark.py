@@ -0,0 +1,108 @@
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import logging
+import traceback
+from boxee.persistence import create_dao, STORAGE_ENGINES
+
+__author__ = 'tamas'
+logger = logging.getLogger(__name__)
+
+SLOTS = 200
+
+
+def single(dao, operations):
+    """
+    A parcel is stored and released one by one, as the characteristics do
+    """
+    for i in xrange(operations // 2):
+        barcode = 'parcel-%s' % i
+        slot_id = dao.reserve_slot(barcode)
+        dao.fetch_slot_by_barcode(barcode)
+        dao.update_box(slot_id, False, '')
+
+
+def bulk(dao, operations):
+    """
+    Couriers drop off and recipients collect 10 parcels at once
+    """
+    for i in xrange(operations // 20):
+        barcodes = ['bulk-%s-%s' % (i, j) for j in range(10)]
+        dao.reserve_slots(barcodes)
+        dao.release_slots(barcodes)
+
+
+def lookups(dao, operations):
+    """
+    Mostly unknown barcodes are scanned
+    """
+    for i in xrange(operations):
+        dao.fetch_slot_by_barcode('unknown-%s' % i)
+    dao.count_slots()
+
+
+def concurrent(dao, operations, threads=4):
+    """
+    The worker threads of the executor store and release in parallel
+    """
+    def work(thread_id):
+        for i in xrange(operations // threads // 2):
+            slot_id = dao.reserve_slot('thread-%s-%s' % (thread_id, i))
+            if slot_id > 0:
+                dao.update_box(slot_id, False, '')
+    workers = [threading.Thread(target=work, args=(thread_id,)) for thread_id in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+WORKLOADS = [('single', single), ('bulk', bulk), ('lookups', lookups), ('concurrent', concurrent)]
+
+
+def recovery(engine, folder):
+    """
+    Leaves changes in the log (or journal) without a clean shutdown and measures the time of the next start
+    """
+    dao = create_dao(engine, range(1, SLOTS + 1), folder)
+    for i in xrange(100):
+        dao.reserve_slot('crash-%s' % i)
+    # no destroy: as if the power was lost
+    started = time.time()
+    reopened = create_dao(engine, range(1, SLOTS + 1), folder)
+    duration = (time.time() - started) * 1000
+    free, total = reopened.count_slots()
+    reopened.destroy()
+    return duration, total - free
+
+
+def main(argv):
+    try:
+        FORMAT = '%(levelname)s - %(module)s.%(funcName)s: %(message)s'
+        logging.basicConfig(format=FORMAT)
+        operations = int(argv[0]) if argv else 2000
+        print('[%s] operations per workload on [%s] slots' % (operations, SLOTS))
+        for engine in STORAGE_ENGINES:
+            folder = tempfile.mkdtemp(prefix='boxee-storage')
+            try:
+                dao = create_dao(engine, range(1, SLOTS + 1), folder)
+                for name, workload in WORKLOADS:
+                    started = time.time()
+                    workload(dao, operations)
+                    duration = time.time() - started
+                    print('%-9s %-11s %8.1f ms  %8.1f us/operation' % (engine, name, duration * 1000,
+                                                                       duration * 1e6 / operations))
+                dao.destroy()
+                duration, used = recovery(engine, tempfile.mkdtemp(dir=folder))
+                print('%-9s %-11s %8.1f ms  (%s parcels recovered)' % (engine, 'recovery', duration, used))
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+    except BaseException as e:
+        print('Base exception received: %s' % str(e))
+        traceback.print_exc()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])  # chop off the sys.argv[0] which is the name of the script